@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+sys.path.insert(0, os.path.join(REPO_ROOT, "src", "Python"))
+from utils import DuckSession, gen_asof_sql, asof_join_df
+
+# benchmark the as-of nearest-observation match (asof_join_utils) against the join-and-rank pattern of
+# BMI_IDX in src/SQL/pat_obs.sql (every observation of the patient joined to the anchor, ranked by
+# distance), in duckdb and in pandas, on synthetic anchors and observations; all four must agree
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return out, time.perf_counter() - start
+
+def gen_data(n_pats, obs_per_pat, anchors_per_pat, seed):
+    rng = np.random.default_rng(seed)
+    day0 = np.datetime64("2012-01-01")
+    patid = np.char.add("P", np.arange(n_pats).astype(str)).astype(object)
+    anc_pat = np.repeat(np.arange(n_pats), anchors_per_pat)
+    anchors = pd.DataFrame({
+        "PATID": patid[anc_pat],
+        "ANCHOR_DATE": day0 + rng.integers(0, 10*365, len(anc_pat)).astype("timedelta64[D]")
+    }).drop_duplicates(["PATID", "ANCHOR_DATE"]).reset_index(drop = True)
+    obs_pat = rng.integers(0, n_pats, n_pats * obs_per_pat)
+    obs = pd.DataFrame({
+        "PATID": patid[obs_pat],
+        "OBS_DATE": day0 + rng.integers(0, 10*365, len(obs_pat)).astype("timedelta64[D]"),
+        "OBS_NUM": np.round(rng.normal(1.2, 0.4, len(obs_pat)), 3)
+    })
+    return anchors, obs
+
+def gen_rank_sql(direction, tolerance):
+    # join-and-rank baseline, same tie rules as gen_asof_sql
+    cond = {"before": "o.OBS_DATE <= a.ANCHOR_DATE", "after": "o.OBS_DATE >= a.ANCHOR_DATE", "nearest": "1 = 1"}[direction]
+    if tolerance is not None:
+        cond += f" and abs(datediff('day', a.ANCHOR_DATE, o.OBS_DATE)) <= {int(tolerance)}"
+    tie = {"before": "o.OBS_NUM desc", "after": "o.OBS_NUM", "nearest": "case when o.OBS_DATE <= a.ANCHOR_DATE then 0 else 1 end, case when o.OBS_DATE <= a.ANCHOR_DATE then -o.OBS_NUM else o.OBS_NUM end"}[direction]
+    return f"""
+        select a.*, r.OBS_DATE as _OBS_DATE, r.OBS_NUM as _OBS_NUM from ANCHORS a
+        left join (
+            select a.PATID, a.ANCHOR_DATE, o.OBS_DATE, o.OBS_NUM,
+                   row_number() over (partition by a.PATID, a.ANCHOR_DATE order by abs(datediff('day', a.ANCHOR_DATE, o.OBS_DATE)), {tie}) as rn
+            from ANCHORS a join OBS o on a.PATID = o.PATID
+            where {cond}
+        ) r on r.PATID = a.PATID and r.ANCHOR_DATE = a.ANCHOR_DATE and r.rn = 1
+    """
+
+def rank_df(anchors, obs, direction, tolerance):
+    # pandas join-and-rank baseline
+    pairs = anchors.merge(obs, on = "PATID")
+    d = (pairs["OBS_DATE"] - pairs["ANCHOR_DATE"]).dt.days
+    keep = {"before": d <= 0, "after": d >= 0, "nearest": d == d}[direction]
+    if tolerance is not None:
+        keep &= d.abs() <= tolerance
+    d, num = d[keep], pairs["OBS_NUM"][keep]
+    # same-date ties: the largest value looking back, the smallest looking ahead
+    back = d <= 0 if direction == "nearest" else pd.Series(direction == "before", index = d.index)
+    pairs = pairs[keep].assign(_D = d.abs(), _S = (d > 0).astype(int), _V = np.where(back, -num, num))
+    best = pairs.sort_values(["PATID", "ANCHOR_DATE", "_D", "_S", "_V"]).drop_duplicates(["PATID", "ANCHOR_DATE"])
+    return anchors.merge(best[["PATID", "ANCHOR_DATE", "OBS_DATE", "OBS_NUM"]].rename(columns = {"OBS_DATE": "_OBS_DATE", "OBS_NUM": "_OBS_NUM"}), on = ["PATID", "ANCHOR_DATE"], how = "left")
+
+def same(a, b):
+    key = ["PATID", "ANCHOR_DATE"]
+    a = a.sort_values(key).reset_index(drop = True)["_OBS_NUM"].astype(float).fillna(-1).to_numpy()
+    b = b.sort_values(key).reset_index(drop = True)["_OBS_NUM"].astype(float).fillna(-1).to_numpy()
+    return len(a) == len(b) and np.allclose(a, b)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "benchmark as-of nearest-observation matching against join-and-rank")
+    parser.add_argument("--pats", type = int, nargs = "+", default = [10000, 100000], help = "patient counts to benchmark")
+    parser.add_argument("--obs-per-pat", type = int, default = 50, help = "observations per patient")
+    parser.add_argument("--anchors-per-pat", type = int, default = 4, help = "anchor dates per patient")
+    parser.add_argument("--direction", choices = ["before","after","nearest"], default = "nearest")
+    parser.add_argument("--tolerance", type = int, default = None, help = "max days between anchor and observation")
+    parser.add_argument("--threads", type = int, default = None, help = "duckdb threads per query")
+    parser.add_argument("--seed", type = int, default = 42)
+    args = parser.parse_args()
+
+    print("pats\tobs\tanchors\tsql_rank(s)\tsql_asof(s)\tdf_rank(s)\tdf_asof(s)\tagree")
+    for n_pats in args.pats:
+        anchors, obs = gen_data(n_pats, args.obs_per_pat, args.anchors_per_pat, args.seed)
+        with DuckSession(threads = args.threads) as session:
+            session.write_pandas(anchors, "ANCHORS", overwrite = True)
+            session.write_pandas(obs, "OBS", overwrite = True)
+            sql_rank, t_sql_rank = timed(lambda: session.sql(gen_rank_sql(args.direction, args.tolerance)).to_pandas())
+            sql_asof, t_sql_asof = timed(lambda: session.sql(gen_asof_sql(
+                "ANCHORS", "OBS", "PATID", "ANCHOR_DATE", "OBS_DATE", ["OBS_NUM"], args.direction, args.tolerance, order_cols = ["OBS_NUM"], prefix = "_"
+            )).to_pandas())
+        df_rank, t_df_rank = timed(rank_df, anchors, obs, args.direction, args.tolerance)
+        df_asof, t_df_asof = timed(
+            asof_join_df, anchors, obs, "PATID", "ANCHOR_DATE", "OBS_DATE", ["OBS_NUM"], args.direction, args.tolerance, order_cols = ["OBS_NUM"], prefix = "_"
+        )
+        agree = same(sql_rank, sql_asof) and same(sql_rank, df_rank) and same(sql_rank, df_asof)
+        print(f"{n_pats}\t{len(obs)}\t{len(anchors)}\t{t_sql_rank:.3f}\t{t_sql_asof:.3f}\t{t_df_rank:.3f}\t{t_df_asof:.3f}\t{agree}")
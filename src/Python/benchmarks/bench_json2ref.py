@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import json2ref, json2ref_df, expand_range
+
+# benchmark json2ref against the previous per-row apply/concat/explode implementation
+# on a synthetic valueset with wide code ranges
+
+def json2ref_df_legacy(json_file):
+    # previous implementation, kept here for comparison only
+    csv_lst = []
+    for item in json_file:
+        for chunk in item["compose"]["include"]:
+            add_chunk = {
+                'id':item["id"],
+                'name':item["name"],
+                'description':item["description"],
+                'codesystem':chunk["system"]
+            }
+            if "filter" in chunk:
+                for filter_item in chunk["filter"]:
+                    if filter_item['property'] == 'codeRange':
+                        code_expand = [expand_range(x) for x in filter_item['value']]
+                        add_chunk['code'] = code_expand
+                        add_chunk['op'] = ['exists']*len(code_expand)
+                    else:
+                        add_chunk['code'] = filter_item['value']
+                        add_chunk['op'] = [filter_item["op"]]*len(filter_item['value'])
+            if "concept" in chunk:
+                add_chunk['code'] = [x["code"] for x in chunk["concept"]]
+                add_chunk['op'] = ['exists' if 'op' not in x else x["op"] for x in chunk["concept"]]
+            csv_lst.append(add_chunk)
+
+    df = pd.DataFrame(csv_lst)
+    def expand_row(row):
+        return pd.DataFrame({
+            'code': row['code'],
+            'op': row['op'],
+            **{col: [row[col]] * len(row['code']) for col in df.columns if col not in ['code', 'op']}
+        })
+    expanded_df = pd.concat(df.apply(expand_row, axis=1).tolist(), ignore_index=True)
+    expanded_df = expanded_df[['id','name','description','codesystem','code','op']]
+    return expanded_df.explode('code')
+
+def gen_synthetic_vs(n_blocks, n_ranges, range_width, n_list, seed = 42):
+    rng = random.Random(seed)
+    json_file = []
+    for i in range(n_blocks):
+        ranges = []
+        for _ in range(n_ranges):
+            lo = rng.randint(10000, 90000)
+            ranges.append(f"{lo}-{lo + range_width}")
+        json_file.append({
+            "id": "SY" + str(i).zfill(5),
+            "name": f"SYN{i}",
+            "description": "synthetic valueset",
+            "compose": {
+                "include": [
+                    {"system": "cpt", "filter": [{"property": "codeRange", "op": "in", "value": ranges}]},
+                    {"system": "icd10cm", "filter": [{"property": "codePrecision", "op": "descendent-of",
+                        "value": ["E" + str(rng.randint(10, 99)) + "." + str(rng.randint(0, 9)) for _ in range(n_list)]}]},
+                    {"system": "rxnorm", "concept": [{"code": str(rng.randint(1000, 9999999))} for _ in range(n_list)]}
+                ]
+            }
+        })
+    return json_file
+
+def timed(fn, *args):
+    # time without tracing, then rerun under tracemalloc for the peak python-heap memory
+    # (arrow-backed pandas string buffers are not counted)
+    start = time.perf_counter()
+    out = fn(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return out, elapsed, peak / 2**20
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "benchmark valueset expansion (json2ref)")
+    parser.add_argument("--blocks", type = int, default = 200)
+    parser.add_argument("--ranges", type = int, default = 10)
+    parser.add_argument("--range-width", type = int, default = 200)
+    parser.add_argument("--codes", type = int, default = 50, help = "listed codes per include block")
+    parser.add_argument("--skip-legacy", action = "store_true")
+    args = parser.parse_args()
+
+    json_file = gen_synthetic_vs(args.blocks, args.ranges, args.range_width, args.codes)
+    print(f"synthetic valueset: {args.blocks} blocks, {args.ranges} ranges x {args.range_width} codes per block")
+
+    new_df, new_t, new_mem = timed(json2ref_df, json_file)
+    print(f"json2ref_df (streaming):  {len(new_df)} rows in {new_t:.3f}s, peak {new_mem:.1f} MiB, {len(new_df)/new_t:,.0f} rows/s")
+    if not args.skip_legacy:
+        old_df, old_t, old_mem = timed(json2ref_df_legacy, json_file)
+        print(f"json2ref_df (legacy):     {len(old_df)} rows in {old_t:.3f}s, peak {old_mem:.1f} MiB, {len(old_df)/old_t:,.0f} rows/s")
+        same = new_df.reset_index(drop = True).equals(old_df.reset_index(drop = True).astype({'code': str}))
+        print(f"speedup: {old_t/new_t:.1f}x, identical output: {same}")
+
+    # end to end, written in chunks
+    with tempfile.TemporaryDirectory() as tmpdir:
+        vs_path = os.path.join(tmpdir, "vs-synthetic.json")
+        with open(vs_path, "w") as f:
+            json.dump(json_file, f)
+        for ext in ["csv", "parquet"]:
+            out_path = os.path.join(tmpdir, "vs-synthetic." + ext)
+            _, t, mem = timed(json2ref, vs_path, out_path)
+            print(f"json2ref -> {ext}: {t:.3f}s, peak {mem:.1f} MiB, {os.path.getsize(out_path)/2**20:.1f} MiB on disk")
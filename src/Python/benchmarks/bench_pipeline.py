@@ -0,0 +1,132 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+# run from the repo root so the ./ref paths used by event_log.py resolve
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+os.chdir(REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "src", "Python"))
+import utils.gen_vs_json_utils as vs_utils
+from utils import DuckSession, gen_synthetic_cdm, run_site_tasks, create_pat_table1, gen_ktx_tbl1_sql, sql_size_report
+import event_log
+
+# benchmark the pipeline end to end on synthetic extracts with the duckdb backend:
+# valueset sql generation (cold and warm), generated sql size plain and compact/bound, event logging per query mode, KTX_TBL1.
+# results can be saved as json and compared across commits with --baseline
+
+QRY_MODES = ["union", "case", "fanout", "join"]
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return out, time.perf_counter() - start
+
+def bench_sqlgen(sites, repeat = 20):
+    # cold: empty in-process memo and no disk cache; warm: compiled predicates reused
+    res = []
+    for qry_mode in QRY_MODES:
+        vs_kd = event_log.get_vs_kd("duckdb")
+        for vs in vs_kd.values():
+            vs.cache_dir = None
+        vs_utils.VS_JSON_MEMO.clear()
+        vs_utils.VS_QRY_REF_MEMO.clear()
+        qry, cold = timed(lambda: [event_log.gen_domain_qry(vs, s, qry_mode) for vs in vs_kd.values() for s in sites])
+        _, warm = timed(lambda: [event_log.gen_domain_qry(vs, s, qry_mode) for _ in range(repeat) for vs in vs_kd.values() for s in sites])
+        # full site statements as sent by event_log.py, plain and compact/bound (--compact-sql)
+        plain = sql_size_report([x for t in event_log.gen_site_tasks(sites, qry_mode, "snow") for x in t["sql"]])
+        bound = sql_size_report([x for t in event_log.gen_site_tasks(sites, qry_mode, "snow", compact = True) for x in t["sql"]])
+        res.append({
+            "step": "sqlgen", "qry_mode": qry_mode, "cold_s": round(cold, 4), "warm_s": round(warm / repeat, 5),
+            "sql_bytes": sum(len(q.encode()) for q in qry), "sql_bytes_compact": sum(len(" ".join(q.split()).encode()) for q in qry),
+            "stmt_bytes": plain["sql_bytes"], "stmt_bytes_bound": bound["sql_bytes"], "bound_param_bytes": bound["param_bytes"],
+            "stmt_texts": plain["distinct_texts"], "stmt_texts_bound": bound["distinct_texts"]
+        })
+    return res
+
+def bench_event_log(cdm_root, sites, max_workers, threads):
+    res = []
+    for qry_mode in QRY_MODES:
+        with DuckSession(cdm_root = cdm_root, threads = threads) as session:
+            session.use_schema("SX_CISTEM2")
+            event_log.create_long_shells(session, overwrite = True)
+            if qry_mode == "join":
+                event_log.upload_code_ref(session)
+            tasks = event_log.gen_site_tasks(sites, qry_mode = qry_mode, sqlty = "duckdb")
+            results, elapsed = timed(run_site_tasks, session, tasks, max_workers = max_workers, retries = 0, verbose = False)
+            failed = [r for r in results if r["status"] != "done"]
+            if failed:
+                raise RuntimeError(f"event logging failed: {failed[0]['error']}")
+            n_dxpx = session.sql(f"SELECT count(*) FROM {event_log.log_tbl_dxpx}").collect()[0][0]
+            n_rx = session.sql(f"SELECT count(*) FROM {event_log.log_tbl_rx}").collect()[0][0]
+            res.append({"step": "event_log", "qry_mode": qry_mode, "elapsed_s": round(elapsed, 3), "rows": n_dxpx + n_rx})
+            if qry_mode == "union":
+                res += bench_ktx_tbl1(session)
+    return res
+
+def bench_ktx_tbl1(session):
+    _, t_pat = timed(create_pat_table1, session, session.sites)
+    res = [{"step": "pat_table1", "elapsed_s": round(t_pat, 3)}]
+    for single_pass in [False, True]:
+        _, t_ktx = timed(lambda: session.sql(f"CREATE OR REPLACE TABLE KTX_TBL1 AS {gen_ktx_tbl1_sql(single_pass = single_pass)}").collect())
+        rows = session.sql("SELECT count(*) FROM KTX_TBL1").collect()[0][0]
+        res.append({"step": "ktx_tbl1", "qry_mode": "single" if single_pass else "multi", "elapsed_s": round(t_ktx, 3), "rows": rows})
+    return res
+
+def print_results(results, baseline = None):
+    # one line per step, with the ratio to the matching baseline entry if given
+    base = {(b["n_pats"], b["step"], b.get("qry_mode")): b for b in (baseline or [])}
+    for r in results:
+        key = (r["n_pats"], r["step"], r.get("qry_mode"))
+        metric = "warm_s" if r["step"] == "sqlgen" else "elapsed_s"
+        line = f"{r['n_pats']:>10} {r['step']:<10} {r.get('qry_mode') or '':<7} " + " ".join(
+            f"{k}={v}" for k, v in r.items() if k not in ("n_pats", "step", "qry_mode")
+        )
+        if key in base and base[key].get(metric):
+            line += f"  ({r[metric] / base[key][metric]:.2f}x baseline)"
+        print(line)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "benchmark sql generation, event logging and KTX_TBL1 on synthetic cdm extracts")
+    parser.add_argument("--pats", type = int, nargs = "+", default = [10000, 100000], help = "patient counts to benchmark")
+    parser.add_argument("--sites", nargs = "+", default = ["SITE1","SITE2","SITE3","SITE4"])
+    parser.add_argument("--seed", type = int, default = 42)
+    parser.add_argument("--max-workers", type = int, default = 4, help = "site slices running at the same time")
+    parser.add_argument("--threads", type = int, default = None, help = "duckdb threads per query")
+    parser.add_argument("--cdm-dir", default = None, help = "keep the generated extracts here (reused if present) instead of a temp folder")
+    parser.add_argument("--json-out", default = None, help = "save results as json")
+    parser.add_argument("--baseline", default = None, help = "json from an earlier run to compare against")
+    args = parser.parse_args()
+
+    results = []
+    for row in bench_sqlgen(args.sites):
+        results.append({"n_pats": 0, **row})
+
+    for n_pats in args.pats:
+        tmpdir = None
+        if args.cdm_dir is None:
+            tmpdir = tempfile.mkdtemp()
+            cdm_root = tmpdir
+        else:
+            cdm_root = os.path.join(args.cdm_dir, f"cdm_{n_pats}_{args.seed}")
+        if not os.path.exists(os.path.join(cdm_root, args.sites[0])):
+            row_cnt, t_gen = timed(gen_synthetic_cdm, cdm_root, n_pats, sites = args.sites, seed = args.seed)
+            results.append({"n_pats": n_pats, "step": "synth_cdm", "elapsed_s": round(t_gen, 3), "rows": sum(row_cnt.values())})
+        try:
+            for row in bench_event_log(cdm_root, args.sites, args.max_workers, args.threads):
+                results.append({"n_pats": n_pats, **row})
+        finally:
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir, ignore_errors = True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(results, f, indent = 4)
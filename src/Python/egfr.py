@@ -0,0 +1,52 @@
+import argparse
+from utils import connect_session, TrackedSession, print_run_report, gen_egfr_sql, egfr_df, use_sample_schema
+import obs_extract
+
+# longitudinal eGFR of the transplant cohort: every serum creatinine row of ALL_OBS (the SCr loinc
+# valueset of ./ref/vs-cde-kd.json, see obs_extract.py) in mg/dL and scored by CKD-EPI 2021 with
+# age and sex of PAT_TABLE1, see utils/egfr_utils.py. "sql" runs as one statement in the warehouse
+# (or duckdb); "numpy" streams the creatinine rows out in batches and scores them locally
+# run from the repo root, like the other scripts
+
+egfr_tbl = "KTX_EGFR_LONG"
+pat_tbl = "PAT_TABLE1"
+
+def build_egfr(
+    session, #snowpark session or DuckSession
+    mode = "sql" #"sql": set-based in the database; "numpy": vectorized locally, batch by batch
+):
+    qry = gen_egfr_sql(obs_tbl = obs_extract.obs_tbl, pat_tbl = pat_tbl)
+    if mode == "sql":
+        session.sql(f"CREATE OR REPLACE TABLE {egfr_tbl} AS {qry}").collect()
+        return
+    # same table shape as the sql version, filled one batch at a time
+    session.sql(f"CREATE OR REPLACE TABLE {egfr_tbl} AS {qry} LIMIT 0").collect()
+    batches = session.sql(f"""
+        select o.PATID, o.OBS_DATE, o.DAYS_SINCE_INDEX, o.OBS_CODE, o.OBS_NUM, o.OBS_UNIT, o.OBS_SRC, p.BIRTH_DATE, p.SEX
+        from {obs_extract.obs_tbl} o
+        left join {pat_tbl} p on p.PATID = o.PATID
+        where o.OBS_NAME = 'SCr' and o.OBS_NUM is not null
+    """).to_pandas_batches()
+    for df in batches:
+        if len(df) > 0:
+            session.write_pandas(egfr_df(df, None), egfr_tbl, auto_create_table = False, overwrite = False)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "score every serum creatinine of ALL_OBS into a longitudinal eGFR table")
+    parser.add_argument("--mode", choices = ["sql","numpy"], default = "sql", help = "sql: one statement in the database; numpy: vectorized locally, batch by batch")
+    parser.add_argument("--backend", choices = ["snow","duckdb"], default = "snow", help = "snow: GROUSE warehouse; duckdb: local database written by obs_extract.py --backend duckdb")
+    parser.add_argument("--duckdb-file", default = "cistem2_local.duckdb", help = "local database holding ALL_OBS and PAT_TABLE1")
+    parser.add_argument("--run-log-file", default = "run_log.jsonl", help = "local json lines file every statement of the run is appended to, next to the KTX_RUN_LOG table")
+    parser.add_argument("--sample-pct", type = float, default = None, help = "read and write the sampled schema SX_CISTEM2_S<pct>, see event_log.py")
+    args = parser.parse_args()
+
+    with connect_session(args.backend, duckdb_file = args.duckdb_file) as raw_session, \
+         TrackedSession(raw_session, jsonl_file = args.run_log_file, step = "egfr") as session:
+        use_sample_schema(session, "SX_CISTEM2", args.sample_pct)
+        try:
+            with session.tag(slice = egfr_tbl):
+                build_egfr(session, mode = args.mode)
+            print(f"{egfr_tbl}: {session.sql(f'SELECT COUNT(*), COUNT(EGFR) FROM {egfr_tbl}').collect()[0]}")
+        finally:
+            session.flush()
+            print_run_report(session.records)
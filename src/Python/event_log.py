@@ -1,11 +1,12 @@
 import os
-import json
-from utils import QueryFromJson
-from snowflake.snowpark import Session
-from snowflake.snowpark.types import StructType, StructField, StringType, IntegerType, DateType, BooleanType, VariantType
-from snowflake.snowpark.functions import (
-    col, coalesce, lit, lag, to_date, when, datediff, sum as s_sum, max as s_max, min as s_min, row_number,
-    abs as s_abs, iff, least, call_function
+import re
+import copy
+import time
+import argparse
+from utils import (
+    QueryFromJson, gen_code_ref, run_site_tasks, print_site_report, LocalLedger, SnowLedger, filter_fresh_tasks,
+    connect_session, TrackedSession, print_run_report, compact_sql, bind_sql, sql_size_report, sample_schema, use_sample_schema,
+    print_projection
 )
 
 # metadata pull - no need to connect to snowflake
@@ -47,19 +48,6 @@ from snowflake.snowpark.functions import (
 # )
 # print(vs_kd_rx.gen_qry())
 
-# data pull - connect to snowflake
-path_to_config = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) + '\.config.json'
-with open(path_to_config,"r") as f:
-    config = json.load(f)
-    connect_params = {
-        "account": config["snowflake-deid-api"]["acct"],
-        "user": config["snowflake-deid-api"]["user"],
-        "password":config["snowflake-deid-api"]["pwd"],
-        "role": config["snowflake-deid-api"]["role"],
-        "warehouse": config["snowflake-deid-api"]["wh"]
-    }
-
-# Connecting to snowflake
 site_lst = [
     "ALLINA",
     "IHC",
@@ -76,109 +64,279 @@ site_lst = [
     "UU",
     "WASHU"
 ]
-with Session.builder.configs(connect_params).create() as session:
-    # test connection
-    # print(session.sql("SELECT CURRENT_USER(), CURRENT_ROLE(), CURRENT_DATABASE()").collect())
-
-    # set up session
-    session.use_database(config["snowflake-deid-api"]["db"])
-    session.use_schema("SX_CISTEM2")
-
-    ##--- create long table shells
-    log_tbl_dxpx = "KTX_DXPX_LONG" 
-    schema = StructType([
-        StructField("PATID", StringType()),
-        StructField("ENCOUNTERID", StringType()),
-        StructField("ENC_TYPE", StringType()),
-        StructField("CD", StringType()),
-        StructField("CD_TYPE", StringType()),
-        StructField("CD_DATE", DateType()),
-        StructField("PHE_TYPE", StringType()),
-        StructField("SITE", StringType())
-    ])
-    empty_df1 = session.create_dataframe([], schema=schema)
-    empty_df1.write.mode("overwrite").save_as_table(log_tbl_dxpx)
-
-    log_tbl_rx = "KTX_RX_LONG" 
-    schema = StructType([
-        StructField("PATID", StringType()),
-        StructField("ENCOUNTERID", StringType()),
-        StructField("CD", StringType()),
-        StructField("CD_TYPE", StringType()),
-        StructField("CD_DATE", DateType()),
-        StructField("PHE_TYPE", StringType()),
-        StructField("SITE", StringType())
-    ])
-    empty_df2 = session.create_dataframe([], schema=schema)
-    empty_df2.write.mode("overwrite").save_as_table(log_tbl_rx)
-
-    ##--- event logging (logitudinal stacking)
-    for s in site_lst:
-        #--- collect dx, px
-        vs_kd_px = QueryFromJson(
-            url = './ref/vs-cde-kd.json',
-            sqlty = 'snow',
-            cd_field = 'PX',
-            cdtype_field = 'PX_TYPE',
-            date_fields = ["PX_DATE",'ADMIT_DATE'],
-            srctbl_name = f"GROUSE_DEID_DB.PCORNET_CDM_{s}.V_DEID_PROCEDURES",
-            other_fields=["PATID","ENCOUNTERID","ENC_TYPE"],
-            sel_keys = ['KTx','RenalBiopsy'],
-            sel_domain = "px"
-        )
-        vs_kd_dx = QueryFromJson(
-            url = './ref/vs-cde-kd.json',
-            sqlty = 'snow',
-            cd_field = 'DX',
-            cdtype_field = 'DX_TYPE',
-            date_fields = ["DX_DATE",'ADMIT_DATE'],
-            srctbl_name = f"GROUSE_DEID_DB.PCORNET_CDM_{s}.V_DEID_DIAGNOSIS",
-            other_fields=["PATID","ENCOUNTERID","ENC_TYPE"],
-            sel_keys = ['MI','AR','T2DM'],
-            sel_domain = "dx"
+log_tbl_dxpx = "KTX_DXPX_LONG"
+log_tbl_rx = "KTX_RX_LONG"
+code_ref_tbl = "KTX_CODE_REF"
+
+##--- compile valueset predicates once, only the source table changes by site
+vs_kd_px = QueryFromJson(
+    url = './ref/vs-cde-kd.json',
+    sqlty = 'snow',
+    cd_field = 'PX',
+    cdtype_field = 'PX_TYPE',
+    date_fields = ["PX_DATE",'ADMIT_DATE'],
+    srctbl_name = "GROUSE_DEID_DB.PCORNET_CDM_{site}.V_DEID_PROCEDURES",
+    other_fields=["PATID","ENCOUNTERID","ENC_TYPE"],
+    sel_keys = ['KTx','RenalBiopsy'],
+    sel_domain = "px",
+    cdtype_map = './ref/cdtype-map.json'
+)
+vs_kd_dx = QueryFromJson(
+    url = './ref/vs-cde-kd.json',
+    sqlty = 'snow',
+    cd_field = 'DX',
+    cdtype_field = 'DX_TYPE',
+    date_fields = ["DX_DATE",'ADMIT_DATE'],
+    srctbl_name = "GROUSE_DEID_DB.PCORNET_CDM_{site}.V_DEID_DIAGNOSIS",
+    other_fields=["PATID","ENCOUNTERID","ENC_TYPE"],
+    sel_keys = ['MI','AR','T2DM'],
+    sel_domain = "dx",
+    cdtype_map = './ref/cdtype-map.json'
+)
+vs_kd_rx = QueryFromJson(
+    url = './ref/vs-cde-kd.json',
+    sqlty = 'snow',
+    cd_field = 'RXNORM_CUI',
+    date_fields = ["RX_START_DATE",'RX_ORDER_DATE'],
+    srctbl_name = "GROUSE_DEID_DB.PCORNET_CDM_{site}.V_DEID_PRESCRIBING",
+    other_fields=["PATID","ENCOUNTERID"],
+    sel_keys = ['AntiRejectionRx'],
+    sel_domain = "rx",
+    cdtype_map = './ref/cdtype-map.json'
+)
+
+def get_vs_kd(sqlty = "snow", sample_pct = None):
+    # same valuesets compiled for another dialect, e.g. "duckdb" for the local backend,
+    # or scanning only a patient sample (see sample_utils)
+    vs_kd = {"px": vs_kd_px, "dx": vs_kd_dx, "rx": vs_kd_rx}
+    if sqlty != "snow" or sample_pct is not None:
+        for domain, vs in vs_kd.items():
+            vs_kd[domain] = copy.copy(vs)
+            vs_kd[domain].sqlty = sqlty
+            vs_kd[domain].sample_pct = sample_pct
+    return vs_kd
+
+def gen_domain_qry(vs, site, qry_mode = "union"):
+    # union: one select per valueset key; case/fanout: one scan of the site table for all keys, case keeps
+    # a row once under the first matching key (fewer rows than union when the selected valuesets overlap);
+    # join: equi-join against the uploaded code reference table
+    srctbl_name = vs.srctbl_name.format(site = site)
+    if qry_mode == "union":
+        return vs.gen_qry(srctbl_name = srctbl_name)
+    if qry_mode == "join":
+        return vs.gen_qry_join(code_ref_tbl, srctbl_name = srctbl_name)
+    return vs.gen_qry_scan(srctbl_name = srctbl_name, fanout = (qry_mode == "fanout"))
+
+def gen_site_tasks(sites, qry_mode = "union", sqlty = "snow", compact = False, sample_pct = None):
+    # one slice per site and domain: clear the slice, then insert it again. the pair is safe
+    # to rerun as a whole, so a slice can be retried or rebuilt on its own without
+    # duplicating rows and sites can run side by side.
+    # compact: whitespace-free statements with the site table, site and code lists bound as
+    # parameters, so every site sends the same statement text (see sql_compact_utils)
+    # sample_pct: only a stable hash-based percent of patients, see sample_utils
+    tasks = []
+    vs_kd = get_vs_kd(sqlty, sample_pct)
+    for s in sites:
+        for domain, vs, log_tbl, cols in [
+            #--- collect dx, px
+            ("px", vs_kd["px"], log_tbl_dxpx, "PATID,ENCOUNTERID,ENC_TYPE,CD,CD_TYPE,CD_DATE,PHE_TYPE,SITE"),
+            ("dx", vs_kd["dx"], log_tbl_dxpx, "PATID,ENCOUNTERID,ENC_TYPE,CD,CD_TYPE,CD_DATE,PHE_TYPE,SITE"),
+            #--- collect rx
+            ("rx", vs_kd["rx"], log_tbl_rx, "PATID,ENCOUNTERID,CD,CD_TYPE,CD_DATE,PHE_TYPE,SITE")
+        ]:
+            delete_sql = f"""
+            DELETE FROM {log_tbl} WHERE SITE = '{s}' AND PHE_TYPE IN ({','.join(vs.add_quote(vs.sel_keys))})
+            """
+            insert_sql = f"""
+            INSERT INTO {log_tbl} ({cols})
+                SELECT q.*,'{s}' AS SITE FROM ({gen_domain_qry(vs, s, qry_mode)}) q
+            """
+            stmts = [delete_sql, insert_sql]
+            if compact:
+                stmts = [
+                    bind_sql(compact_sql(x), sqlty, srctbl_name = vs.srctbl_name.format(site = s), binds = [s])
+                    for x in stmts
+                ]
+            tasks.append({
+                "site": s,
+                "slice": domain,
+                "sql": stmts,
+                "srctbl_name": vs.srctbl_name.format(site = s),
+                "vs_hash": vs.gen_vs_hash(),
+                "src_version": None
+            })
+    return tasks
+
+def get_src_version(session, srctbl_name, _depth = 0):
+    # content version of a source table: last DDL/DML time and row count of a base table. the CDM
+    # sources are views, whose LAST_ALTERED moves only when the view is redefined, so a view is
+    # versioned by the base tables its definition reads; when the definition is hidden (secure
+    # views of a share) by its row count. None when the table does not exist
+    if hasattr(session, "get_src_version"):
+        # DuckSession, also behind a TrackedSession
+        return session.get_src_version(srctbl_name)
+    db, schema, tbl = [x.strip('"').upper() for x in srctbl_name.split('.')]
+    rows = session.sql(f"""
+        SELECT t.TABLE_TYPE, t.LAST_ALTERED, t.ROW_COUNT, v.VIEW_DEFINITION
+        FROM {db}.INFORMATION_SCHEMA.TABLES t
+        LEFT JOIN {db}.INFORMATION_SCHEMA.VIEWS v
+          ON v.TABLE_SCHEMA = t.TABLE_SCHEMA AND v.TABLE_NAME = t.TABLE_NAME
+        WHERE t.TABLE_SCHEMA = '{schema}' AND t.TABLE_NAME = '{tbl}'
+    """).collect()
+    if len(rows) == 0:
+        return None
+    tbl_type, last_altered, row_cnt, view_def = rows[0]
+    if tbl_type != "VIEW":
+        return f"{last_altered}/{row_cnt}"
+    refs = sorted(set(
+        m.upper().replace('"', '') for m in re.findall(r"\b(?:from|join)\s+((?:\"?\w+\"?\.){2}\"?\w+\"?)", view_def or "", re.IGNORECASE)
+    )) if _depth < 3 else []
+    if refs:
+        versions = [get_src_version(session, r, _depth + 1) for r in refs]
+        if all(v is not None for v in versions):
+            return f"{last_altered};" + ";".join(f"{r}={v}" for r, v in zip(refs, versions))
+    cnt = session.sql(f"SELECT count(*) FROM {srctbl_name}").collect()[0][0]
+    return f"{last_altered};count={cnt}"
+
+def get_existing_tables(
+    session, #snowpark session or DuckSession
+    srctbl_names #fully qualified source tables, db.schema.table
+):
+    # the subset of srctbl_names that exists, by one INFORMATION_SCHEMA.TABLES lookup per database
+    # instead of versioning each table (see get_src_version)
+    if hasattr(session, "src_files"):
+        # DuckSession, also behind a TrackedSession
+        return {t for t in srctbl_names if t.upper() in session.src_files}
+    by_db = {}
+    for t in srctbl_names:
+        db, schema, tbl = [x.strip('"').upper() for x in t.split('.')]
+        by_db.setdefault(db, {}).setdefault((schema, tbl), []).append(t)
+    found = set()
+    for db, names in by_db.items():
+        schemas = ','.join(sorted({f"'{k[0]}'" for k in names}))
+        tbls = ','.join(sorted({f"'{k[1]}'" for k in names}))
+        rows = session.sql(f"""
+            SELECT TABLE_SCHEMA, TABLE_NAME FROM {db}.INFORMATION_SCHEMA.TABLES
+            WHERE TABLE_SCHEMA IN ({schemas}) AND TABLE_NAME IN ({tbls})
+        """).collect()
+        for r in rows:
+            found.update(names.get((r[0], r[1]), []))
+    return found
+
+def create_long_shells(session, overwrite = False):
+    ##--- create long table shells, kept as they are unless overwrite
+    create_stmt = "CREATE OR REPLACE TABLE" if overwrite else "CREATE TABLE IF NOT EXISTS"
+    session.sql(f"""
+        {create_stmt} {log_tbl_dxpx} (
+            PATID varchar, ENCOUNTERID varchar, ENC_TYPE varchar, CD varchar, CD_TYPE varchar,
+            CD_DATE date, PHE_TYPE varchar, SITE varchar
         )
-        ktx_qry_dxpx = ' UNION ALL'.join([
-            vs_kd_px.gen_qry(),
-            vs_kd_dx.gen_qry()
-        ])
-        insert_tmp_sql = f"""
-        INSERT INTO TMP_{log_tbl_dxpx} (PATID,ENCOUNTERID,ENC_TYPE,CD,CD_TYPE,CD_DATE,PHE_TYPE)
-            {ktx_qry_dxpx}
-        """
-        insert_sql = f"""
-        INSERT INTO {log_tbl_dxpx} (PATID,ENCOUNTERID,ENC_TYPE,CD,CD_TYPE,CD_DATE,PHE_TYPE,SITE)
-            SELECT PATID,ENCOUNTERID,ENC_TYPE,CD,CD_TYPE,CD_DATE,PHE_TYPE,'{s}' AS SITE FROM TMP_{log_tbl_dxpx}
-        """
-        empty_df1.drop("SITE").write.mode("overwrite").save_as_table(f"TMP_{log_tbl_dxpx}",table_type="temporary")
-        session.sql(insert_tmp_sql).collect()
-        session.sql(insert_sql).collect()
-
-        #--- collect rx
-        vs_kd_rx = QueryFromJson(
-            url = './ref/vs-cde-kd.json',
-            sqlty = 'snow',
-            cd_field = 'RXNORM_CUI',
-            date_fields = ["RX_START_DATE",'RX_ORDER_DATE'],
-            srctbl_name = f"GROUSE_DEID_DB.PCORNET_CDM_{s}.V_DEID_PRESCRIBING",
-            other_fields=["PATID","ENCOUNTERID"],
-            sel_keys = ['AntiRejectionRx'],
-            sel_domain = "rx"
+    """).collect()
+    session.sql(f"""
+        {create_stmt} {log_tbl_rx} (
+            PATID varchar, ENCOUNTERID varchar, CD varchar, CD_TYPE varchar,
+            CD_DATE date, PHE_TYPE varchar, SITE varchar
         )
-        empty_df2.drop("SITE").write.mode("overwrite").save_as_table(f"TMP_{log_tbl_rx}",table_type="temporary")
-        insert_tmp_sql = f"""
-        INSERT INTO TMP_{log_tbl_rx} (PATID,ENCOUNTERID,CD,CD_TYPE,CD_DATE,PHE_TYPE)
-            {vs_kd_rx.gen_qry()}
-        """
-        insert_sql = f"""
-        INSERT INTO {log_tbl_rx} (PATID,ENCOUNTERID,CD,CD_TYPE,CD_DATE,PHE_TYPE,SITE)
-            SELECT PATID,ENCOUNTERID,CD,CD_TYPE,CD_DATE,PHE_TYPE,'{s}' AS SITE FROM TMP_{log_tbl_rx} 
-        """
-        session.sql(insert_tmp_sql).collect()
-        session.sql(insert_sql).collect()
+    """).collect()
+
+def upload_code_ref(session):
+    ##--- expanded valueset as a small reference table, uploaded once per run for --qry-mode join
+    code_ref = gen_code_ref('./ref/vs-cde-kd.json', './ref/cdtype-map.json')
+    session.write_pandas(code_ref, code_ref_tbl, auto_create_table = True, overwrite = True, table_type = "temporary")
+
+def run_event_log(
+    session, #shared session, see connect_session
+    sites, #sites to (re)load
+    ledger, #LocalLedger or SnowLedger, slices whose valueset and source table are unchanged are skipped
+    qry_mode = "union", #see gen_domain_qry
+    sqlty = "snow", #"duckdb" for the local backend
+    compact = False, #see gen_site_tasks
+    full_refresh = False, #rebuild the long tables and ledger from scratch
+    max_workers = 1, #site slices running at the same time
+    retries = 2, #extra attempts for a failed site slice
+    sample_pct = None, #see gen_site_tasks
+    src_versions = None #{srctbl_name: version} the caller already looked up, e.g. the pipeline's stage inputs; the rest are looked up here
+):
+    create_long_shells(session, overwrite = full_refresh)
+    if qry_mode == "join":
+        upload_code_ref(session)
+
+    ##--- skip slices whose valueset and source table are unchanged since they were loaded
+    if full_refresh:
+        ledger.reset()
+    tasks = gen_site_tasks(sites, qry_mode = qry_mode, sqlty = sqlty, compact = compact, sample_pct = sample_pct)
+    print("generated sql: " + ", ".join(f"{k}={v}" for k, v in sql_size_report([x for t in tasks for x in t["sql"]]).items()))
+    # once per source table, slices of the same table share its version
+    src_versions = dict(src_versions or {})
+    for task in tasks:
+        if task["srctbl_name"] not in src_versions:
+            src_versions[task["srctbl_name"]] = get_src_version(session, task["srctbl_name"])
+        task["src_version"] = src_versions[task["srctbl_name"]]
+    tasks, skipped = filter_fresh_tasks(tasks, ledger)
+    print(f"{len(skipped)} slice(s) up to date, {len(tasks)} slice(s) to (re)build")
 
+    ##--- event logging (logitudinal stacking), sites fanned out over a thread pool
+    start = time.perf_counter()
+    results = run_site_tasks(
+        session,
+        tasks,
+        max_workers = max_workers,
+        retries = retries,
+        on_done = lambda t: ledger.mark_done(t["site"], t["slice"], t["vs_hash"], t["src_version"])
+    )
+    wall_time = time.perf_counter() - start
+    print_site_report(results, wall_time = wall_time)
+    print_projection(sample_pct, wall_time)
 
+    failed = [f"{r['site']}-{r['slice']}" for r in results if r["status"] != "done"]
+    if failed:
+        raise RuntimeError(f"event logging failed for: {', '.join(failed)}; rerun to resume")
+    return results
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "stack dx/px/rx events of all sites into long tables")
+    parser.add_argument("--max-workers", type = int, default = 1, help = "number of site slices running at the same time")
+    parser.add_argument("--retries", type = int, default = 2, help = "extra attempts for a failed site slice")
+    parser.add_argument(
+        "--qry-mode", choices = ["union","case","fanout","join"], default = "union",
+        help = "union: one scan per valueset key; case: one scan per table, a row matching several keys is kept once under the first, so only for non-overlapping valuesets; fanout: one scan per table, one row per matching key; join: equi-join against an uploaded code reference table"
+    )
+    parser.add_argument("--full-refresh", action = "store_true", help = "rebuild the long tables and ledger from scratch")
+    parser.add_argument("--ledger-file", default = None, help = "keep the checkpoint ledger in a local json file instead of snowflake")
+    parser.add_argument("--sites", nargs = "*", default = site_lst, help = "subset of sites to run")
+    parser.add_argument("--backend", choices = ["snow","duckdb"], default = "snow", help = "snow: GROUSE warehouse; duckdb: local parquet extracts under --cdm-root")
+    parser.add_argument("--cdm-root", default = None, help = "root folder of the local parquet extracts, <cdm-root>/<SITE>/<TABLE>.parquet")
+    parser.add_argument("--duckdb-file", default = "cistem2_local.duckdb", help = "local database the long tables are written to")
+    parser.add_argument("--compact-sql", action = "store_true", help = "send compact statements with the site table and code lists bound as parameters, identical text for every site")
+    parser.add_argument("--run-log-file", default = "run_log.jsonl", help = "local json lines file every statement of the run is appended to, next to the KTX_RUN_LOG table")
+    parser.add_argument("--sample-pct", type = float, default = None, help = "keep a stable hash-based percent of patients, e.g. 1, written to the schema SX_CISTEM2_S<pct>")
+    args = parser.parse_args()
 
+    # data pull - snowflake, or the local parquet extracts with --backend duckdb
+    with connect_session(args.backend, duckdb_file = args.duckdb_file, cdm_root = args.cdm_root) as raw_session, \
+         TrackedSession(raw_session, jsonl_file = args.run_log_file, step = "event_log") as session:
+        use_sample_schema(session, "SX_CISTEM2", args.sample_pct)
+        if args.backend == "duckdb":
+            # only the sites with a local extract
+            args.sites = [s for s in args.sites if s in session.sites]
 
-   
-        
\ No newline at end of file
+        if args.ledger_file:
+            ledger = LocalLedger(args.ledger_file)
+        elif args.backend == "duckdb":
+            ledger = LocalLedger(sample_schema(os.path.splitext(args.duckdb_file)[0], args.sample_pct) + "_ledger.json")
+        else:
+            ledger = SnowLedger(session)
+        try:
+            run_event_log(
+                session, args.sites, ledger,
+                qry_mode = args.qry_mode,
+                sqlty = "duckdb" if args.backend == "duckdb" else "snow",
+                compact = args.compact_sql,
+                full_refresh = args.full_refresh,
+                max_workers = args.max_workers,
+                retries = args.retries,
+                sample_pct = args.sample_pct
+            )
+        finally:
+            session.flush()
+            print_run_report(session.records)
@@ -0,0 +1,30 @@
+import argparse
+from utils import connect_session, TrackedSession, print_run_report, export_table, EXPORT_PART_COLS, use_sample_schema
+
+# streaming parquet export of the derived tables, the bounded-memory replacement for pulling
+# KTX_TBL1 into one RDS in src/R/extract.R; the long tables are written one site at a time:
+#   <out-dir>/<TABLE>/<PART_COL>=<value>/part-0.parquet
+# rerunning after an interruption skips the partitions already listed as done in _manifest.json.
+# read back with pyarrow.dataset / arrow::open_dataset
+# run from the repo root, like the other scripts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "stream derived tables into partitioned parquet files")
+    parser.add_argument("--tables", nargs = "*", default = list(EXPORT_PART_COLS), help = "tables to export")
+    parser.add_argument("--out-dir", default = "./data", help = "export root, one folder per table")
+    parser.add_argument("--backend", choices = ["snow","duckdb"], default = "snow", help = "snow: GROUSE warehouse; duckdb: local database written by event_log.py --backend duckdb")
+    parser.add_argument("--duckdb-file", default = "cistem2_local.duckdb", help = "local database holding the derived tables")
+    parser.add_argument("--overwrite", action = "store_true", help = "export every partition again instead of resuming")
+    parser.add_argument("--run-log-file", default = "run_log.jsonl", help = "local json lines file every statement of the run is appended to, next to the KTX_RUN_LOG table")
+    parser.add_argument("--sample-pct", type = float, default = None, help = "read and write the sampled schema SX_CISTEM2_S<pct>, see event_log.py")
+    args = parser.parse_args()
+
+    with connect_session(args.backend, duckdb_file = args.duckdb_file) as raw_session, \
+         TrackedSession(raw_session, jsonl_file = args.run_log_file, step = "export") as session:
+        use_sample_schema(session, "SX_CISTEM2", args.sample_pct)
+        for tbl in args.tables:
+            with session.tag(slice = tbl):
+                manifest = export_table(session, tbl, args.out_dir, overwrite = args.overwrite)
+            print(f"{tbl}: {manifest['rows']} row(s) in {len(manifest['partitions'])} partition(s)")
+        session.flush()
+        print_run_report(session.records)
@@ -0,0 +1,35 @@
+import argparse
+from utils import connect_session, load_outcome_spec, gen_outcome_sql, TrackedSession, print_run_report, use_sample_schema
+
+# all outcome variants of an outcome spec in one job, written as one wide table named after the spec
+# (KTX_OUTCOMES for ./ref/outcome-spec-kd.json). sensitivity analyses are new entries in the spec,
+# not edits to ktx_tbl1.py. joins to PAT_TABLE1/KTX_TBL1 on PATID for demographics
+
+def build_outcomes(session, spec):
+    spec = load_outcome_spec(spec)
+    session.sql(f"CREATE OR REPLACE TABLE {spec['name']} AS {gen_outcome_sql(spec)}").collect()
+    return spec
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "evaluate the outcome variants of an outcome spec against the long event tables")
+    parser.add_argument("--spec", default = "./ref/outcome-spec-kd.json", help = "outcome spec json")
+    parser.add_argument("--backend", choices = ["snow","duckdb"], default = "snow", help = "snow: GROUSE warehouse; duckdb: local database written by event_log.py --backend duckdb")
+    parser.add_argument("--duckdb-file", default = "cistem2_local.duckdb", help = "local database holding the long tables")
+    parser.add_argument("--dry-run", action = "store_true", help = "print the compiled query instead of running it")
+    parser.add_argument("--run-log-file", default = "run_log.jsonl", help = "local json lines file every statement of the run is appended to, next to the KTX_RUN_LOG table")
+    parser.add_argument("--sample-pct", type = float, default = None, help = "read and write the sampled schema SX_CISTEM2_S<pct>, see event_log.py")
+    args = parser.parse_args()
+
+    spec = load_outcome_spec(args.spec)
+    qry = gen_outcome_sql(spec)
+    if args.dry_run:
+        print(qry)
+    else:
+        with connect_session(args.backend, duckdb_file = args.duckdb_file) as raw_session, \
+             TrackedSession(raw_session, jsonl_file = args.run_log_file, step = "ktx_outcomes") as session:
+            use_sample_schema(session, "SX_CISTEM2", args.sample_pct)
+            with session.tag(slice = spec["name"]):
+                build_outcomes(session, spec)
+            print(f"{spec['name']}: {len(spec['outcomes'])} outcome variant(s) written")
+            session.flush()
+            print_run_report(session.records)
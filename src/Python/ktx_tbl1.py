@@ -1,34 +1,20 @@
-import os
-import json
-from utils import QueryFromJson
-from snowflake.snowpark import Session
-from snowflake.snowpark.types import StructType, StructField, StringType, IntegerType, DateType, BooleanType, VariantType
-from snowflake.snowpark.functions import (
-    col, coalesce, lit, lag, to_date, when, datediff, sum as s_sum, max as s_max, min as s_min, row_number,
-    abs as s_abs, iff, least, call_function
+import argparse
+from contextlib import nullcontext
+from utils import (
+    connect_session, create_pat_table1, gen_ktx_tbl1_sql, gen_ktx_idx_sql, first_in_window, TrackedSession, print_run_report,
+    ResultCache, use_sample_schema, gen_sample_predicate
 )
-from snowflake.snowpark.window import Window
-
-# data pull - connect to snowflake
-path_to_config = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) + '\.config.json'
-with open(path_to_config,"r") as f:
-    config = json.load(f)
-    connect_params = {
-        "account": config["snowflake-deid-api"]["acct"],
-        "user": config["snowflake-deid-api"]["user"],
-        "password":config["snowflake-deid-api"]["pwd"],
-        "role": config["snowflake-deid-api"]["role"],
-        "warehouse": config["snowflake-deid-api"]["wh"]
-    }
-
-with Session.builder.configs(connect_params).create() as session:
-    # test connection
-    # print(session.sql("SELECT CURRENT_USER(), CURRENT_ROLE(), CURRENT_DATABASE()").collect())
-
-    # set up session
-    session.use_database(config["snowflake-deid-api"]["db"])
-    session.use_schema("SX_CISTEM2")
+try:
+    from snowflake.snowpark.functions import (
+        col, coalesce, lit, lag, to_date, when, datediff, sum as s_sum, max as s_max, min as s_min, row_number,
+        abs as s_abs, iff, least, call_function
+    )
+    from snowflake.snowpark.window import Window
+except ImportError:
+    # the local duckdb backend runs the sql derivation and does not need snowpark
+    pass
 
+def derive_ktx_tbl1(session, cache = None):
     ##--- create table references
     log_tbl_dxpx = session.table("KTX_DXPX_LONG")
     log_tbl_rx = session.table("KTX_RX_LONG")
@@ -47,7 +33,10 @@ with Session.builder.configs(connect_params).create() as session:
             .with_column_renamed("CD_DATE", "KTX_DATE1")
             .select("PATID", "KTX_DATE1", "SITE")
     )
-    # ktx_idx.write.mode("overwrite").save_as_table("KTX_IDX")
+    # read by nodat, mi_ae, biopsy_idx and the final joins: kept in a cached table rather than
+    # re-inlined (window and all) into each of them
+    if cache is not None:
+        ktx_idx = cache.materialize("KTX_IDX", ktx_idx, inputs = ["KTX_DXPX_LONG"])
 
     ##--- identify NODAT
     dm_idx = (
@@ -95,37 +84,30 @@ with Session.builder.configs(connect_params).create() as session:
     # mi_ae.write.mode("overwrite").save_as_table("MI_AE")
 
     ##--- identify AR
+    # first biopsy within 180 days of the ktx and first rx within 7 days of the biopsy are as-of
+    # matches over each patient's sorted events instead of joins on PATID alone, see band_join_utils
     biopsy_idx = (
-        ktx_idx.join(
-            log_tbl_dxpx,
-            (ktx_idx["PATID"]==log_tbl_dxpx["PATID"]) &
-            (log_tbl_dxpx["PHE_TYPE"]).isin(['RenalBiopsy']) &
-            (log_tbl_dxpx["CD_DATE"] >= to_date(lit("2014-01-01"))) &
-            (log_tbl_dxpx["CD_DATE"] <= to_date(lit("2023-12-31"))) &
-            (datediff("day",ktx_idx["KTX_DATE1"],log_tbl_dxpx["CD_DATE"]).between (0,180)),
-            join_type = "inner"
+        first_in_window(
+            ktx_idx,
+            log_tbl_dxpx.filter(col('PHE_TYPE').isin(['RenalBiopsy']))
+                .filter(
+                    (col('CD_DATE') >= to_date(lit('2014-01-01'))) &
+                    (col('CD_DATE') <= to_date(lit('2023-12-31')))
+                ),
+            "PATID", "KTX_DATE1", "CD_DATE", 0, 180, "RBX_DATE1", inner = True
         )
-        .group_by(ktx_idx["PATID"],ktx_idx["KTX_DATE1"])
-        .agg(s_min(log_tbl_dxpx["CD_DATE"]).alias("CD_DATE"))
         .select(
-            ktx_idx["PATID"].alias("PATID"),
-            log_tbl_dxpx["CD_DATE"].alias("RBX_DATE1"),
-            datediff("day", ktx_idx["KTX_DATE1"], log_tbl_dxpx["CD_DATE"]).alias("DAYS_TO_RBX")
+            col("PATID"),
+            col("RBX_DATE1"),
+            datediff("day", col("KTX_DATE1"), col("RBX_DATE1")).alias("DAYS_TO_RBX")
         )
     )
     ar_ae = (
-        biopsy_idx.join(
-            log_tbl_rx,
-            (biopsy_idx["PATID"] == log_tbl_rx["PATID"]) & 
-            (datediff("day",biopsy_idx["RBX_DATE1"],log_tbl_rx["CD_DATE"]).between(0,7)),
-            "inner"
-        )
-        .group_by(biopsy_idx["PATID"],biopsy_idx["RBX_DATE1"],biopsy_idx["DAYS_TO_RBX"])
-        .agg(s_min(log_tbl_rx["CD_DATE"]).alias("ANTIREJ_DATE1"))
+        first_in_window(biopsy_idx, log_tbl_rx, "PATID", "RBX_DATE1", "CD_DATE", 0, 7, "ANTIREJ_DATE1", inner = True)
         .select(
-            biopsy_idx["PATID"].alias("PATID"),
-            biopsy_idx["RBX_DATE1"].alias("RBX_DATE1"),
-            biopsy_idx["DAYS_TO_RBX"].alias("DAYS_TO_RBX"),
+            col("PATID"),
+            col("RBX_DATE1"),
+            col("DAYS_TO_RBX"),
             col("ANTIREJ_DATE1")
         )
     )
@@ -209,4 +191,136 @@ with Session.builder.configs(connect_params).create() as session:
                 p["INDEX_SRC"].alias("SRC_SITE")
             )
     )
-    final.write.mode("overwrite").save_as_table("KTX_TBL1")
\ No newline at end of file
+    return final
+
+def derive_ktx_tbl1_single_pass(session, study_start = '2014-01-01', study_end = '2023-12-31'):
+    # same output as derive_ktx_tbl1, but ktx index, first T2DM, first post-ktx MI and first biopsy
+    # within 180 days come from one scan of KTX_DXPX_LONG: the ktx date is spread over each patient's
+    # rows with a window min, then every first event is a conditional min per patient
+    log_tbl_dxpx = session.table("KTX_DXPX_LONG")
+    log_tbl_rx = session.table("KTX_RX_LONG")
+    p = session.table("PAT_TABLE1")
+
+    is_ktx = (col("PHE_TYPE") == lit("KTx")) & col("ENC_TYPE").isin(["EI","IP"])
+    w = Window.partition_by(col("PATID"))
+    ev = (
+        log_tbl_dxpx.filter(col("PHE_TYPE").isin(["KTx","T2DM","MI","RenalBiopsy"]))
+            .filter(
+                (col("CD_DATE") >= to_date(lit(study_start))) &
+                (col("CD_DATE") <= to_date(lit(study_end)))
+            )
+            .with_column("KTX_DATE1", s_min(when(is_ktx, col("CD_DATE"))).over(w))
+            .filter(col("KTX_DATE1").is_not_null())
+    )
+    pat_ev = (
+        ev.group_by(col("PATID"))
+            .agg(
+                s_min(col("KTX_DATE1")).alias("KTX_DATE1"),
+                call_function("min_by", col("SITE"), when(is_ktx, col("CD_DATE"))).alias("KTX_SITE"),
+                s_min(when(col("PHE_TYPE") == lit("T2DM"), col("CD_DATE"))).alias("DM_ANY_DATE1"),
+                s_min(when(
+                    (col("PHE_TYPE") == lit("MI")) & col("ENC_TYPE").isin(["EI","IP"]) & (col("CD_DATE") > col("KTX_DATE1")),
+                    col("CD_DATE")
+                )).alias("MI_DATE1"),
+                s_min(when(
+                    (col("PHE_TYPE") == lit("RenalBiopsy")) & datediff("day", col("KTX_DATE1"), col("CD_DATE")).between(0,180),
+                    col("CD_DATE")
+                )).alias("RBX_DATE1")
+            )
+            # NODAT only if the first T2DM code in the window comes after the transplant
+            .with_column("DM_DATE1", when(col("DM_ANY_DATE1") > col("KTX_DATE1"), col("DM_ANY_DATE1")))
+    )
+
+    ##--- anti-rejection rx still needs the rx table, matched only for patients with a biopsy
+    ar_ae = (
+        first_in_window(
+            pat_ev.filter(col("RBX_DATE1").is_not_null()).select("PATID", "RBX_DATE1"),
+            log_tbl_rx, "PATID", "RBX_DATE1", "CD_DATE", 0, 7, "ANTIREJ_DATE1", inner = True
+        )
+        .select("PATID", "ANTIREJ_DATE1")
+    )
+
+    final = (
+        pat_ev.join(ar_ae, "PATID", "left")
+            .with_column("AR_RBX_DATE1", when(col("ANTIREJ_DATE1").is_not_null(), col("RBX_DATE1")))
+            .join(p.select("PATID","SEX","RACE","HISPANIC","BIRTH_DATE","DEATH_IND","CENSOR_DATE","INDEX_SRC"), "PATID")
+            .select(
+                col("PATID"),
+                col("KTX_DATE1").alias("INDEX_DATE"),
+                col("KTX_SITE"),
+                col("DM_DATE1"),
+                datediff("day", col("KTX_DATE1"), col("DM_DATE1")).alias("DAYS_TO_NODAT"),
+                when(col("DM_DATE1").is_not_null(), 1).otherwise(0).alias("NODAT_IND"),
+                col("MI_DATE1"),
+                datediff("day", col("KTX_DATE1"), col("MI_DATE1")).alias("DAYS_TO_MI"),
+                when(col("MI_DATE1").is_not_null(), 1).otherwise(0).alias("MI_IND"),
+                col("AR_RBX_DATE1").alias("RBX_DATE1"),
+                datediff("day", col("KTX_DATE1"), col("AR_RBX_DATE1")).alias("DAYS_TO_RBX"),
+                col("ANTIREJ_DATE1"),
+                datediff("day", col("AR_RBX_DATE1"), col("ANTIREJ_DATE1")).alias("DAYS_RBX_TO_ANTIREJ"),
+                when(col("AR_RBX_DATE1").is_not_null(), 1).otherwise(0).alias("AR_IND"),
+                col("SEX"),
+                col("RACE"),
+                col("HISPANIC"),
+                datediff("year", col("BIRTH_DATE"), col("KTX_DATE1")).alias("AGE_AT_KTX"),
+                col("DEATH_IND"),
+                col("CENSOR_DATE"),
+                datediff("day", col("KTX_DATE1"), col("CENSOR_DATE")).alias("DAYS_TO_CENSOR"),
+                col("INDEX_SRC").alias("SRC_SITE")
+            )
+    )
+    return final
+
+def build_ktx_tbl1(session, backend = "snow", single_pass = False, tgt_tbl = "KTX_TBL1", with_pat_table1 = True, use_cache = True, sample_pct = None, src_schema = "SX_CISTEM2"):
+    # sample_pct: the patient sample of the long tables (see event_log.py), PAT_TABLE1 is drawn the same way
+    # src_schema: schema of the full run, the sampled PAT_TABLE1 is drawn from its PAT_TABLE1 on snowflake
+    ##--- shared intermediates are cached across runs, see utils/result_cache_utils.py; the single pass has none
+    cache = ResultCache(session) if use_cache and not single_pass else None
+    if backend == "snow":
+        ##--- src/SQL/pat_tbl1.sql builds the full PAT_TABLE1, the sampled schema gets the sample of it
+        if with_pat_table1 and sample_pct is not None:
+            found = session.sql(f"""
+                SELECT count(*) FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = '{src_schema}' AND TABLE_NAME = 'PAT_TABLE1'
+            """).collect()[0][0]
+            if found == 0:
+                raise RuntimeError(
+                    f"{src_schema}.PAT_TABLE1 not found: run src/SQL/pat_tbl1.sql in {src_schema} first, "
+                    "or run pipeline.py --sample-pct, which builds the sampled PAT_TABLE1 itself"
+                )
+            with session.tag(slice = "PAT_TABLE1") if hasattr(session, "tag") else nullcontext():
+                session.sql(f"CREATE OR REPLACE TABLE PAT_TABLE1 AS SELECT * FROM {src_schema}.PAT_TABLE1 WHERE {gen_sample_predicate(sample_pct)}").collect()
+        final = derive_ktx_tbl1_single_pass(session) if single_pass else derive_ktx_tbl1(session, cache = cache)
+        if hasattr(session, "save_as_table"):
+            session.save_as_table(final, tgt_tbl)
+        else:
+            final.write.mode("overwrite").save_as_table(tgt_tbl)
+    else:
+        ##--- PAT_TABLE1 is built by src/SQL/pat_tbl1.sql on snowflake, locally from the attached extracts
+        if with_pat_table1:
+            with session.tag(slice = "PAT_TABLE1") if hasattr(session, "tag") else nullcontext():
+                create_pat_table1(session, session.sites, sample_pct = sample_pct)
+        with session.tag(slice = tgt_tbl) if hasattr(session, "tag") else nullcontext():
+            ktx_idx_tbl = cache.materialize_sql("KTX_IDX", gen_ktx_idx_sql(), inputs = ["KTX_DXPX_LONG"]) if cache is not None else None
+            session.sql(f"CREATE OR REPLACE TABLE {tgt_tbl} AS {gen_ktx_tbl1_sql(single_pass = single_pass, ktx_idx_tbl = ktx_idx_tbl)}").collect()
+    if cache is not None:
+        print(f"result cache: {len(cache.hits)} hit(s) {cache.hits}, {len(cache.misses)} miss(es) {cache.misses}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "derive KTX_TBL1 from the long event tables")
+    parser.add_argument("--backend", choices = ["snow","duckdb"], default = "snow", help = "snow: GROUSE warehouse; duckdb: local database written by event_log.py --backend duckdb")
+    parser.add_argument("--cdm-root", default = None, help = "root folder of the local parquet extracts, <cdm-root>/<SITE>/<TABLE>.parquet")
+    parser.add_argument("--duckdb-file", default = "cistem2_local.duckdb", help = "local database holding the long tables")
+    parser.add_argument("--single-pass", action = "store_true", help = "derive all first events from one scan of the dx/px long table")
+    parser.add_argument("--no-cache", action = "store_true", help = "derive the shared intermediates inline instead of reusing cached tables")
+    parser.add_argument("--run-log-file", default = "run_log.jsonl", help = "local json lines file every statement of the run is appended to, next to the KTX_RUN_LOG table")
+    parser.add_argument("--sample-pct", type = float, default = None, help = "see event_log.py, use the same value as the run that built the long tables")
+    args = parser.parse_args()
+
+    with connect_session(args.backend, duckdb_file = args.duckdb_file, cdm_root = args.cdm_root) as raw_session, \
+         TrackedSession(raw_session, jsonl_file = args.run_log_file, step = "ktx_tbl1") as session:
+        # set up session
+        use_sample_schema(session, "SX_CISTEM2", args.sample_pct)
+
+        build_ktx_tbl1(session, args.backend, single_pass = args.single_pass, use_cache = not args.no_cache, sample_pct = args.sample_pct)
+        session.flush()
+        print_run_report(session.records)
\ No newline at end of file
@@ -0,0 +1,209 @@
+import copy
+import time
+import argparse
+from utils import (
+    QueryFromJson, run_site_tasks, print_site_report, connect_session, TrackedSession, print_run_report,
+    compact_sql, bind_sql, sql_size_report, gen_obs_idx_sql, use_sample_schema, print_projection
+)
+import event_log
+
+# study observations of the transplant cohort, stacked into ALL_OBS. replaces the get_obs_long
+# procedure in src/SQL/pat_obs.sql, which copied every lab, vital and obs_clin row of the cohort
+# site by site and trimmed to WT/HT/BMI afterwards: here the loinc valuesets (codes and plausible
+# value ranges, see ./ref/vs-cde-kd.json) are pushed into each site scan, and the site/source
+# slices run side by side
+
+obs_tbl = "ALL_OBS"
+obs_idx_tbl = "KTX_OBS_IDX"
+ref_cohort = "KTX_TBL1"
+obs_keys = ['SCr','Tacrolimus','WT','HT','BMI']
+
+##--- one QueryFromJson per source table, all matched on loinc
+vs_obs_lab = QueryFromJson(
+    url = './ref/vs-cde-kd.json',
+    sqlty = 'snow',
+    cd_field = 'LAB_LOINC',
+    date_fields = ["SPECIMEN_DATE","LAB_ORDER_DATE","RESULT_DATE"],
+    srctbl_name = "GROUSE_DEID_DB.PCORNET_CDM_{site}.V_DEID_LAB_RESULT_CM",
+    other_fields = ["PATID","RESULT_NUM","RESULT_UNIT","NORM_RANGE_LOW","NORM_RANGE_HIGH","RESULT_QUAL"],
+    sel_keys = ['SCr','Tacrolimus'],
+    sel_domain = "lab",
+    val_field = "RESULT_NUM",
+    cdtype_map = './ref/cdtype-map.json'
+)
+vs_obs_clin = QueryFromJson(
+    url = './ref/vs-cde-kd.json',
+    sqlty = 'snow',
+    cd_field = 'OBSCLIN_CODE',
+    cdtype_field = 'OBSCLIN_TYPE',
+    date_fields = ["OBSCLIN_START_DATE","OBSCLIN_STOP_DATE"],
+    srctbl_name = "GROUSE_DEID_DB.PCORNET_CDM_{site}.V_DEID_OBS_CLIN",
+    other_fields = ["PATID","OBSCLIN_RESULT_NUM","OBSCLIN_RESULT_UNIT","OBSCLIN_RESULT_QUAL"],
+    sel_keys = obs_keys,
+    sel_domain = "lab",
+    # no value range here: the body measure ranges are in vital units, obs_clin reports mixed units
+    cdtype_map = './ref/cdtype-map.json'
+)
+# vital columns carry no code, each measure is given its loinc in a single pass over the table
+vs_obs_vital = QueryFromJson(
+    url = './ref/vs-cde-kd.json',
+    sqlty = 'snow',
+    cd_field = 'OBS_CODE',
+    date_fields = ["MEASURE_DATE"],
+    srctbl_name = """(
+        select v.PATID, v.MEASURE_DATE, m.OBS_CODE, m.OBS_UNIT,
+               case m.OBS_CODE when '29463-7' then v.WT when '8302-2' then v.HT else v.ORIGINAL_BMI end as OBS_NUM
+        from GROUSE_DEID_DB.PCORNET_CDM_{site}.V_DEID_VITAL v
+        cross join (values ('29463-7','lb_av'),('8302-2','in_us'),('39156-5','kg/m2')) m(OBS_CODE,OBS_UNIT)
+    )""",
+    other_fields = ["PATID","OBS_NUM","OBS_UNIT"],
+    sel_keys = ['WT','HT','BMI'],
+    sel_domain = "lab",
+    val_field = "OBS_NUM",
+    cdtype_map = './ref/cdtype-map.json'
+)
+
+# source: (valueset, base table, ALL_OBS columns as expressions over the scan output q)
+OBS_SRC = {
+    "lab": (vs_obs_lab, "GROUSE_DEID_DB.PCORNET_CDM_{site}.V_DEID_LAB_RESULT_CM", {
+        "OBS_CODE": "q.LAB_LOINC", "OBS_NUM": "q.RESULT_NUM", "OBS_UNIT": "q.RESULT_UNIT",
+        "OBS_REF_LOW": "q.NORM_RANGE_LOW", "OBS_REF_HIGH": "q.NORM_RANGE_HIGH", "OBS_QUAL": "q.RESULT_QUAL"
+    }),
+    "obsclin": (vs_obs_clin, "GROUSE_DEID_DB.PCORNET_CDM_{site}.V_DEID_OBS_CLIN", {
+        "OBS_CODE": "q.OBSCLIN_CODE", "OBS_NUM": "q.OBSCLIN_RESULT_NUM", "OBS_UNIT": "q.OBSCLIN_RESULT_UNIT",
+        "OBS_REF_LOW": "NULL", "OBS_REF_HIGH": "NULL", "OBS_QUAL": "q.OBSCLIN_RESULT_QUAL"
+    }),
+    "vital": (vs_obs_vital, "GROUSE_DEID_DB.PCORNET_CDM_{site}.V_DEID_VITAL", {
+        "OBS_CODE": "q.OBS_CODE", "OBS_NUM": "q.OBS_NUM", "OBS_UNIT": "q.OBS_UNIT",
+        "OBS_REF_LOW": "NULL", "OBS_REF_HIGH": "NULL", "OBS_QUAL": "NULL"
+    })
+}
+
+def get_vs_obs(sqlty = "snow", sample_pct = None):
+    # same valuesets compiled for another dialect, e.g. "duckdb" for the local backend,
+    # or scanning only a patient sample (see sample_utils)
+    vs_obs = {src: vs for src, (vs, _, _) in OBS_SRC.items()}
+    if sqlty != "snow" or sample_pct is not None:
+        for src, vs in vs_obs.items():
+            vs_obs[src] = copy.copy(vs)
+            vs_obs[src].sqlty = sqlty
+            vs_obs[src].sample_pct = sample_pct
+    return vs_obs
+
+def gen_obs_tasks(sites, sqlty = "snow", compact = False, sample_pct = None):
+    # one slice per site and source table, cleared and inserted again as a pair like event_log.gen_site_tasks;
+    # one scan of the source per slice, all selected loinc valuesets matched in a single case (they share
+    # no code, so no row is lost to the first-match rule of gen_qry_scan without fanout).
+    # sample_pct: the cohort is sampled already, the same filter in the scan only saves the join
+    tasks = []
+    vs_obs = get_vs_obs(sqlty, sample_pct)
+    for s in sites:
+        for src, (_, base_tbl, cols) in OBS_SRC.items():
+            vs = vs_obs[src]
+            delete_sql = f"""
+            DELETE FROM {obs_tbl} WHERE OBS_SRC = '{s}' AND OBS_TYPE = '{src}'
+            """
+            insert_sql = f"""
+            INSERT INTO {obs_tbl} (PATID,OBS_DATE,DAYS_SINCE_INDEX,OBS_CODE_TYPE,OBS_CODE,OBS_NAME,OBS_NUM,OBS_UNIT,OBS_REF_LOW,OBS_REF_HIGH,OBS_QUAL,OBS_TYPE,OBS_SRC)
+                SELECT DISTINCT
+                    q.PATID, q.CD_DATE, datediff('day', c.INDEX_DATE, q.CD_DATE), 'LC', {cols['OBS_CODE']}, q.CD_GRP,
+                    {cols['OBS_NUM']}, {cols['OBS_UNIT']}, {cols['OBS_REF_LOW']}, {cols['OBS_REF_HIGH']}, {cols['OBS_QUAL']},
+                    '{src}', '{s}'
+                FROM ({vs.gen_qry_scan(srctbl_name = vs.srctbl_name.format(site = s))}) q
+                JOIN {ref_cohort} c ON c.PATID = q.PATID
+            """
+            stmts = [delete_sql, insert_sql]
+            if compact:
+                stmts = [
+                    bind_sql(compact_sql(x), sqlty, srctbl_name = base_tbl.format(site = s), binds = [s])
+                    for x in stmts
+                ]
+            tasks.append({
+                "site": s,
+                "slice": src,
+                "sql": stmts,
+                "srctbl_name": base_tbl.format(site = s),
+                "vs_hash": vs.gen_vs_hash()
+            })
+    return tasks
+
+def create_obs_shell(session, overwrite = False):
+    create_stmt = "CREATE OR REPLACE TABLE" if overwrite else "CREATE TABLE IF NOT EXISTS"
+    session.sql(f"""
+        {create_stmt} {obs_tbl} (
+            PATID varchar NOT NULL, OBS_DATE date, DAYS_SINCE_INDEX integer, OBS_CODE_TYPE varchar, OBS_CODE varchar,
+            OBS_NAME varchar, OBS_NUM double, OBS_UNIT varchar, OBS_REF_LOW varchar, OBS_REF_HIGH varchar,
+            OBS_QUAL varchar, OBS_TYPE varchar, OBS_SRC varchar
+        )
+    """).collect()
+
+def run_obs_extract(
+    session, #shared session, see connect_session
+    sites, #sites to (re)load
+    sqlty = "snow", #"duckdb" for the local backend
+    compact = False, #see event_log.gen_site_tasks
+    full_refresh = False, #rebuild ALL_OBS from scratch
+    max_workers = 1, #site slices running at the same time
+    retries = 2, #extra attempts for a failed site slice
+    sample_pct = None #see gen_obs_tasks
+):
+    create_obs_shell(session, overwrite = full_refresh)
+    tasks = gen_obs_tasks(sites, sqlty = sqlty, compact = compact, sample_pct = sample_pct)
+    print("generated sql: " + ", ".join(f"{k}={v}" for k, v in sql_size_report([x for t in tasks for x in t["sql"]]).items()))
+
+    ##--- not every site shares obs_clin, slices without a source table are left out
+    found = event_log.get_existing_tables(session, {t["srctbl_name"] for t in tasks})
+    missing = [t for t in tasks if t["srctbl_name"] not in found]
+    tasks = [t for t in tasks if t not in missing]
+    if missing:
+        print(f"no source table for: {', '.join(t['site'] + '-' + t['slice'] for t in missing)}")
+
+    start = time.perf_counter()
+    results = run_site_tasks(session, tasks, max_workers = max_workers, retries = retries)
+    wall_time = time.perf_counter() - start
+    print_site_report(results, wall_time = wall_time)
+    print_projection(sample_pct, wall_time)
+
+    failed = [f"{r['site']}-{r['slice']}" for r in results if r["status"] != "done"]
+    if failed:
+        raise RuntimeError(f"observation extraction failed for: {', '.join(failed)}; rerun to resume")
+    return results
+
+def build_obs_idx(session):
+    ##--- measures nearest to the transplant date, as-of matched per patient (see cohort_sql_utils.OBS_IDX_MEASURES)
+    session.sql(f"CREATE OR REPLACE TABLE {obs_idx_tbl} AS {gen_obs_idx_sql(ref_cohort = ref_cohort, obs_tbl = obs_tbl)}").collect()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "stack the study's loinc-coded labs and body measures of the cohort into ALL_OBS")
+    parser.add_argument("--max-workers", type = int, default = 4, help = "number of site slices running at the same time")
+    parser.add_argument("--retries", type = int, default = 2, help = "extra attempts for a failed site slice")
+    parser.add_argument("--full-refresh", action = "store_true", help = "rebuild ALL_OBS from scratch")
+    parser.add_argument("--sites", nargs = "*", default = event_log.site_lst, help = "subset of sites to run")
+    parser.add_argument("--backend", choices = ["snow","duckdb"], default = "snow", help = "snow: GROUSE warehouse; duckdb: local parquet extracts under --cdm-root")
+    parser.add_argument("--cdm-root", default = None, help = "root folder of the local parquet extracts, <cdm-root>/<SITE>/<TABLE>.parquet")
+    parser.add_argument("--duckdb-file", default = "cistem2_local.duckdb", help = "local database holding KTX_TBL1, ALL_OBS is written to it")
+    parser.add_argument("--compact-sql", action = "store_true", help = "see event_log.py")
+    parser.add_argument("--run-log-file", default = "run_log.jsonl", help = "local json lines file every statement of the run is appended to, next to the KTX_RUN_LOG table")
+    parser.add_argument("--sample-pct", type = float, default = None, help = "see event_log.py, use the same value as the run that built KTX_TBL1")
+    args = parser.parse_args()
+
+    with connect_session(args.backend, duckdb_file = args.duckdb_file, cdm_root = args.cdm_root) as raw_session, \
+         TrackedSession(raw_session, jsonl_file = args.run_log_file, step = "obs_extract") as session:
+        use_sample_schema(session, "SX_CISTEM2", args.sample_pct)
+        if args.backend == "duckdb":
+            args.sites = [s for s in args.sites if s in session.sites]
+        try:
+            run_obs_extract(
+                session, args.sites,
+                sqlty = "duckdb" if args.backend == "duckdb" else "snow",
+                compact = args.compact_sql,
+                full_refresh = args.full_refresh,
+                max_workers = args.max_workers,
+                retries = args.retries,
+                sample_pct = args.sample_pct
+            )
+            with session.tag(slice = obs_idx_tbl):
+                build_obs_idx(session)
+        finally:
+            session.flush()
+            print_run_report(session.records)
@@ -0,0 +1,195 @@
+import os
+import argparse
+from utils import (
+    connect_session, TrackedSession, print_run_report, LocalLedger, SnowLedger, create_pat_table1,
+    Stage, run_pipeline, print_pipeline_report, file_hash, run_sql_script, export_table, sample_schema, use_sample_schema,
+    gen_sample_predicate, print_projection
+)
+import event_log
+import ktx_tbl1
+import ktx_outcomes
+import obs_extract
+import egfr
+
+# the whole build as one stage graph over a single session:
+#
+#   pat_table1 ----------------------\
+#   event_log ---+--> ktx_tbl1 ------+--> all_obs --+--> obs_idx
+#                |                   |              +--> egfr
+#                |                   |              \--> pat_obs (snow only)
+#                |                   \--> extract
+#                \--> ktx_outcomes
+#
+# each stage is skipped when its inputs (code, valuesets, source table versions, upstream stages)
+# are unchanged since its last successful run; independent stages run side by side.
+# --sample-pct runs the whole graph on a stable hash-based percent of patients (see sample_utils):
+# the filter is pushed into every source scan, the sampled tables go to their own schema, and the
+# time of a full run is projected from the sampled stage times.
+# run from the repo root, like the other scripts
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def gen_stages(args):
+    sqlty = "duckdb" if args.backend == "duckdb" else "snow"
+    site_ledger = {}
+    # source versions looked up for the stage inputs, handed on to the stage so they are not looked up twice
+    src_versions = {}
+
+    def event_log_inputs(session):
+        tasks = event_log.gen_site_tasks(args.sites, qry_mode = args.qry_mode, sqlty = sqlty, compact = args.compact_sql, sample_pct = args.sample_pct)
+        src_versions.clear()
+        for name in sorted({t["srctbl_name"] for t in tasks}):
+            src_versions[name] = event_log.get_src_version(session, name)
+        return sorted((t["site"], t["slice"], t["vs_hash"], src_versions[t["srctbl_name"]]) for t in tasks)
+
+    def run_event_log(session):
+        if "ledger" not in site_ledger:
+            site_ledger["ledger"] = (
+                LocalLedger(sample_schema(os.path.splitext(args.duckdb_file)[0], args.sample_pct) + "_ledger.json") if args.backend == "duckdb"
+                else SnowLedger(session)
+            )
+        event_log.run_event_log(
+            session, args.sites, site_ledger["ledger"],
+            qry_mode = args.qry_mode, sqlty = sqlty, compact = args.compact_sql,
+            max_workers = args.site_workers, retries = args.retries, sample_pct = args.sample_pct,
+            src_versions = src_versions
+        )
+
+    def pat_table1_inputs(session):
+        # demographic/encounter/death versions of every site; the worksheet has its own site list on snowflake
+        code = (
+            file_hash(os.path.join(SRC_DIR, "utils", "cohort_sql_utils.py")) if args.backend == "duckdb"
+            else file_hash(os.path.join(SRC_DIR, "..", "SQL", "pat_tbl1.sql"))
+        )
+        return {
+            "code": code,
+            "sample_pct": args.sample_pct,
+            "src": [
+                event_log.get_src_version(session, f"GROUSE_DEID_DB.{'CMS_PCORNET_CDM' if s == 'CMS' else 'PCORNET_CDM_' + s}.V_DEID_{tbl}")
+                for s in args.sites for tbl in ["DEMOGRAPHIC", "ENCOUNTER", "DEATH"]
+            ]
+        }
+
+    def run_pat_table1(session):
+        if args.backend == "duckdb":
+            create_pat_table1(session, args.sites, sample_pct = args.sample_pct)
+        else:
+            run_sql_script(session, os.path.join(SRC_DIR, "..", "SQL", "pat_tbl1.sql"))
+            if args.sample_pct is not None:
+                # the worksheet reads every patient, the sample is applied to its output
+                session.sql(f"DELETE FROM PAT_TABLE1 WHERE NOT ({gen_sample_predicate(args.sample_pct)})").collect()
+
+    stages = [
+        Stage("pat_table1", run_pat_table1, inputs = pat_table1_inputs),
+        Stage("event_log", run_event_log, inputs = event_log_inputs),
+        Stage(
+            "ktx_tbl1",
+            lambda session: ktx_tbl1.build_ktx_tbl1(session, args.backend, single_pass = args.single_pass, with_pat_table1 = False, use_cache = not args.no_cache),
+            deps = ["event_log", "pat_table1"],
+            inputs = lambda session: {
+                "code": file_hash(*[os.path.join(SRC_DIR, x) for x in ["ktx_tbl1.py", "utils/cohort_sql_utils.py", "utils/band_join_utils.py", "utils/result_cache_utils.py"]]),
+                "single_pass": args.single_pass
+            }
+        ),
+        Stage(
+            "ktx_outcomes",
+            lambda session: ktx_outcomes.build_outcomes(session, args.spec),
+            deps = ["event_log"],
+            inputs = lambda session: {
+                "code": file_hash(os.path.join(SRC_DIR, "utils", "outcome_spec_utils.py")),
+                "spec": file_hash(args.spec)
+            }
+        ),
+        Stage(
+            "extract",
+            lambda session: export_table(session, "KTX_TBL1", args.out_dir, overwrite = True, verbose = False),
+            deps = ["ktx_tbl1"],
+            inputs = lambda session: {"out": os.path.abspath(args.out_dir), "code": file_hash(os.path.join(SRC_DIR, "utils", "export_utils.py"))},
+            exists = lambda session: os.path.exists(os.path.join(args.out_dir, "KTX_TBL1", "_manifest.json"))
+        ),
+        Stage(
+            "all_obs",
+            lambda session: obs_extract.run_obs_extract(
+                session, args.sites, sqlty = sqlty, compact = args.compact_sql, full_refresh = True,
+                max_workers = args.site_workers, retries = args.retries, sample_pct = args.sample_pct
+            ),
+            deps = ["ktx_tbl1"],
+            inputs = lambda session: {
+                "code": file_hash(os.path.join(SRC_DIR, "obs_extract.py")),
+                "src": sorted(
+                    (t["site"], t["slice"], t["vs_hash"], event_log.get_src_version(session, t["srctbl_name"]))
+                    for t in obs_extract.gen_obs_tasks(args.sites, sqlty = sqlty, compact = args.compact_sql, sample_pct = args.sample_pct)
+                )
+            }
+        ),
+        Stage(
+            "obs_idx",
+            obs_extract.build_obs_idx,
+            deps = ["all_obs"],
+            inputs = lambda session: {"code": file_hash(*[os.path.join(SRC_DIR, "utils", x) for x in ["cohort_sql_utils.py", "asof_join_utils.py"]])}
+        ),
+        Stage(
+            "egfr",
+            lambda session: egfr.build_egfr(session, mode = args.egfr_mode),
+            deps = ["all_obs", "pat_table1"],
+            inputs = lambda session: {
+                "code": file_hash(*[os.path.join(SRC_DIR, x) for x in ["egfr.py", "utils/egfr_utils.py"]]),
+                "mode": args.egfr_mode
+            }
+        )
+    ]
+    if args.backend == "snow":
+        stages.append(Stage(
+            "pat_obs",
+            lambda session: run_sql_script(session, os.path.join(SRC_DIR, "..", "SQL", "pat_obs.sql")),
+            deps = ["all_obs"],
+            inputs = lambda session: {"code": file_hash(os.path.join(SRC_DIR, "..", "SQL", "pat_obs.sql"))}
+        ))
+    return stages
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "run the cohort build as one stage graph, skipping stages whose inputs are unchanged")
+    parser.add_argument("--backend", choices = ["snow","duckdb"], default = "snow", help = "snow: GROUSE warehouse; duckdb: local parquet extracts under --cdm-root")
+    parser.add_argument("--cdm-root", default = None, help = "root folder of the local parquet extracts, <cdm-root>/<SITE>/<TABLE>.parquet")
+    parser.add_argument("--duckdb-file", default = "cistem2_local.duckdb", help = "local database the derived tables are written to")
+    parser.add_argument("--sites", nargs = "*", default = event_log.site_lst, help = "subset of sites to run")
+    parser.add_argument("--max-workers", type = int, default = 2, help = "stages running at the same time")
+    parser.add_argument("--site-workers", type = int, default = 4, help = "site slices running at the same time within event_log")
+    parser.add_argument("--retries", type = int, default = 2, help = "extra attempts for a failed site slice")
+    parser.add_argument("--qry-mode", choices = ["union","case","fanout","join"], default = "union", help = "see event_log.py")
+    parser.add_argument("--compact-sql", action = "store_true", help = "see event_log.py")
+    parser.add_argument("--single-pass", action = "store_true", help = "see ktx_tbl1.py")
+    parser.add_argument("--egfr-mode", choices = ["sql","numpy"], default = "sql", help = "see egfr.py")
+    parser.add_argument("--no-cache", action = "store_true", help = "see ktx_tbl1.py")
+    parser.add_argument("--spec", default = "./ref/outcome-spec-kd.json", help = "outcome spec json for ktx_outcomes")
+    parser.add_argument("--out-dir", default = "./data", help = "folder the extract stage writes to")
+    parser.add_argument("--force", nargs = "*", default = [], help = "stages to run even if their inputs are unchanged, 'all' for every stage")
+    parser.add_argument("--state-file", default = None, help = "keep the stage ledger in a local json file instead of the KTX_PIPELINE_LEDGER table")
+    parser.add_argument("--run-log-file", default = "run_log.jsonl", help = "local json lines file every statement of the run is appended to, next to the KTX_RUN_LOG table")
+    parser.add_argument("--sample-pct", type = float, default = None, help = "keep a stable hash-based percent of patients, e.g. 1; schema, ledgers and --out-dir get an _S<pct> suffix")
+    args = parser.parse_args()
+    args.out_dir = sample_schema(os.path.normpath(args.out_dir), args.sample_pct)
+    os.makedirs(args.out_dir, exist_ok = True)
+
+    with connect_session(args.backend, duckdb_file = args.duckdb_file, cdm_root = args.cdm_root) as raw_session, \
+         TrackedSession(raw_session, jsonl_file = args.run_log_file, step = "pipeline") as session:
+        use_sample_schema(session, "SX_CISTEM2", args.sample_pct)
+        if args.backend == "duckdb":
+            args.sites = [s for s in args.sites if s in session.sites]
+
+        if args.state_file:
+            ledger = LocalLedger(args.state_file)
+        elif args.backend == "duckdb":
+            ledger = LocalLedger(sample_schema(os.path.splitext(args.duckdb_file)[0], args.sample_pct) + "_pipeline.json")
+        else:
+            ledger = SnowLedger(session, tbl_name = "KTX_PIPELINE_LEDGER")
+
+        results, wall_time = run_pipeline(session, gen_stages(args), ledger, max_workers = args.max_workers, force = args.force)
+        session.flush()
+        print_run_report(session.records)
+        print_pipeline_report(results, wall_time)
+        print_projection(args.sample_pct, wall_time, results)
+
+        failed = [r["stage"] for r in results if r["status"] in ("failed", "blocked")]
+        if failed:
+            raise RuntimeError(f"pipeline stages not built: {', '.join(failed)}; rerun to resume")
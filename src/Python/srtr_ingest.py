@@ -0,0 +1,44 @@
+import argparse
+from utils import ingest_sas, gen_synthetic_sas, SRTR_PART_COLS, DuckSession
+
+# SRTR SAF export (see doc/SOP.md) to partitioned parquet the pipeline can join, see utils/sas_ingest_utils.py:
+#   python src/Python/srtr_ingest.py ./pubsaf2409 ./srtr --tables TX_KI CAND_KIPA --cols TX_KI=PX_ID,REC_TX_DT,REC_FAIL_DT
+# a rerun converts only new or changed files. locally the tables read back as SRTR_DB.PUBSAF.<TABLE>
+# views of DuckSession.attach_srtr; --synthetic writes small SRTR-like files to <src> first, for testing
+# run from the repo root, like the other scripts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "convert SRTR SAS files into typed, partitioned parquet")
+    parser.add_argument("src", help = "sas7bdat/xpt file or folder of the unpacked export")
+    parser.add_argument("out_dir", help = "parquet root, one folder per table")
+    parser.add_argument("--tables", nargs = "*", default = None, help = "tables to convert, e.g. TX_KI CAND_KIPA; all by default")
+    parser.add_argument("--cols", nargs = "*", default = [], help = "column projections as TABLE=COL1,COL2,...; other tables keep all columns")
+    parser.add_argument("--max-workers", type = int, default = 2, help = "files converted at the same time, one process each")
+    parser.add_argument("--mem-mb", type = int, default = 512, help = "memory budget of each worker, sets the chunk size")
+    parser.add_argument("--chunk-rows", type = int, default = None, help = "fixed chunk size instead of the memory budget")
+    parser.add_argument("--no-partition", action = "store_true", help = f"one partition per table instead of the year partitions of {', '.join(SRTR_PART_COLS)}")
+    parser.add_argument("--overwrite", action = "store_true", help = "convert every file again instead of only new or changed ones")
+    parser.add_argument("--synthetic", type = int, default = None, help = "write this many synthetic recipients to <src> first")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        print(f"written {', '.join(gen_synthetic_sas(args.src, n_pat = args.synthetic))}")
+    cols = {}
+    for x in args.cols:
+        tbl, lst = x.split("=", 1)
+        cols[tbl.upper()] = lst.split(",")
+
+    results = ingest_sas(
+        args.src, args.out_dir,
+        tables = [t.upper() for t in args.tables] if args.tables else None,
+        cols = cols,
+        part_cols = {} if args.no_partition else SRTR_PART_COLS,
+        max_workers = args.max_workers,
+        mem_mb = args.mem_mb,
+        chunk_rows = args.chunk_rows,
+        overwrite = args.overwrite
+    )
+    with DuckSession() as session:
+        session.attach_srtr(args.out_dir)
+        for view_name in session.src_files:
+            print(f"{view_name}: {session.sql(f'SELECT COUNT(*) FROM {view_name}').collect()[0][0]} row(s)")
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts import the utils package from src/Python, like running them from the repo root
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
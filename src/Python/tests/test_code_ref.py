@@ -0,0 +1,99 @@
+import json
+import duckdb
+from utils import QueryFromJson, gen_code_ref
+
+# join matching must give the rows of gen_qry, also when a valueset nests prefixes or lists
+# exact codes under one of its prefixes, when an exact code comes without its ".", when a key lists
+# a code under several systems and there is no code type column, and for keys with a valueRange
+
+VS = [{
+    "id": "T00001", "name": "MI", "description": "test",
+    "compose": {"include": [
+        {"system": "icd10cm", "filter": [{"property": "codePrecision", "op": "descendent-of", "value": ["I21", "I21.0", "I22.1"]}]},
+        {"system": "icd10cm", "concept": [{"code": "I21.4"}, {"code": "I25.2"}]},
+        {"system": "icd10cm", "filter": [{"property": "codePrecision", "op": "descendent-of", "value": ["I21"]}]}
+    ]},
+    "relatedArtifact": {"valueType": "discrete"}
+}]
+SRC = [("1", "I21.0", "10"), ("2", "I21.4", "10"), ("3", "I25.2", "10"), ("4", "I22.1", "10"), ("5", "I22.0", "10"), ("6", "I21.4", "09"), ("7", "I252", "10")]
+
+def test_join_matches_union(tmp_path):
+    url = str(tmp_path / "vs.json")
+    with open(url, "w") as f:
+        json.dump(VS, f)
+    cdtype_map = {"icd10cm": "10"}
+    vs = QueryFromJson(
+        url = url, sqlty = "duckdb", cd_field = "DX", cdtype_field = "DX_TYPE", date_fields = ["DX_DATE"],
+        other_fields = ["PATID"], srctbl_name = "src", cdtype_map = cdtype_map, cache_dir = None
+    )
+    con = duckdb.connect()
+    con.execute("CREATE TABLE src (PATID varchar, DX varchar, DX_TYPE varchar, DX_DATE date)")
+    con.executemany("INSERT INTO src VALUES (?, ?, ?, date '2020-01-01')", [list(x) for x in SRC])
+    code_ref = gen_code_ref(url, cdtype_map)
+    con.register("code_ref_df", code_ref)
+    con.execute("CREATE TABLE code_ref AS SELECT * FROM code_ref_df")
+
+    union_rows = sorted(con.execute(vs.gen_qry()).fetchall())
+    join_rows = sorted(con.execute(vs.gen_qry_join("code_ref")).fetchall())
+    assert [r[0] for r in union_rows] == ["1", "2", "3", "4"]
+    assert join_rows == union_rows
+
+def _rows(con, vs, reftbl = "code_ref"):
+    return sorted(con.execute(vs.gen_qry()).fetchall()), sorted(con.execute(vs.gen_qry_join(reftbl)).fetchall())
+
+def test_join_without_code_type_matches_union(tmp_path):
+    url = str(tmp_path / "vs.json")
+    with open(url, "w") as f:
+        json.dump([{
+            "id": "T00002", "name": "MI", "description": "test",
+            "compose": {"include": [
+                {"system": "icd10cm", "filter": [{"property": "codePrecision", "op": "descendent-of", "value": ["I21"]}]},
+                {"system": "icd9cm", "concept": [{"code": "I21.4"}, {"code": "410.1"}, {"code": "411.0"}]},
+                {"system": "icd9cm", "filter": [{"property": "codePrecision", "op": "descendent-of", "value": ["410"]}]},
+                {"system": "icd10cm", "concept": [{"code": "410.1"}, {"code": "411.0"}]}
+            ]},
+            "relatedArtifact": {"valueType": "discrete"}
+        }], f)
+    cdtype_map = {"icd9cm": "09", "icd10cm": "10"}
+    vs = QueryFromJson(
+        url = url, sqlty = "duckdb", cd_field = "DX", date_fields = ["DX_DATE"],
+        other_fields = ["PATID"], srctbl_name = "src", cdtype_map = cdtype_map, cache_dir = None
+    )
+    con = duckdb.connect()
+    con.execute("CREATE TABLE src (PATID varchar, DX varchar, DX_DATE date)")
+    con.executemany("INSERT INTO src VALUES (?, ?, date '2020-01-01')", [
+        ["1", "I21.4"], ["2", "410.1"], ["3", "411.0"], ["4", "410.9"], ["5", "4110"], ["6", "I22.0"]
+    ])
+    con.register("code_ref_df", gen_code_ref(url, cdtype_map))
+    con.execute("CREATE TABLE code_ref AS SELECT * FROM code_ref_df")
+
+    union_rows, join_rows = _rows(con, vs)
+    assert [r[0] for r in union_rows] == ["1", "2", "3", "4"]
+    assert join_rows == union_rows
+
+def test_join_applies_value_range(tmp_path):
+    url = str(tmp_path / "vs.json")
+    with open(url, "w") as f:
+        json.dump(VS + [{
+            "id": "T00003", "name": "SCr", "description": "test",
+            "compose": {"include": [{"system": "loinc", "concept": [{"code": "2160-0"}, {"code": "38483-4"}]}]},
+            "relatedArtifact": {"valueType": "continuous", "valueRange": {
+                "low": {"value": 0.5, "incld": 1}, "high": {"value": 5, "incld": 0}
+            }}
+        }], f)
+    cdtype_map = {"icd10cm": "10", "loinc": "LC"}
+    vs = QueryFromJson(
+        url = url, sqlty = "duckdb", cd_field = "DX", cdtype_field = "DX_TYPE", date_fields = ["DX_DATE"],
+        other_fields = ["PATID"], srctbl_name = "src", val_field = "VAL", cdtype_map = cdtype_map, cache_dir = None
+    )
+    con = duckdb.connect()
+    con.execute("CREATE TABLE src (PATID varchar, DX varchar, DX_TYPE varchar, DX_DATE date, VAL double)")
+    con.executemany("INSERT INTO src VALUES (?, ?, ?, date '2020-01-01', ?)", [list(x) + [None] for x in SRC] + [
+        ["8", "2160-0", "LC", 1.2], ["9", "2160-0", "LC", 5.0], ["10", "38483-4", "LC", 0.5], ["11", "2160-0", "LC", None]
+    ])
+    con.register("code_ref_df", gen_code_ref(url, cdtype_map))
+    con.execute("CREATE TABLE code_ref AS SELECT * FROM code_ref_df")
+
+    union_rows, join_rows = _rows(con, vs)
+    assert sorted(r[0] for r in union_rows if r[-1] == "SCr") == ["10", "8"]
+    assert join_rows == union_rows
@@ -0,0 +1,31 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+from utils import DuckSession, export_table
+
+# every partition is written with the schema of the table, also when a partition has no
+# value in a column (the type cannot be told from its data)
+
+def test_all_null_partition_keeps_column_types(tmp_path):
+    session = DuckSession()
+    session.sql("""
+        CREATE TABLE KTX_TBL1 AS SELECT * FROM (VALUES
+            ('A', '1', NULL::date, NULL::double, NULL::varchar),
+            ('A', '2', NULL::date, NULL::double, NULL::varchar),
+            ('B', '3', date '2020-01-02', 1.5, 'M'),
+            ('B', '4', date '2021-03-04', NULL, 'F')
+        ) t(KTX_SITE, PATID, TX_DATE, EGFR, SEX)
+    """).collect()
+    manifest = export_table(session, "KTX_TBL1", str(tmp_path), dict_cols = ["SEX"], verbose = False)
+    assert manifest["rows"] == 4
+
+    schemas = [pq.read_schema(str(tmp_path / "KTX_TBL1" / f"KTX_SITE={s}" / "part-0.parquet")) for s in ["A", "B"]]
+    assert schemas[0] == schemas[1]
+    assert schemas[0].names == ["PATID", "TX_DATE", "EGFR", "SEX"]
+    assert schemas[0].field("TX_DATE").type == pa.date32()
+    assert schemas[0].field("EGFR").type == pa.float64()
+    assert schemas[0].field("SEX").type == pa.dictionary(pa.int32(), pa.string())
+
+    part_a = pq.read_table(str(tmp_path / "KTX_TBL1" / "KTX_SITE=A" / "part-0.parquet"))
+    assert part_a.column("TX_DATE").null_count == 2
+    part_b = pq.read_table(str(tmp_path / "KTX_TBL1" / "KTX_SITE=B" / "part-0.parquet")).to_pydict()
+    assert [str(d) for d in part_b["TX_DATE"]] == ["2020-01-02", "2021-03-04"]
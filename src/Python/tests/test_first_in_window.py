@@ -0,0 +1,44 @@
+import duckdb
+import numpy as np
+import pytest
+from utils import gen_first_in_window_sql
+
+# the as-of match gives, for every left row, the earliest right date in the window, the same as
+# the join on the key plus a min it replaces
+
+@pytest.fixture(scope = "module")
+def con():
+    rng = np.random.default_rng(0)
+    con = duckdb.connect()
+    n_left, n_right = 400, 1500
+    con.execute("CREATE TABLE l (ROW_ID int, PATID varchar, IDX_DATE date)")
+    con.executemany("INSERT INTO l VALUES (?, ?, date '2015-01-01' + ?::int)", [
+        [i, f"P{p}", int(d)] for i, (p, d) in enumerate(zip(rng.integers(0, 60, n_left), rng.integers(0, 400, n_left)))
+    ])
+    # repeated (PATID, IDX_DATE) probes and patients without any right event
+    con.execute("INSERT INTO l SELECT ROW_ID + 10000, PATID, IDX_DATE FROM l WHERE ROW_ID < 50")
+    con.execute("INSERT INTO l VALUES (99999, 'NONE', date '2015-06-01')")
+    con.execute("CREATE TABLE r (PATID varchar, CD_DATE date)")
+    con.executemany("INSERT INTO r VALUES (?, date '2015-01-01' + ?::int)", [
+        [f"P{p}", int(d)] for p, d in zip(rng.integers(0, 70, n_right), rng.integers(-30, 430, n_right))
+    ])
+    return con
+
+def _join_min(lo, hi, inner):
+    return f"""
+        select l.ROW_ID, min(r.CD_DATE) as NEXT_DATE
+        from l {"join" if inner else "left join"} r
+          on l.PATID = r.PATID and datediff('day', l.IDX_DATE, r.CD_DATE) between {lo} and {hi}
+        group by l.ROW_ID
+    """
+
+@pytest.mark.parametrize("lo,hi", [(0, 7), (3, 30), (-14, 14), (0, 0)])
+@pytest.mark.parametrize("inner", [False, True])
+def test_first_in_window_matches_join(con, lo, hi, inner):
+    qry = gen_first_in_window_sql("l", "r", "PATID", "IDX_DATE", "CD_DATE", lo, hi, "NEXT_DATE", inner = inner)
+    got = sorted(con.execute(f"select ROW_ID, NEXT_DATE from ({qry})").fetchall())
+    want = sorted(con.execute(_join_min(lo, hi, inner)).fetchall())
+    assert got == want
+    if not inner:
+        assert len(got) == con.execute("select count(*) from l").fetchone()[0]
+    assert any(x[1] is not None for x in got)
@@ -0,0 +1,38 @@
+from utils import LocalLedger, filter_fresh_tasks
+
+# a slice is skipped only when it was built from the same valueset hash and source version
+
+def _task(site, slc, vs_hash = "h1", src_version = "v1"):
+    return {"site": site, "slice": slc, "sql": "", "vs_hash": vs_hash, "src_version": src_version}
+
+def _split(tasks, ledger):
+    to_run, skipped = filter_fresh_tasks(tasks, ledger)
+    return [(t["site"], t["slice"]) for t in to_run], [(t["site"], t["slice"]) for t in skipped]
+
+def test_fresh_and_stale(tmp_path):
+    ledger = LocalLedger(str(tmp_path / "ledger.json"))
+    ledger.mark_done("S1", "DX", "h1", "v1", row_cnt = 10)
+    ledger.mark_done("S1", "PX", "h1", "v1")
+    ledger.mark_done("S2", "DX", "h1", "v1")
+    tasks = [_task("S1", "DX"), _task("S1", "PX", vs_hash = "h2"), _task("S2", "DX", src_version = "v2"), _task("S3", "DX")]
+    assert _split(tasks, ledger) == ([("S1", "PX"), ("S2", "DX"), ("S3", "DX")], [("S1", "DX")])
+
+    # the ledger file is read back by the next run
+    ledger = LocalLedger(str(tmp_path / "ledger.json"))
+    assert ledger.get("S1", "DX")["row_cnt"] == 10
+    assert _split(tasks, ledger) == ([("S1", "PX"), ("S2", "DX"), ("S3", "DX")], [("S1", "DX")])
+
+def test_unknown_src_version_is_rebuilt(tmp_path):
+    ledger = LocalLedger(str(tmp_path / "ledger.json"))
+    ledger.mark_done("S1", "DX", "h1", None)
+    assert not ledger.is_fresh("S1", "DX", "h1", None)
+    assert _split([_task("S1", "DX", src_version = None)], ledger) == ([("S1", "DX")], [])
+
+def test_reset(tmp_path):
+    ledger = LocalLedger(str(tmp_path / "ledger.json"))
+    ledger.mark_done("S1", "DX", "h1", "v1")
+    assert ledger.is_fresh("S1", "DX", "h1", "v1")
+    ledger.reset()
+    assert ledger.get("S1", "DX") is None
+    assert LocalLedger(str(tmp_path / "ledger.json")).entries == {}
+    assert _split([_task("S1", "DX")], ledger) == ([("S1", "DX")], [])
@@ -0,0 +1,53 @@
+import duckdb
+import pytest
+from utils import expand_range, parse_range, merge_ranges, range_predicate_multisql
+
+# the compiled range predicate must match exactly the codes the expand_range enumeration lists
+
+CANDIDATES = [
+    # in range, bounds included
+    "A100", "A101", "A150", "A199", "A200",
+    # out of range, other prefix, lower case
+    "A99", "A201", "A1000", "B150", "a150",
+    # zero-padded, malformed, padded with spaces
+    "A0100", "A0150", "A00", "A10a", "A1.5", "A-150", " A150", "A150 ", "A", "",
+    # bare numbers
+    "0", "5", "99", "100", "150", "200", "201", "0150", "150 ", "1e2"
+]
+
+def _matches(predicate):
+    con = duckdb.connect()
+    con.execute("CREATE TABLE t (CD varchar)")
+    con.executemany("INSERT INTO t VALUES (?)", [[x] for x in CANDIDATES])
+    return {r[0] for r in con.execute(f"SELECT CD FROM t WHERE {predicate}").fetchall()}
+
+@pytest.mark.parametrize("range_expression", ["A100-A200", "A0-A150", "100-200", "0-99", "A150-A150"])
+def test_range_predicate_matches_expansion(range_expression):
+    prefix, lo, hi = parse_range(range_expression)
+    expected = set(expand_range(range_expression)) & set(CANDIDATES)
+    assert _matches(range_predicate_multisql("duckdb", "CD", prefix, lo, hi)) == expected
+
+def test_range_predicate_rejects_padded_and_malformed():
+    matched = _matches(range_predicate_multisql("duckdb", "CD", "A", 0, 1000))
+    for cd in ["A0100", "A0150", "A00", "A10a", "A1.5", "A-150", " A150", "A150 ", "A", "a150"]:
+        assert cd not in matched
+
+def test_parse_range():
+    assert parse_range("A100-A200") == ("A", 100, 200)
+    assert parse_range("100-200") == ("", 100, 200)
+
+def test_merge_ranges():
+    # overlapping and touching intervals merge, a gap or another prefix does not
+    assert merge_ranges([("A", 100, 150), ("A", 120, 200)]) == [("A", 100, 200)]
+    assert merge_ranges([("A", 100, 150), ("A", 151, 200)]) == [("A", 100, 200)]
+    assert merge_ranges([("A", 100, 150), ("A", 152, 200)]) == [("A", 100, 150), ("A", 152, 200)]
+    assert merge_ranges([("A", 100, 150), ("B", 151, 200)]) == [("A", 100, 150), ("B", 151, 200)]
+    assert merge_ranges([("A", 150, 200), ("A", 100, 300), ("A", 120, 130)]) == [("A", 100, 300)]
+
+def test_merged_ranges_match_expansion():
+    ranges = ["A100-A150", "A140-A180", "A181-A200", "100-150"]
+    expected = set().union(*[expand_range(r) for r in ranges]) & set(CANDIDATES)
+    predicate = " or ".join(
+        range_predicate_multisql("duckdb", "CD", *r) for r in merge_ranges([parse_range(x) for x in ranges])
+    )
+    assert _matches(predicate) == expected
@@ -0,0 +1,51 @@
+import os
+import json
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyreadstat
+from utils import ingest_sas, gen_synthetic_sas
+
+# round trip of the synthetic SRTR files: types from the SAS metadata, dates and missing values
+# kept, a rerun converts nothing and a removed source file takes its output with it
+
+def _read(out_dir, tbl):
+    return pq.read_table(os.path.join(out_dir, tbl), partitioning = "hive")
+
+def test_round_trip_types_and_values(tmp_path):
+    src, out = str(tmp_path / "src"), str(tmp_path / "out")
+    gen_synthetic_sas(src, n_pat = 500)
+    results = ingest_sas(src, out, max_workers = 1, chunk_rows = 120, verbose = False)
+    assert sorted(r["table"] for r in results) == ["CAND_KIPA", "TX_KI"]
+    assert all(r["chunks"] > 1 for r in results)
+
+    tbl = _read(out, "TX_KI")
+    assert tbl.schema.field("REC_TX_DT").type == pa.date32()
+    assert tbl.schema.field("REC_FAIL_DT").type == pa.date32()
+    assert tbl.schema.field("REC_CREAT").type == pa.float64()
+    assert tbl.schema.field("REC_CTR_CD").type == pa.string()
+    assert sorted(os.listdir(os.path.join(out, "TX_KI")))[0].startswith("REC_TX_YEAR=")
+
+    sas, _ = pyreadstat.read_xport(os.path.join(src, "tx_ki.xpt"))
+    df = tbl.to_pandas().sort_values("PX_ID").reset_index(drop = True)
+    assert len(df) == len(sas) == 500
+    assert (pd.to_datetime(df["REC_TX_DT"]) == pd.to_datetime(sas["REC_TX_DT"])).all()
+    assert df["REC_FAIL_DT"].isna().sum() == sas["REC_FAIL_DT"].isna().sum() > 0
+    assert df["REC_CREAT"].isna().sum() == sas["REC_CREAT"].isna().sum() > 0
+    assert df["REC_CTR_CD"].isna().sum() == (sas["REC_CTR_CD"] == "").sum() > 0
+
+def test_rerun_skips_and_removed_file_is_dropped(tmp_path):
+    src, out = str(tmp_path / "src"), str(tmp_path / "out")
+    gen_synthetic_sas(src, n_pat = 200)
+    ingest_sas(src, out, max_workers = 1, verbose = False)
+    files = {os.path.join(r, f): os.path.getmtime(os.path.join(r, f)) for r, _, fs in os.walk(out) for f in fs if f.endswith(".parquet")}
+
+    assert ingest_sas(src, out, max_workers = 1, verbose = False) == []
+    assert {f: os.path.getmtime(f) for f in files} == files
+
+    os.remove(os.path.join(src, "cand_kipa.xpt"))
+    assert ingest_sas(src, out, max_workers = 1, verbose = False) == []
+    assert not os.path.exists(os.path.join(out, "CAND_KIPA"))
+    assert os.path.isdir(os.path.join(out, "TX_KI"))
+    with open(os.path.join(out, "_manifest.json")) as f:
+        assert [os.path.basename(k) for k in json.load(f)["files"]] == ["tx_ki.xpt"]
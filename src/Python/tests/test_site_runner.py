@@ -0,0 +1,52 @@
+import time
+from utils import LocalSession, TrackedSession, run_site_tasks
+
+# the fan-out against the LocalSession stand-in: tasks run side by side, a failed statement is
+# retried, a task out of retries is reported without stopping the others, and the statements are
+# tagged with the caller's tags plus the task's site and slice
+
+def _tasks(sites, slc = "DX"):
+    return [{"site": s, "slice": slc, "sql": [f"-- {s} {slc} 1", f"-- {s} {slc} 2"]} for s in sites]
+
+def test_tasks_run_in_parallel():
+    session = LocalSession(latency = 0.2)
+    start = time.perf_counter()
+    results = run_site_tasks(session, _tasks(["S1", "S2", "S3", "S4"]), max_workers = 4, verbose = False)
+    wall = time.perf_counter() - start
+    assert [r["status"] for r in results] == ["done"] * 4
+    assert [r["site"] for r in results] == ["S1", "S2", "S3", "S4"]
+    assert len(session.queries) == 8
+    assert len({q["thread"] for q in session.queries}) == 4
+    # serial would take 8 * 0.2s
+    assert wall < 0.8
+
+def test_failed_statement_is_retried():
+    session = LocalSession(latency = 0, fail_on = {"S2 DX 2": 1})
+    done = []
+    results = run_site_tasks(session, _tasks(["S1", "S2"]), retry_wait = 0, verbose = False, on_done = done.append)
+    assert [(r["status"], r["attempts"]) for r in results] == [("done", 1), ("done", 2)]
+    # the task is rerun as a whole
+    assert [q["sql"] for q in session.queries if "S2" in q["sql"]] == ["-- S2 DX 1", "-- S2 DX 2", "-- S2 DX 1", "-- S2 DX 2"]
+    assert sorted(t["site"] for t in done) == ["S1", "S2"]
+
+def test_failure_is_reported_per_task():
+    session = LocalSession(latency = 0, fail_on = {"S2": 10})
+    done = []
+    results = run_site_tasks(session, _tasks(["S1", "S2", "S3"]), retries = 1, retry_wait = 0, verbose = False, on_done = done.append)
+    failed = [r for r in results if r["status"] == "failed"]
+    assert [(r["site"], r["attempts"]) for r in failed] == [("S2", 2)]
+    assert "simulated failure" in failed[0]["error"]
+    assert all(r["error"] is None for r in results if r["site"] != "S2")
+    assert sorted(t["site"] for t in done) == ["S1", "S3"]
+
+def test_caller_tags_are_merged():
+    session = TrackedSession(LocalSession(latency = 0, fail_on = {"S2": 1}), log_tbl = None, step = "event_log")
+    with session.tag(stage = "event_log", site = "ALL"):
+        run_site_tasks(session, _tasks(["S1", "S2"]), max_workers = 2, retry_wait = 0, verbose = False)
+    recs = sorted(session.records, key = lambda r: (r["site"], r["attempt"], r["sql_text"]))
+    assert all(r["stage"] == "event_log" and r["step"] == "event_log" and r["slice"] == "DX" for r in recs)
+    assert [(r["site"], r["attempt"], r["status"]) for r in recs] == [
+        ("S1", 1, "done"), ("S1", 1, "done"), ("S2", 1, "failed"), ("S2", 2, "done"), ("S2", 2, "done")
+    ]
+    # outside the block the caller's tags are gone
+    assert session.current_tags() == {}
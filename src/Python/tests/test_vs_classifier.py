@@ -0,0 +1,60 @@
+import os
+import json
+import duckdb
+import numpy as np
+from utils import QueryFromJson, VsClassifier, gen_synthetic_cdm
+
+# the offline classifier labels the rows of the synthetic extracts like the union-all sql does:
+# descendent-of prefixes (MI, T2DM), exact code lists (KTx, RenalBiopsy), a codeRange block
+# added here over the cpt background codes, and rows without a code
+
+REF_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "..", "ref")
+RANGE_VS = {
+    "id": "T00001", "name": "Imaging", "description": "test",
+    "compose": {"include": [{"system": "cpt", "filter": [{"property": "codeRange", "op": "in", "value": ["70010-70559", "72010-72295"]}]}]},
+    "relatedArtifact": {"valueType": "boolean"}
+}
+
+def _setup(tmp_path):
+    with open(os.path.join(REF_DIR, "vs-cde-kd.json")) as f:
+        vs = json.load(f) + [RANGE_VS]
+    url = str(tmp_path / "vs.json")
+    with open(url, "w") as f:
+        json.dump(vs, f)
+    cdtype_map = os.path.join(REF_DIR, "cdtype-map.json")
+    gen_synthetic_cdm(str(tmp_path / "cdm"), 3000, sites = ["SITE1"], vs_url = url, cdtype_map = cdtype_map)
+    return url, cdtype_map
+
+def _compare(con, url, cdtype_map, tbl, cd_field, domain, date_field):
+    path = os.path.join(os.path.dirname(url), "cdm", "SITE1", tbl, "*.parquet")
+    con.execute(f"""
+        CREATE OR REPLACE TABLE src AS
+        SELECT row_number() OVER () - 1 AS ROW_IDX, * FROM (
+            SELECT PATID, {cd_field}, {cd_field}_TYPE, {date_field} FROM read_parquet('{path}')
+            UNION ALL SELECT 'NULL-' || range, NULL, '10', NULL FROM range(20)
+        )
+    """)
+    vs = QueryFromJson(
+        url = url, sqlty = "duckdb", cd_field = cd_field, cdtype_field = cd_field + "_TYPE", date_fields = [date_field],
+        other_fields = ["ROW_IDX"], srctbl_name = "src", sel_domain = domain, cdtype_map = cdtype_map, cache_dir = None
+    )
+    union_rows = {(r[0], r[-1]) for r in con.execute(vs.gen_qry()).fetchall()}
+
+    df = con.execute(f"SELECT ROW_IDX, {cd_field}, {cd_field}_TYPE FROM src ORDER BY ROW_IDX").df()
+    assert (df["ROW_IDX"].to_numpy() == np.arange(len(df))).all()
+    clf = VsClassifier(url, cdtype_map = cdtype_map, sel_domain = domain)
+    out = clf.classify(df[cd_field], df[cd_field + "_TYPE"])
+    clf_rows = set(zip(out["ROW_IDX"].tolist(), out["PHE_TYPE"].tolist()))
+
+    assert clf_rows == union_rows
+    null_rows = set(df.loc[df[cd_field].isna(), "ROW_IDX"])
+    assert len(null_rows) == 20 and not any(r in null_rows for r, _ in clf_rows)
+    return {phe for _, phe in clf_rows}
+
+def test_classify_matches_union(tmp_path):
+    url, cdtype_map = _setup(tmp_path)
+    con = duckdb.connect()
+    dx_labels = _compare(con, url, cdtype_map, "DIAGNOSIS", "DX", "dx", "DX_DATE")
+    assert {"MI", "T2DM", "AR"} <= dx_labels
+    px_labels = _compare(con, url, cdtype_map, "PROCEDURES", "PX", "px", "PX_DATE")
+    assert {"KTx", "RenalBiopsy", "Imaging"} <= px_labels
@@ -1 +1,20 @@
-from .gen_vs_json_utils import *
\ No newline at end of file
+from .gen_vs_json_utils import *
+from .site_runner_utils import *
+from .ledger_utils import *
+from .vs_classifier_utils import *
+from .duckdb_utils import *
+from .cohort_sql_utils import *
+from .session_utils import *
+from .synth_cdm_utils import *
+from .outcome_spec_utils import *
+from .band_join_utils import *
+from .telemetry_utils import *
+from .sql_compact_utils import *
+from .pipeline_utils import *
+from .export_utils import *
+from .asof_join_utils import *
+from .egfr_utils import *
+from .vs_store_utils import *
+from .result_cache_utils import *
+from .sample_utils import *
+from .sas_ingest_utils import *
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+
+# as-of matching of anchor dates (e.g. the transplant date) to the nearest observation of the same
+# key in a long table (e.g. ALL_OBS), within a tolerance, looking before, after or both ways:
+#  - gen_asof_sql: anchors and observations sorted together in one window pass. a running count of
+#    observations puts each anchor in the same group as the last observation before it (and, counted
+#    backwards, the first one after it), so a second window reads the match off its group. no join
+#    of the anchors to every observation of the key and no rank over the pairs
+#  - asof_join_df: the same match locally, as a vectorized sort-merge (pandas merge_asof)
+# an observation on the anchor date counts as both before and after; nearest prefers the earlier
+# one at equal distance; observations of the same date are ordered by order_cols, the last one is
+# taken looking back, the first one looking ahead
+
+DIRECTIONS = ("before", "after", "nearest")
+
+def _as_list(cols):
+    return [cols] if isinstance(cols, str) else list(cols)
+
+def _check_direction(direction):
+    if direction not in DIRECTIONS:
+        raise ValueError(f"direction must be one of {DIRECTIONS}, got '{direction}'")
+
+def gen_asof_sql(
+    anchors, #table name, cte name or "(select ...)" subquery holding the key(s) and anchor date
+    obs, #table name, cte name or "(select ...)" subquery of observations
+    on, #key column or list of key columns, present in both
+    anchor_date, #date column of anchors
+    obs_date, #date column of obs
+    obs_cols, #obs columns to return besides the obs date
+    direction = "nearest", #"before": latest obs on or before the anchor; "after": earliest on or after; "nearest": closest either way
+    tolerance = None, #max days between anchor and obs, None for no limit
+    order_cols = list(), #obs columns ordering the observations of one date
+    prefix = "" #prefix of the returned columns, e.g. "SCR_"
+):
+    # anchor rows plus <prefix><obs_date>, <prefix>DAYS (obs date - anchor date) and <prefix><obs_cols>,
+    # null when nothing matches. plain sql for snowflake and duckdb
+    _check_direction(direction)
+    on = _as_list(on)
+    keys = ', '.join(on)
+    obs_cols = [c for c in _as_list(obs_cols) if c != obs_date and c not in on]
+    extra = list(dict.fromkeys(obs_cols + [c for c in order_cols if c not in on and c != obs_date]))
+    sides = [s for s, d in [("B", "before"), ("A", "after")] if direction in (d, "nearest")]
+
+    # _BN: observations up to and including the row, anchors sorted after the obs of their date;
+    # _AN: the same counted from the end. an anchor shares its count with the obs it matches
+    ord_cols = {"B": f"_T, _SRC desc{''.join(', ' + c for c in order_cols)}", "A": f"_T desc, _SRC desc{''.join(', ' + c + ' desc' for c in order_cols)}"}
+    counts = ', '.join(
+        f"sum(_SRC) over (partition by {keys} order by {ord_cols[s]} rows between unbounded preceding and current row) as _{s}N"
+        for s in sides
+    )
+    grp_vals = ', '.join(
+        f"first_value(case when _SRC = 1 then {c} end) over (partition by {keys}, _{s}N order by _SRC desc) as {s}_{c}"
+        for s in sides for c in ["_T"] + obs_cols
+    )
+
+    # which side matches, within the tolerance
+    ok = {
+        s: f"{s}__T is not null" + (f" and abs(datediff('day', _T, {s}__T)) <= {int(tolerance)}" if tolerance is not None else "")
+        for s in sides
+    }
+    if direction == "nearest":
+        choose = lambda c: (
+            f"case when {ok['B']} and (A__T is null or not ({ok['A']}) or datediff('day', B__T, _T) <= datediff('day', _T, A__T)) then B_{c}"
+            f" when {ok['A']} then A_{c} end"
+        )
+    else:
+        choose = lambda c: f"case when {ok[sides[0]]} then {sides[0]}_{c} end"
+
+    probe_nulls = ''.join(f", null as {c}" for c in extra)
+    obs_vals = ''.join(f", o.{c}" for c in extra)
+    return f"""
+        select l.*, m._MT as {prefix}{obs_date}, datediff('day', l.{anchor_date}, m._MT) as {prefix}DAYS{''.join(f", m.{c} as {prefix}{c}" for c in obs_cols)}
+        from {anchors} l
+        left join (
+            select {keys}, _T, {choose("_T")} as _MT{''.join(f", {choose(c)} as {c}" for c in obs_cols)}
+            from (
+                select {keys}, _T, _SRC, {grp_vals}
+                from (
+                    select *, {counts}
+                    from (
+                        select distinct {keys}, {anchor_date} as _T, 0 as _SRC{probe_nulls} from {anchors}
+                        union all
+                        select {', '.join('o.' + k for k in on)}, o.{obs_date} as _T, 1 as _SRC{obs_vals} from {obs} o
+                        where o.{obs_date} is not null
+                          and exists (select 1 from {anchors} a where {' and '.join(f"a.{k} = o.{k}" for k in on)})
+                    ) u
+                ) c
+            ) g
+            where _SRC = 0
+        ) m on {' and '.join(f"m.{k} = l.{k}" for k in on)} and m._T = l.{anchor_date}
+    """
+
+def asof_join_df(
+    anchors, #pandas DataFrame holding the key(s) and anchor date
+    obs, #pandas DataFrame of observations
+    on, #key column or list of key columns, present in both
+    anchor_date, #date column of anchors
+    obs_date, #date column of obs
+    obs_cols, #obs columns to return besides the obs date
+    direction = "nearest", #see gen_asof_sql
+    tolerance = None, #max days between anchor and obs, None for no limit
+    order_cols = list(), #obs columns ordering the observations of one date
+    prefix = "" #prefix of the returned columns
+):
+    # same output as gen_asof_sql, anchor rows in their original order
+    _check_direction(direction)
+    on = _as_list(on)
+    obs_cols = [c for c in _as_list(obs_cols) if c != obs_date and c not in on]
+    out_names = {c: prefix + c for c in [obs_date] + obs_cols}
+
+    left = anchors.reset_index(drop = True).assign(_ROW = np.arange(len(anchors)), _T = pd.to_datetime(anchors[anchor_date]).values)
+    right = obs[on + [obs_date] + list(dict.fromkeys(obs_cols + [c for c in order_cols if c not in on and c != obs_date]))]
+    right = right.assign(_T = pd.to_datetime(right[obs_date])).dropna(subset = ["_T"])
+    # merge_asof takes the last row of a date looking back and the first looking ahead
+    right = right.sort_values(["_T"] + list(order_cols), kind = "stable")
+    right = right[on + ["_T", obs_date] + obs_cols].rename(columns = out_names)
+
+    has_date = left["_T"].notna()
+    matched = pd.merge_asof(
+        left[has_date].sort_values("_T", kind = "stable")[["_ROW", "_T"] + on],
+        right,
+        on = "_T",
+        by = on,
+        direction = {"before": "backward", "after": "forward", "nearest": "nearest"}[direction],
+        tolerance = pd.Timedelta(days = tolerance) if tolerance is not None else None
+    )
+    matched = matched.drop(columns = on + ["_T"]).set_index("_ROW")
+    out = left.drop(columns = ["_T"]).join(matched, on = "_ROW").drop(columns = ["_ROW"])
+    days = pd.to_datetime(out[prefix + obs_date]) - pd.to_datetime(out[anchor_date])
+    out.insert(out.columns.get_loc(prefix + obs_date) + 1, prefix + "DAYS", days.dt.days.astype("Int64"))
+    return out
@@ -0,0 +1,75 @@
+# time-windowed event pairing without the per-patient cross product of a join on the key alone:
+# the earliest right_date in [lo, hi] days after each left row, as a sorted as-of match (one window
+# pass over the key's events) instead of a join and a min. it comes as plain sql (snowflake and
+# duckdb, see cohort_sql_utils) and as snowpark DataFrame ops (ktx_tbl1)
+
+def gen_first_in_window_sql(
+    left, #table name or "(select ...)" subquery
+    right, #table name or "(select ...)" subquery
+    on, #join key column, present in both
+    left_date, #date column of left
+    right_date, #date column of right
+    lo, #window start in days from left_date, inclusive
+    hi, #window end in days from left_date, inclusive
+    out_col, #name of the added column, null when nothing falls in the window
+    inner = False #True: drop left rows without a match, like an inner join
+):
+    # every left row becomes a probe at left_date+lo among the key's right events; the min of the
+    # right dates from the probe onwards is the next event, kept if it is within hi days
+    return f"""
+        select l.*, case when datediff('day',l.{left_date},w.NEXT_DATE) <= {int(hi)} then w.NEXT_DATE end as {out_col}
+        from {left} l
+        {"join" if inner else "left join"} (
+            select {on}, _T, NEXT_DATE from (
+                select {on}, _T, _SRC,
+                       min(_R) over (partition by {on} order by _T, _SRC rows between current row and unbounded following) as NEXT_DATE
+                from (
+                    select distinct {on}, {left_date} + {int(lo)} as _T, 0 as _SRC, cast(null as date) as _R from {left}
+                    union all
+                    select {on}, {right_date} as _T, 1 as _SRC, {right_date} as _R from {right}
+                    where {on} in (select {on} from {left})
+                ) u
+            ) p
+            where _SRC = 0
+        ) w on l.{on} = w.{on} and l.{left_date} + {int(lo)} = w._T
+        {f"where datediff('day',l.{left_date},w.NEXT_DATE) <= {int(hi)}" if inner else ""}
+    """
+
+def first_in_window(
+    left, #snowpark DataFrame
+    right, #snowpark DataFrame
+    on, #join key column, present in both
+    left_date, #date column of left
+    right_date, #date column of right
+    lo, #window start in days from left_date, inclusive
+    hi, #window end in days from left_date, inclusive
+    out_col, #name of the added column, null when nothing falls in the window
+    inner = False #True: drop left rows without a match
+):
+    # snowpark version of gen_first_in_window_sql
+    from snowflake.snowpark.functions import col, lit, dateadd, datediff, when, min as s_min
+    from snowflake.snowpark.types import DateType
+    from snowflake.snowpark.window import Window
+    probe = (
+        left.select(col(on), dateadd("day", lit(int(lo)), col(left_date)).alias("_T")).distinct()
+            .with_column("_SRC", lit(0))
+            .with_column("_R", lit(None).cast(DateType()))
+    )
+    events = (
+        right.join(left.select(on).distinct(), on, "leftsemi")
+            .select(col(on), col(right_date).alias("_T"), lit(1).alias("_SRC"), col(right_date).alias("_R"))
+    )
+    w = Window.partition_by(col(on)).order_by(col("_T"), col("_SRC")).rows_between(Window.CURRENT_ROW, Window.UNBOUNDED_FOLLOWING)
+    nxt = (
+        probe.union_all_by_name(events)
+            .with_column("NEXT_DATE", s_min(col("_R")).over(w))
+            .filter(col("_SRC") == 0)
+            .select(on, "_T", "NEXT_DATE")
+    )
+    out = (
+        left.with_column("_T", dateadd("day", lit(int(lo)), col(left_date)))
+            .join(nxt, [on, "_T"], "inner" if inner else "left")
+            .with_column(out_col, when(datediff("day", col(left_date), col("NEXT_DATE")) <= int(hi), col("NEXT_DATE")))
+            .drop("_T", "NEXT_DATE")
+    )
+    return out.filter(col(out_col).is_not_null()) if inner else out
@@ -0,0 +1,373 @@
+# cohort tables as plain sql that runs on both snowflake and duckdb: only ansi casts, coalesce,
+# year() and datediff('<part>', start, end), which both engines read the same way
+from .band_join_utils import gen_first_in_window_sql
+from .asof_join_utils import gen_asof_sql
+from .sample_utils import gen_sample_predicate
+
+def gen_pat_demo_sql(
+    site, #site acronym, "CMS" for the medicare cdm
+    cdm_db = "GROUSE_DEID_DB", #database holding the site cdm schemas
+    tgt_tbl = "PAT_DEMO_LONG", #table the site rows are inserted into
+    sample_pct = None #keep a stable hash-based percent of patients, see sample_utils
+):
+    # same logic as the get_pat_demo stored procedure in src/SQL/pat_tbl1.sql
+    site_cdm = 'CMS_PCORNET_CDM' if site == 'CMS' else 'PCORNET_CDM_' + site
+    cms_ind = 1 if site == 'CMS' else 0
+    return f"""
+        INSERT INTO {tgt_tbl}
+            WITH cte_enc_age AS (
+                SELECT d.patid,
+                    d.birth_date,
+                    cast(e.admit_date as date) as index_date,
+                    e.enc_type as index_enc_type,
+                    round(datediff('day',cast(d.birth_date as date),cast(e.admit_date as date))/365.25) AS age_at_index,
+                    case when d.sex in ('NI','UN','OT') then NULL else d.sex end as sex,
+                    case when d.race in ('NI','UN','07','OT') then NULL else d.race end as race,
+                    case when d.hispanic in ('NI','UN','R','OT') then NULL else d.hispanic end as hispanic,
+                    '{site}' as index_src,
+                    max(coalesce(cast(e.discharge_date as date),cast(e.admit_date as date),current_date)) over (partition by e.patid) as censor_date,
+                    max(dth.death_date) over (partition by e.patid) as death_date
+                FROM {cdm_db}.{site_cdm}.V_DEID_DEMOGRAPHIC d
+                JOIN {cdm_db}.{site_cdm}.V_DEID_ENCOUNTER e ON d.PATID = e.PATID
+                LEFT JOIN {cdm_db}.{site_cdm}.V_DEID_DEATH dth on d.PATID = dth.PATID
+                WHERE d.patid is not null and {gen_sample_predicate(sample_pct, 'd.patid')} and coalesce(cast(e.discharge_date as date),cast(e.admit_date as date),current_date) <= current_date
+            )
+            SELECT DISTINCT
+                 cte.patid
+                ,cte.birth_date
+                ,cte.index_date
+                ,cte.index_enc_type
+                ,cte.age_at_index
+                ,cte.sex
+                ,cte.race
+                ,cte.hispanic
+                ,cte.index_src
+                ,coalesce(death_date,censor_date) as censor_date
+                ,case when death_date is not null then 1 else 0 end as death_ind
+                ,{cms_ind} as cms_ind
+            FROM cte_enc_age cte
+    """
+
+def gen_pat_demo_ddl(tgt_tbl = "PAT_DEMO_LONG"):
+    return f"""
+        create or replace table {tgt_tbl} (
+            PATID varchar(50) NOT NULL,
+            BIRTH_DATE date,
+            INDEX_DATE date,
+            INDEX_ENC_TYPE varchar(3),
+            AGE_AT_INDEX integer,
+            SEX varchar(3),
+            RACE varchar(6),
+            HISPANIC varchar(20),
+            INDEX_SRC varchar(20),
+            CENSOR_DATE date,
+            DEATH_IND integer,
+            CMS_IND integer
+        )
+    """
+
+def gen_pat_table1_sql(
+    cms = True, #False when the medicare enrollment table is not available, enrollment columns are left empty
+    cdm_db = "GROUSE_DEID_DB", #database holding the cms cdm schema
+    demo_tbl = "PAT_DEMO_LONG" #long demographic table, see gen_pat_demo_sql
+):
+    # same logic as the PAT_TABLE1 ctas in src/SQL/pat_tbl1.sql
+    enr_tbl = f"{cdm_db}.CMS_PCORNET_CDM.V_DEID_ENROLLMENT"
+    cms_cte = f"""
+        , cte_partab as (
+            select patid,
+                   min(enr_start_date) as partab_start_date,
+                   max(coalesce(enr_end_date,enr_start_date)) as partab_end_date,
+                   max(case when chart = 'Y' then 1 else 0 end) as xwalk_ind
+            from {enr_tbl}
+            where enr_basis = 'I'
+            group by patid
+        ), cte_partd as (
+            select patid,
+                   min(enr_start_date) as partd_start_date,
+                   max(coalesce(enr_end_date,enr_start_date)) as partd_end_date
+            from {enr_tbl}
+            where enr_basis = 'D'
+            group by patid
+        ), cte_partc as (
+            select distinct patid, 1 as PARTC_IND
+            from {enr_tbl}
+            where raw_basis = 'C'
+        )
+    """ if cms else ""
+    cms_cols = """
+          ,coalesce(ab.xwalk_ind,0) as xwalk_ind
+          ,ab.partab_start_date
+          ,ab.partab_end_date
+          ,case when d.partd_start_date is not null then 1 else 0 end as partd_ind
+          ,d.partd_start_date
+          ,d.partd_end_date
+    """ if cms else """
+          ,0 as xwalk_ind
+          ,cast(null as date) as partab_start_date
+          ,cast(null as date) as partab_end_date
+          ,0 as partd_ind
+          ,cast(null as date) as partd_start_date
+          ,cast(null as date) as partd_end_date
+    """
+    cms_join = """
+    left join cte_partab ab on a.patid = ab.patid
+    left join cte_partc ma on a.patid = ma.patid
+    left join cte_partd d on a.patid = d.patid
+    """ if cms else ""
+    return f"""
+    with cte_ord as (
+        select a.*,
+               row_number() over (partition by a.patid order by a.index_date,a.cms_ind desc) as rn
+        from {demo_tbl} a
+    ), cte_ehr as (
+        select patid,
+               min(index_date) as ehr_start_date,
+               max(index_date) as ehr_end_date
+        from {demo_tbl}
+        where cms_ind = 0
+        group by patid
+    ) {cms_cte}
+    select a.patid
+          ,a.birth_date
+          ,a.index_date
+          ,year(a.index_date) as index_year
+          ,a.age_at_index
+          ,case when a.age_at_index is null then 'NI'
+                when a.age_at_index < 19 then 'agegrp1'
+                when a.age_at_index >= 19 and a.age_at_index < 24 then 'agegrp2'
+                when a.age_at_index >= 25 and a.age_at_index < 85 then 'agegrp' || cast(floor((a.age_at_index - 25)/5) + 3 as integer)
+                else 'agegrp15' end as agegrp_at_index
+          ,a.sex
+          ,CASE WHEN a.race IN ('05') THEN 'white'
+                WHEN a.race IN ('03') THEN 'black'
+                WHEN a.race IN ('02') THEN 'asian'
+                WHEN a.race IN ('01','04','06','OT') THEN 'other'
+                ELSE 'NI' END AS race
+          ,CASE WHEN a.hispanic = 'Y' THEN 'hispanic'
+                WHEN a.hispanic = 'N' THEN 'non-hispanic'
+                ELSE 'NI' END AS hispanic
+          ,a.index_enc_type
+          ,a.index_src
+          ,a.censor_date
+          ,year(a.censor_date) as censor_year
+          ,a.death_ind
+          {cms_cols}
+          ,case when ehr.ehr_start_date is not null then 1 else 0 end as ehr_ind
+          ,ehr.ehr_start_date
+          ,ehr.ehr_end_date
+          ,{"coalesce(ma.PARTC_IND,0)" if cms else "0"} as PARTC_IND
+    from cte_ord a
+    left join cte_ehr ehr on a.patid = ehr.patid
+    {cms_join}
+    where a.rn = 1
+    """
+
+def create_pat_table1(
+    session, #snowpark session or DuckSession
+    sites, #list of site acronyms, "CMS" included if the medicare cdm is attached
+    tgt_tbl = "PAT_TABLE1",
+    sample_pct = None #see gen_pat_demo_sql
+):
+    session.sql(gen_pat_demo_ddl()).collect()
+    for site in sites:
+        session.sql(gen_pat_demo_sql(site, sample_pct = sample_pct)).collect()
+    session.sql(f"create or replace table {tgt_tbl} as {gen_pat_table1_sql(cms = 'CMS' in sites)}").collect()
+
+def gen_ktx_idx_sql(
+    log_tbl_dxpx = "KTX_DXPX_LONG",
+    study_start = "2014-01-01",
+    study_end = "2023-12-31"
+):
+    # first inpatient ktx in the study window per patient, with its site
+    return f"""
+        select PATID, KTX_DATE1, SITE from (
+            select PATID, CD_DATE as KTX_DATE1, SITE,
+                   row_number() over (partition by PATID order by CD_DATE) as rn
+            from {log_tbl_dxpx}
+            where PHE_TYPE in ('KTx') and ENC_TYPE in ('EI','IP') and CD_DATE between date '{study_start}' and date '{study_end}'
+        ) x where rn = 1
+    """
+
+def gen_ktx_tbl1_sql(
+    log_tbl_dxpx = "KTX_DXPX_LONG", #long dx/px event table, see event_log.py
+    log_tbl_rx = "KTX_RX_LONG", #long rx event table, see event_log.py
+    pat_tbl = "PAT_TABLE1", #patient table 1, see src/SQL/pat_tbl1.sql
+    study_start = "2014-01-01", #study window, inclusive
+    study_end = "2023-12-31",
+    single_pass = False, #True: one scan of the dx/px long table, see gen_ktx_tbl1_single_pass_sql
+    ktx_idx_tbl = None #table already holding gen_ktx_idx_sql, e.g. a ResultCache entry; None to derive it inline
+):
+    # same steps and output as the snowpark derivation in ktx_tbl1.py
+    if single_pass:
+        return gen_ktx_tbl1_single_pass_sql(log_tbl_dxpx, log_tbl_rx, pat_tbl, study_start, study_end)
+    study_window = f"CD_DATE between date '{study_start}' and date '{study_end}'"
+    ktx_idx = f"select PATID, KTX_DATE1, SITE from {ktx_idx_tbl}" if ktx_idx_tbl else gen_ktx_idx_sql(log_tbl_dxpx, study_start, study_end)
+    # first biopsy within 180 days of the ktx, first rx within 7 days of the biopsy: as-of matches
+    # rather than joins on PATID alone, see band_join_utils
+    rbx_first = gen_first_in_window_sql(
+        "ktx_idx", f"(select PATID, CD_DATE from {log_tbl_dxpx} where PHE_TYPE in ('RenalBiopsy') and {study_window})",
+        "PATID", "KTX_DATE1", "CD_DATE", 0, 180, "RBX_DATE1", inner = True
+    )
+    antirej_first = gen_first_in_window_sql(
+        "biopsy_idx", log_tbl_rx, "PATID", "RBX_DATE1", "CD_DATE", 0, 7, "ANTIREJ_DATE1", inner = True
+    )
+    return f"""
+    with ktx_idx as (
+        {ktx_idx}
+    ), dm_idx as (
+        select PATID, min(CD_DATE) as DM_DATE1
+        from {log_tbl_dxpx}
+        where PHE_TYPE in ('T2DM') and {study_window}
+        group by PATID
+    ), nodat as (
+        select k.PATID, d.DM_DATE1, datediff('day',k.KTX_DATE1,d.DM_DATE1) as DAYS_TO_NODAT
+        from ktx_idx k
+        join dm_idx d on k.PATID = d.PATID
+        where d.DM_DATE1 > k.KTX_DATE1
+    ), mi_ae as (
+        select k.PATID, min(m.CD_DATE) as MI_DATE1, min(datediff('day',k.KTX_DATE1,m.CD_DATE)) as DAYS_TO_MI
+        from ktx_idx k
+        join {log_tbl_dxpx} m on k.PATID = m.PATID
+        where m.PHE_TYPE in ('MI') and m.ENC_TYPE in ('EI','IP') and m.{study_window} and m.CD_DATE > k.KTX_DATE1
+        group by k.PATID
+    ), biopsy_idx as (
+        select PATID, RBX_DATE1, datediff('day',KTX_DATE1,RBX_DATE1) as DAYS_TO_RBX from (
+            {rbx_first}
+        ) x
+    ), ar_ae as (
+        select PATID, RBX_DATE1, DAYS_TO_RBX, ANTIREJ_DATE1 from (
+            {antirej_first}
+        ) x
+    )
+    select k.PATID
+          ,k.KTX_DATE1 as INDEX_DATE
+          ,k.SITE as KTX_SITE
+          ,n.DM_DATE1
+          ,n.DAYS_TO_NODAT
+          ,case when n.DM_DATE1 is not null then 1 else 0 end as NODAT_IND
+          ,m.MI_DATE1
+          ,m.DAYS_TO_MI
+          ,case when m.MI_DATE1 is not null then 1 else 0 end as MI_IND
+          ,a.RBX_DATE1
+          ,a.DAYS_TO_RBX
+          ,a.ANTIREJ_DATE1
+          ,datediff('day',a.RBX_DATE1,a.ANTIREJ_DATE1) as DAYS_RBX_TO_ANTIREJ
+          ,case when a.RBX_DATE1 is not null then 1 else 0 end as AR_IND
+          ,p.SEX
+          ,p.RACE
+          ,p.HISPANIC
+          ,datediff('year',p.BIRTH_DATE,k.KTX_DATE1) as AGE_AT_KTX
+          ,p.DEATH_IND
+          ,p.CENSOR_DATE
+          ,datediff('day',k.KTX_DATE1,p.CENSOR_DATE) as DAYS_TO_CENSOR
+          ,p.INDEX_SRC as SRC_SITE
+    from ktx_idx k
+    left join nodat n on k.PATID = n.PATID
+    left join mi_ae m on k.PATID = m.PATID
+    left join ar_ae a on k.PATID = a.PATID
+    join {pat_tbl} p on k.PATID = p.PATID
+    """
+
+def gen_ktx_tbl1_single_pass_sql(
+    log_tbl_dxpx = "KTX_DXPX_LONG",
+    log_tbl_rx = "KTX_RX_LONG",
+    pat_tbl = "PAT_TABLE1",
+    study_start = "2014-01-01",
+    study_end = "2023-12-31"
+):
+    # same output as gen_ktx_tbl1_sql, but ktx index, first T2DM, first post-ktx MI and first biopsy
+    # within 180 days come from one scan of the dx/px table: the ktx date is spread over the
+    # patient's rows with a window min, then each event is a conditional min per patient.
+    # the anti-rejection rx still needs the rx table, matched only for patients with a biopsy
+    ktx_cond = "PHE_TYPE = 'KTx' and ENC_TYPE in ('EI','IP')"
+    return f"""
+    with ev as (
+        select PATID, PHE_TYPE, ENC_TYPE, CD_DATE, SITE,
+               min(case when {ktx_cond} then CD_DATE end) over (partition by PATID) as KTX_DATE1
+        from {log_tbl_dxpx}
+        where PHE_TYPE in ('KTx','T2DM','MI','RenalBiopsy')
+          and CD_DATE between date '{study_start}' and date '{study_end}'
+    ), pat_ev as (
+        select PATID,
+               min(KTX_DATE1) as KTX_DATE1,
+               min_by(SITE, case when {ktx_cond} then CD_DATE end) as KTX_SITE,
+               min(case when PHE_TYPE = 'T2DM' then CD_DATE end) as DM_ANY_DATE1,
+               min(case when PHE_TYPE = 'MI' and ENC_TYPE in ('EI','IP') and CD_DATE > KTX_DATE1 then CD_DATE end) as MI_DATE1,
+               min(case when PHE_TYPE = 'RenalBiopsy' and datediff('day',KTX_DATE1,CD_DATE) between 0 and 180 then CD_DATE end) as RBX_DATE1
+        from ev
+        where KTX_DATE1 is not null
+        group by PATID
+    ), bx as (
+        select PATID, RBX_DATE1 from pat_ev where RBX_DATE1 is not null
+    ), ar_ae as (
+        select PATID, ANTIREJ_DATE1 from (
+            {gen_first_in_window_sql("bx", log_tbl_rx, "PATID", "RBX_DATE1", "CD_DATE", 0, 7, "ANTIREJ_DATE1", inner = True)}
+        ) x
+    ), k as (
+        select e.*,
+               -- NODAT only if the first T2DM code in the window comes after the transplant
+               case when e.DM_ANY_DATE1 > e.KTX_DATE1 then e.DM_ANY_DATE1 end as DM_DATE1,
+               a.ANTIREJ_DATE1,
+               case when a.ANTIREJ_DATE1 is not null then e.RBX_DATE1 end as AR_RBX_DATE1
+        from pat_ev e
+        left join ar_ae a on e.PATID = a.PATID
+    )
+    select k.PATID
+          ,k.KTX_DATE1 as INDEX_DATE
+          ,k.KTX_SITE
+          ,k.DM_DATE1
+          ,datediff('day',k.KTX_DATE1,k.DM_DATE1) as DAYS_TO_NODAT
+          ,case when k.DM_DATE1 is not null then 1 else 0 end as NODAT_IND
+          ,k.MI_DATE1
+          ,datediff('day',k.KTX_DATE1,k.MI_DATE1) as DAYS_TO_MI
+          ,case when k.MI_DATE1 is not null then 1 else 0 end as MI_IND
+          ,k.AR_RBX_DATE1 as RBX_DATE1
+          ,datediff('day',k.KTX_DATE1,k.AR_RBX_DATE1) as DAYS_TO_RBX
+          ,k.ANTIREJ_DATE1
+          ,datediff('day',k.AR_RBX_DATE1,k.ANTIREJ_DATE1) as DAYS_RBX_TO_ANTIREJ
+          ,case when k.AR_RBX_DATE1 is not null then 1 else 0 end as AR_IND
+          ,p.SEX
+          ,p.RACE
+          ,p.HISPANIC
+          ,datediff('year',p.BIRTH_DATE,k.KTX_DATE1) as AGE_AT_KTX
+          ,p.DEATH_IND
+          ,p.CENSOR_DATE
+          ,datediff('day',k.KTX_DATE1,p.CENSOR_DATE) as DAYS_TO_CENSOR
+          ,p.INDEX_SRC as SRC_SITE
+    from k
+    join {pat_tbl} p on k.PATID = p.PATID
+    """
+
+# index-anchored measures of KTX_OBS_IDX: (column prefix, ALL_OBS filter, direction, tolerance in days)
+OBS_IDX_MEASURES = [
+    ("WT", "OBS_NAME = 'WT' and OBS_TYPE = 'vital'", "nearest", None),
+    ("HT", "OBS_NAME = 'HT' and OBS_TYPE = 'vital'", "nearest", None),
+    ("BMI", "OBS_NAME = 'BMI' and OBS_TYPE = 'vital'", "nearest", None),
+    ("SCR", "OBS_NAME = 'SCr'", "before", 365),
+    ("TAC", "OBS_NAME = 'Tacrolimus'", "after", 90)
+]
+
+def gen_obs_idx_sql(
+    measures = OBS_IDX_MEASURES, #see OBS_IDX_MEASURES
+    ref_cohort = "KTX_TBL1", #one row per PATID with the anchor date
+    obs_tbl = "ALL_OBS", #long observation table, see obs_extract.py
+    anchor_date = "INDEX_DATE"
+):
+    # one row per cohort patient, the as-of matched value, unit, date and days from index of each measure;
+    # replaces the exact-date self-joins of SEL_OBS_BMI/BMI_IDX in src/SQL/pat_obs.sql
+    ctes = [f"anc as (select PATID, {anchor_date} from {ref_cohort})"]
+    cols, joins = [], []
+    for name, flt, direction, tolerance in measures:
+        obs = f"(select PATID, OBS_DATE, OBS_NUM, OBS_UNIT from {obs_tbl} where {flt} and OBS_NUM is not null)"
+        ctes.append(f"""m_{name} as (
+            {gen_asof_sql("anc", obs, "PATID", anchor_date, "OBS_DATE", ["OBS_NUM", "OBS_UNIT"], direction, tolerance, order_cols = ["OBS_NUM"], prefix = "_")}
+        )""")
+        cols.append(f"m_{name}._OBS_NUM as {name}, m_{name}._OBS_UNIT as {name}_UNIT, m_{name}._OBS_DATE as {name}_DATE, m_{name}._DAYS as {name}_DAYS")
+        joins.append(f"left join m_{name} on m_{name}.PATID = a.PATID")
+    return f"""
+    with {', '.join(ctes)}
+    select a.PATID, a.{anchor_date}, {', '.join(cols)}
+    from anc a
+    {' '.join(joins)}
+    """
@@ -0,0 +1,161 @@
+import os
+import glob
+import threading
+from datetime import datetime, timezone
+
+# local execution backend: a duckdb database standing in for the snowflake session, with the
+# site extracts attached as GROUSE_DEID_DB.PCORNET_CDM_<SITE>.V_DEID_<TABLE> views over parquet
+# files laid out as <cdm_root>/<SITE>/<TABLE>.parquet (or <cdm_root>/<SITE>/<TABLE>/*.parquet)
+
+class DuckSession:
+    def __init__(
+        self,
+        database = ":memory:", #duckdb database file, or ":memory:"
+        cdm_root = None, #root folder of the parquet extracts, one subfolder per site; can be attached later
+        cdm_db = "GROUSE_DEID_DB", #database name the site schemas are attached under
+        threads = None #duckdb threads per query, None for the duckdb default
+    ):
+        import duckdb
+        self.con = duckdb.connect(database)
+        if threads is not None:
+            self.con.execute(f"SET threads = {int(threads)}")
+        self.cdm_db = cdm_db
+        self.src_files = {}
+        self.sites = []
+        self.database = self.con.execute("SELECT current_database()").fetchone()[0]
+        self.schema = "main"
+        self._local = threading.local()
+        if cdm_root is not None:
+            self.attach_cdm(cdm_root)
+
+    def _cursor(self):
+        # a duckdb connection is not thread-safe, so each worker thread gets its own cursor
+        # on the same database, pointed at the current database and schema
+        cur = getattr(self._local, "cur", None)
+        if cur is None or getattr(self._local, "use", None) != (self.database, self.schema):
+            if cur is None:
+                cur = self._local.cur = self.con.cursor()
+            cur.execute(f"USE {self.database}.{self.schema}")
+            self._local.use = (self.database, self.schema)
+        return cur
+
+    def sql(self, query, params = None):
+        return DuckSqlResult(self, query, params)
+
+    def use_database(self, database):
+        self.database = database
+        self.schema = "main"
+
+    def use_schema(self, schema):
+        self.con.execute(f"CREATE SCHEMA IF NOT EXISTS {self.database}.{schema}")
+        self.schema = schema
+
+    def write_pandas(
+        self,
+        df, #pandas DataFrame
+        table_name, #target table
+        auto_create_table = True, #create the table if it does not exist
+        overwrite = False, #replace the table instead of appending
+        table_type = "" #accepted for snowpark compatibility; duckdb temporary tables are not visible to other cursors, so a regular table is created
+    ):
+        cur = self._cursor()
+        cur.register("_write_pandas_df", df)
+        try:
+            if overwrite:
+                cur.execute(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM _write_pandas_df")
+            elif auto_create_table:
+                cur.execute(f"CREATE TABLE IF NOT EXISTS {table_name} AS SELECT * FROM _write_pandas_df LIMIT 0")
+                cur.execute(f"INSERT INTO {table_name} SELECT * FROM _write_pandas_df")
+            else:
+                cur.execute(f"INSERT INTO {table_name} SELECT * FROM _write_pandas_df")
+        finally:
+            cur.unregister("_write_pandas_df")
+
+    def attach_cdm(
+        self,
+        cdm_root, #root folder of the parquet extracts
+        sites = None #subset of site folders to attach, None for all
+    ):
+        attached = {r[0] for r in self.con.execute("SELECT database_name FROM duckdb_databases()").fetchall()}
+        if self.cdm_db not in attached:
+            self.con.execute(f"ATTACH ':memory:' AS {self.cdm_db}")
+        for site in sorted(os.listdir(cdm_root)):
+            site_dir = os.path.join(cdm_root, site)
+            if not os.path.isdir(site_dir) or (sites is not None and site not in sites):
+                continue
+            # same schema naming as the snowflake share
+            schema = "CMS_PCORNET_CDM" if site == "CMS" else "PCORNET_CDM_" + site
+            self.con.execute(f"CREATE SCHEMA IF NOT EXISTS {self.cdm_db}.{schema}")
+            if site not in self.sites:
+                self.sites.append(site)
+            for path in sorted(os.listdir(site_dir)):
+                full_path = os.path.join(site_dir, path)
+                if path.endswith(".parquet"):
+                    tbl, files = path[:-len(".parquet")].upper(), [full_path]
+                elif os.path.isdir(full_path):
+                    tbl, files = path.upper(), glob.glob(os.path.join(full_path, "*.parquet"))
+                else:
+                    continue
+                if len(files) == 0:
+                    continue
+                view_name = f"{self.cdm_db}.{schema}.V_DEID_{tbl}"
+                src = full_path if len(files) == 1 and full_path in files else os.path.join(full_path, "*.parquet")
+                self.con.execute(f"CREATE OR REPLACE VIEW {view_name} AS SELECT * FROM read_parquet('{src}')")
+                self.src_files[view_name.upper()] = files
+
+    def attach_srtr(
+        self,
+        srtr_root, #parquet root written by sas_ingest_utils.ingest_sas, one folder per table
+        srtr_db = "SRTR_DB", #database the tables are attached under
+        schema = "PUBSAF"
+    ):
+        # SRTR_DB.PUBSAF.<TABLE> views over the partitioned files, the year partitions read back as columns
+        attached = {r[0] for r in self.con.execute("SELECT database_name FROM duckdb_databases()").fetchall()}
+        if srtr_db not in attached:
+            self.con.execute(f"ATTACH ':memory:' AS {srtr_db}")
+        self.con.execute(f"CREATE SCHEMA IF NOT EXISTS {srtr_db}.{schema}")
+        for tbl in sorted(os.listdir(srtr_root)):
+            files = glob.glob(os.path.join(srtr_root, tbl, "**", "*.parquet"), recursive = True)
+            if not os.path.isdir(os.path.join(srtr_root, tbl)) or len(files) == 0:
+                continue
+            view_name = f"{srtr_db}.{schema}.{tbl.upper()}"
+            src = os.path.join(srtr_root, tbl, "**", "*.parquet")
+            self.con.execute(f"CREATE OR REPLACE VIEW {view_name} AS SELECT * FROM read_parquet('{src}', hive_partitioning = true, union_by_name = true)")
+            self.src_files[view_name.upper()] = files
+
+    def get_src_version(self, srctbl_name):
+        # latest modification time of the parquet files behind an attached view
+        files = self.src_files.get(srctbl_name.upper())
+        if not files:
+            return None
+        mtime = max(os.path.getmtime(f) for f in files)
+        return datetime.fromtimestamp(mtime, timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class DuckSqlResult:
+    def __init__(self, session, query, params = None):
+        self.session = session
+        self.query = query
+        self.params = params
+
+    def _execute(self):
+        return self.session._cursor().execute(self.query, self.params)
+
+    def collect(self):
+        return self._execute().fetchall()
+
+    def to_pandas(self):
+        return self._execute().df()
+
+    def to_pandas_batches(self, batch_rows = 1000000):
+        # same role as snowpark's DataFrame.to_pandas_batches: the result streamed in bounded chunks
+        for batch in self._execute().fetch_record_batch(batch_rows):
+            yield batch.to_pandas()
@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+
+# eGFR trajectories from the serum creatinine rows of ALL_OBS (see obs_extract.py), by the race-free
+# CKD-EPI 2021 creatinine equation:
+#   142 * min(scr/k, 1)^a * max(scr/k, 1)^-1.200 * 0.9938^age [* 1.012 if female]
+#   k = 0.7 (F) / 0.9 (M), a = -0.241 (F) / -0.302 (M), scr in mg/dL, age in years
+# creatinine is converted to mg/dL through a unit lookup, falling back on the unit implied by the
+# loinc code when the reported unit is missing or unknown; age and sex come from PAT_TABLE1.
+# rows that cannot be scored (no usable unit, implausible value, under 18, sex not F/M) are kept
+# with a null EGFR. two set-based versions, same output:
+#  - gen_egfr_sql: one statement, for snowflake or duckdb
+#  - egfr_df: vectorized numpy over a DataFrame (or each batch of a streamed one)
+
+UMOL_PER_MG = 88.4
+
+# reported unit, lowercased and trimmed: factor to mg/dL
+SCR_UNIT_FACTORS = {
+    "mg/dl": 1.0,
+    "mg/100ml": 1.0,
+    "mg%": 1.0,
+    "umol/l": 1 / UMOL_PER_MG,
+    "µmol/l": 1 / UMOL_PER_MG,
+    "μmol/l": 1 / UMOL_PER_MG,
+    "micromol/l": 1 / UMOL_PER_MG,
+    "mmol/l": 1000 / UMOL_PER_MG
+}
+# loinc code: factor to mg/dL of the unit the code is defined in
+SCR_LOINC_FACTORS = {
+    "2160-0": 1.0,
+    "38483-4": 1.0,
+    "14682-9": 1 / UMOL_PER_MG,
+    "59826-8": 1 / UMOL_PER_MG
+}
+# plausible creatinine, mg/dL
+SCR_RANGE = (0.1, 30.0)
+# sex: (kappa, alpha, sex factor)
+CKD_EPI_2021 = {
+    "F": (0.7, -0.241, 1.012),
+    "M": (0.9, -0.302, 1.0)
+}
+MIN_AGE = 18
+
+EGFR_COLS = ["PATID", "OBS_DATE", "DAYS_SINCE_INDEX", "OBS_CODE", "SCR", "SCR_UNIT", "SCR_MGDL", "SEX", "AGE", "EGFR", "OBS_SRC"]
+
+def _values_sql(d):
+    return ', '.join(f"('{k}', {v!r})" for k, v in d.items())
+
+def gen_egfr_sql(
+    obs_tbl = "ALL_OBS", #long observation table, see obs_extract.py
+    pat_tbl = "PAT_TABLE1", #one row per PATID with BIRTH_DATE and SEX
+    scr_filter = "OBS_NAME = 'SCr'", #creatinine rows of obs_tbl, the SCr loinc valueset of ./ref/vs-cde-kd.json
+    unit_factors = SCR_UNIT_FACTORS,
+    loinc_factors = SCR_LOINC_FACTORS
+):
+    # one row per creatinine observation with EGFR_COLS; the lookups are inline values, joined by hash
+    case_sex = lambda i: f"case s.SEX {' '.join(f'when {chr(39)}{k}{chr(39)} then {v[i]}' for k, v in CKD_EPI_2021.items())} end"
+    return f"""
+    select s.PATID, s.OBS_DATE, s.DAYS_SINCE_INDEX, s.OBS_CODE, s.SCR, s.SCR_UNIT, s.SCR_MGDL, s.SEX, s.AGE,
+           case when s.SEX in ({', '.join(f"'{k}'" for k in CKD_EPI_2021)}) and s.AGE >= {MIN_AGE}
+                 and s.SCR_MGDL between {SCR_RANGE[0]} and {SCR_RANGE[1]}
+                then 142 * power(least(s.SCR_MGDL / {case_sex(0)}, 1), {case_sex(1)})
+                         * power(greatest(s.SCR_MGDL / {case_sex(0)}, 1), -1.200)
+                         * power(0.9938, s.AGE) * {case_sex(2)}
+           end as EGFR,
+           s.OBS_SRC
+    from (
+        select o.PATID, o.OBS_DATE, o.DAYS_SINCE_INDEX, o.OBS_CODE, o.OBS_NUM as SCR, o.OBS_UNIT as SCR_UNIT,
+               o.OBS_NUM * coalesce(u.TO_MGDL, l.TO_MGDL) as SCR_MGDL,
+               p.SEX, datediff('day', p.BIRTH_DATE, o.OBS_DATE) / 365.25 as AGE, o.OBS_SRC
+        from {obs_tbl} o
+        left join {pat_tbl} p on p.PATID = o.PATID
+        left join (values {_values_sql(unit_factors)}) u(UNIT_KEY, TO_MGDL) on u.UNIT_KEY = lower(trim(o.OBS_UNIT))
+        left join (values {_values_sql(loinc_factors)}) l(LOINC, TO_MGDL) on l.LOINC = o.OBS_CODE
+        where ({scr_filter}) and o.OBS_NUM is not null
+    ) s
+    """
+
+def scr_to_mgdl(
+    scr, #reported creatinine values
+    unit, #reported units
+    code = None, #loinc codes, for the fallback unit
+    unit_factors = SCR_UNIT_FACTORS,
+    loinc_factors = SCR_LOINC_FACTORS
+):
+    factor = pd.Series(unit, dtype = object).str.strip().str.lower().map(unit_factors)
+    if code is not None:
+        factor = factor.fillna(pd.Series(code, dtype = object).map(loinc_factors))
+    return np.asarray(scr, dtype = float) * factor.to_numpy(dtype = float, na_value = np.nan)
+
+def ckd_epi_2021(
+    scr_mgdl, #creatinine, mg/dL
+    age, #age in years
+    sex #"F"/"M", anything else gives nan
+):
+    scr = np.asarray(scr_mgdl, dtype = float)
+    age = np.asarray(age, dtype = float)
+    sex = np.asarray(sex, dtype = object)
+    female, male = sex == "F", sex == "M"
+    pick = lambda i: np.where(female, CKD_EPI_2021["F"][i], CKD_EPI_2021["M"][i])
+    ok = (female | male) & (age >= MIN_AGE) & (scr >= SCR_RANGE[0]) & (scr <= SCR_RANGE[1])
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        r = scr / pick(0)
+        egfr = 142 * np.minimum(r, 1) ** pick(1) * np.maximum(r, 1) ** -1.200 * 0.9938 ** age * pick(2)
+    return np.where(ok, egfr, np.nan)
+
+def egfr_df(
+    obs, #ALL_OBS rows, already restricted to creatinine
+    pat, #PAT_TABLE1 rows (PATID, BIRTH_DATE, SEX), None when obs already carries BIRTH_DATE and SEX
+    unit_factors = SCR_UNIT_FACTORS,
+    loinc_factors = SCR_LOINC_FACTORS
+):
+    # same rows and columns as gen_egfr_sql
+    obs = obs[obs["OBS_NUM"].notna()]
+    if pat is not None:
+        obs = obs.merge(pat[["PATID", "BIRTH_DATE", "SEX"]], on = "PATID", how = "left")
+    days = (pd.to_datetime(obs["OBS_DATE"]) - pd.to_datetime(obs["BIRTH_DATE"])).dt.days
+    out = pd.DataFrame({
+        "PATID": obs["PATID"].to_numpy(),
+        "OBS_DATE": obs["OBS_DATE"].to_numpy(),
+        "DAYS_SINCE_INDEX": obs["DAYS_SINCE_INDEX"].to_numpy(),
+        "OBS_CODE": obs["OBS_CODE"].to_numpy(),
+        "SCR": obs["OBS_NUM"].to_numpy(dtype = float),
+        "SCR_UNIT": obs["OBS_UNIT"].to_numpy(),
+        "SCR_MGDL": scr_to_mgdl(obs["OBS_NUM"].to_numpy(), obs["OBS_UNIT"].to_numpy(), obs["OBS_CODE"].to_numpy(), unit_factors, loinc_factors),
+        "SEX": obs["SEX"].to_numpy(),
+        "AGE": days.to_numpy(dtype = float, na_value = np.nan) / 365.25,
+        "OBS_SRC": obs["OBS_SRC"].to_numpy()
+    })
+    out.insert(out.columns.get_loc("OBS_SRC"), "EGFR", ckd_epi_2021(out["SCR_MGDL"], out["AGE"], out["SEX"]))
+    return out
@@ -0,0 +1,170 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+from datetime import datetime, timezone
+from .result_cache_utils import table_version
+
+# streaming parquet export of the derived tables: one partition per site (or other column), each
+# written batch by batch through arrow so memory stays at about one batch, low-cardinality text
+# columns dictionary-encoded. <out_dir>/<TABLE>/_manifest.json records the finished partitions,
+# so an interrupted export resumes with the partitions that are not done yet, as long as the
+# table has not changed since (table_version); a rebuilt table is exported from scratch
+
+EXPORT_PART_COLS = {
+    "KTX_DXPX_LONG": "SITE",
+    "KTX_RX_LONG": "SITE",
+    "KTX_TBL1": "KTX_SITE",
+    "ALL_OBS": None
+}
+EXPORT_DICT_COLS = ["SITE", "KTX_SITE", "SRC_SITE", "PHE_TYPE", "CD_TYPE", "ENC_TYPE", "OBS_CODE_TYPE", "OBS_NAME", "OBS_SRC"]
+
+def _now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+def _part_dir(part_col, part):
+    # hive-style folder, <col>=<value>; the column itself is left out of the files
+    return f"{part_col}={'__HIVE_DEFAULT_PARTITION__' if part is None else part}" if part_col else "all"
+
+def _load_manifest(path):
+    if os.path.exists(path):
+        with open(path, "r", encoding = "utf-8") as f:
+            return json.load(f)
+    return None
+
+def _save_manifest(path, manifest):
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "w", encoding = "utf-8") as f:
+        json.dump(manifest, f, indent = 4)
+    os.replace(tmp_file, path)
+
+def _arrow_type(data_type, scale = None):
+    # INFORMATION_SCHEMA.COLUMNS data type (snowflake or duckdb) as an arrow type
+    import pyarrow as pa
+    t = str(data_type).upper()
+    if t.startswith(("VARCHAR", "TEXT", "STRING", "CHAR")):
+        return pa.string()
+    if t == "DATE":
+        return pa.date32()
+    if t.startswith(("TIMESTAMP_TZ", "TIMESTAMP_LTZ", "TIMESTAMP WITH TIME ZONE")):
+        return pa.timestamp("us", tz = "UTC")
+    if t.startswith(("TIMESTAMP", "DATETIME")):
+        return pa.timestamp("us")
+    if t.startswith("BOOL"):
+        return pa.bool_()
+    if t in ("BIGINT", "INTEGER", "INT", "SMALLINT", "TINYINT", "HUGEINT", "UBIGINT", "UINTEGER", "USMALLINT", "UTINYINT"):
+        return pa.int64()
+    if t.startswith(("NUMBER", "DECIMAL", "NUMERIC")):
+        return pa.int64() if scale in (0, None) and not re.search(r",\s*[1-9]", t) else pa.float64()
+    if t.startswith(("DOUBLE", "FLOAT", "REAL")):
+        return pa.float64()
+    return pa.string()
+
+def export_schema(
+    session, #snowpark session or DuckSession
+    tbl_name, #table in the current schema
+    exclude = list(), #columns left out, e.g. the partition column
+    dict_cols = EXPORT_DICT_COLS #text columns to dictionary-encode where present
+):
+    # arrow schema of the table from its declared column types, shared by every partition and batch,
+    # so an all-null column or batch is written with the type of the column, not guessed from the data
+    import pyarrow as pa
+    rows = session.sql(f"""
+        SELECT COLUMN_NAME, DATA_TYPE, NUMERIC_SCALE FROM INFORMATION_SCHEMA.COLUMNS
+        WHERE TABLE_CATALOG = current_database() AND TABLE_SCHEMA = current_schema() AND upper(TABLE_NAME) = '{tbl_name.upper()}'
+        ORDER BY ORDINAL_POSITION
+    """).collect()
+    if len(rows) == 0:
+        raise ValueError(f"table {tbl_name} not found in the current schema")
+    fields = []
+    for name, data_type, scale in rows:
+        if name in exclude:
+            continue
+        typ = _arrow_type(data_type, scale)
+        if name in dict_cols and pa.types.is_string(typ):
+            typ = pa.dictionary(pa.int32(), typ)
+        fields.append(pa.field(name, typ))
+    return pa.schema(fields)
+
+def _to_arrow(df, schema):
+    import pyarrow as pa
+    tbl = pa.Table.from_pandas(df, preserve_index = False)
+    return tbl.select(schema.names).cast(schema)
+
+def export_table(
+    session, #snowpark session or DuckSession
+    tbl_name, #table to export
+    out_dir, #export root, the table goes to <out_dir>/<tbl_name>
+    part_col = "", #partition column, "" for the EXPORT_PART_COLS default, None for a single partition
+    dict_cols = EXPORT_DICT_COLS, #text columns to dictionary-encode where present
+    overwrite = False, #start over instead of resuming
+    compression = "zstd",
+    verbose = True
+):
+    import pyarrow.parquet as pq
+    if part_col == "":
+        part_col = EXPORT_PART_COLS.get(tbl_name.upper())
+    tbl_dir = os.path.join(out_dir, tbl_name)
+    manifest_file = os.path.join(tbl_dir, "_manifest.json")
+    qry_hash = hashlib.sha256(
+        f"{tbl_name}|{part_col}|{','.join(dict_cols)}|{compression}|{table_version(session, tbl_name)}".encode("utf-8")
+    ).hexdigest()[:16]
+
+    manifest = None if overwrite else _load_manifest(manifest_file)
+    if manifest is None or manifest.get("qry_hash") != qry_hash:
+        shutil.rmtree(tbl_dir, ignore_errors = True)
+        manifest = {"table": tbl_name, "part_col": part_col, "qry_hash": qry_hash, "started_at": _now(), "partitions": {}}
+    os.makedirs(tbl_dir, exist_ok = True)
+
+    if part_col:
+        parts = [r[0] for r in session.sql(f"SELECT DISTINCT {part_col} FROM {tbl_name}").collect()]
+        parts = sorted(parts, key = lambda x: (x is None, str(x)))
+    else:
+        parts = [None]
+    schema = export_schema(session, tbl_name, exclude = [part_col] if part_col else [], dict_cols = dict_cols)
+
+    for part in parts:
+        key = _part_dir(part_col, part)
+        if manifest["partitions"].get(key, {}).get("status") == "done":
+            continue
+        part_path = os.path.join(tbl_dir, key)
+        shutil.rmtree(part_path, ignore_errors = True)
+        os.makedirs(part_path)
+        if part_col is None:
+            qry = f"SELECT * FROM {tbl_name}"
+        elif part is None:
+            qry = f"SELECT * EXCLUDE ({part_col}) FROM {tbl_name} WHERE {part_col} IS NULL"
+        else:
+            qry = f"SELECT * EXCLUDE ({part_col}) FROM {tbl_name} WHERE {part_col} = '{str(part).replace(chr(39), chr(39)*2)}'"
+
+        # one file per partition, one row group per batch; renamed into place once complete
+        file_path = os.path.join(part_path, "part-0.parquet")
+        writer, n_rows = None, 0
+        try:
+            for df in session.sql(qry).to_pandas_batches():
+                if len(df) == 0:
+                    continue
+                tbl = _to_arrow(df, schema)
+                if writer is None:
+                    writer = pq.ParquetWriter(file_path + ".tmp", schema, compression = compression, use_dictionary = True)
+                writer.write_table(tbl)
+                n_rows += tbl.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is not None:
+            os.replace(file_path + ".tmp", file_path)
+        manifest["partitions"][key] = {
+            "status": "done", "value": part, "rows": n_rows,
+            "files": [os.path.relpath(file_path, tbl_dir)] if writer is not None else [],
+            "updated_at": _now()
+        }
+        _save_manifest(manifest_file, manifest)
+        if verbose:
+            print(f"{tbl_name}/{key}: {n_rows} row(s)")
+
+    manifest["finished_at"] = _now()
+    manifest["rows"] = sum(p["rows"] for p in manifest["partitions"].values())
+    _save_manifest(manifest_file, manifest)
+    return manifest
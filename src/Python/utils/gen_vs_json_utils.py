@@ -1,17 +1,36 @@
 import pandas as pd
+import numpy as np
 import json
 import urllib.request as urlreq
 import os
 import re
+import hashlib
+from .sample_utils import gen_sample_predicate
+
+# bump whenever the predicate compiler changes so stale on-disk artifacts are not reused
+VS_COMPILER_VERSION = "6"
+
+# in-process caches shared by all QueryFromJson instances
+VS_JSON_MEMO = {}
+VS_QRY_REF_MEMO = {}
+CDTYPE_PROMPT_MEMO = {}
+
+# code systems by CDM domain
+DOMAIN_TO_CODES = {
+    "dx":  ["icd9cm", "icd10cm", "snomed", "drg"],
+    "px":  ["icd9proc", "icd10pcs", "cpt", "hpc"],
+    "lab": ["loinc"],
+    "rx":  ["rxnorm", "ndc"]
+}
 
 def split_part_multisql(
-    which_sql, #["snow","postgres","spark","mysql","sqlserver","oracle"]
+    which_sql, #["snow","postgres","spark","mysql","sqlserver","oracle","duckdb"]
     string,
     delimiter,
     index
 ):
     sqlqry = ''
-    if which_sql in ('snow','postgres'):
+    if which_sql in ('snow','postgres','duckdb'):
         sqlqry += '''
             split_part('''+ string +''','''+ "'"+ delimiter +"'"+''','''+ str(index) +''')
         '''
@@ -32,6 +51,89 @@ def split_part_multisql(
 
     return sqlqry
 
+def load_vs_json(
+    url #url or local path to valueset json file
+):
+    # returns (parsed json, content hash); remote files are fetched once per process,
+    # local files are re-read only when they change on disk; a valueset store (see vs_store_utils)
+    # gives all its blocks and its digest
+    from .vs_store_utils import VsStore, is_vs_store
+    if is_vs_store(url):
+        store = VsStore(url)
+        return store.get_blocks(), store.digest()
+    if url.startswith(("http://", "https://")):
+        memo_key = url
+    else:
+        st = os.stat(url)
+        memo_key = (os.path.abspath(url), st.st_mtime_ns, st.st_size)
+    if memo_key not in VS_JSON_MEMO:
+        if url.startswith(("http://", "https://")):
+            with urlreq.urlopen(url) as response:
+                raw = response.read()
+        else:
+            with open(url, "rb") as f:
+                raw = f.read()
+        VS_JSON_MEMO[memo_key] = (json.loads(raw), hashlib.sha256(raw).hexdigest())
+    return VS_JSON_MEMO[memo_key]
+
+def load_vs_blocks(
+    url, #url or local path to valueset json file, or a valueset store
+    names = list() #block names, empty for all blocks
+):
+    # (selected blocks, hash of the selection); a store reads them through its name index
+    from .vs_store_utils import VsStore, is_vs_store
+    if len(names) == 0:
+        return load_vs_json(url)
+    if is_vs_store(url):
+        blocks = VsStore(url).get_blocks(names)
+    else:
+        blocks = [x for x in load_vs_json(url)[0] if x["name"] in names]
+    return blocks, hashlib.sha256(json.dumps(blocks, sort_keys = True).encode("utf-8")).hexdigest()
+
+def load_cdtype_map(
+    cdtype_map #dict of {codesystem: code type value}, or path to a json file holding it
+):
+    if isinstance(cdtype_map, dict):
+        return dict(cdtype_map)
+    with open(cdtype_map, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def gen_vs_cache_key(vs_hash, sqlty, cdtype_map, **fields):
+    # everything the compiled where-clauses depend on, except the source table name
+    key_src = json.dumps(
+        {
+            "version": VS_COMPILER_VERSION,
+            "vs": vs_hash,
+            "sqlty": sqlty,
+            "cdtype_map": sorted(cdtype_map.items()),
+            "fields": sorted(fields.items())
+        },
+        sort_keys = True
+    )
+    return hashlib.sha256(key_src.encode("utf-8")).hexdigest()
+
+def read_vs_cache(cache_key, cache_dir):
+    if cache_key in VS_QRY_REF_MEMO:
+        return VS_QRY_REF_MEMO[cache_key]
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, cache_key + ".json")
+        if os.path.exists(cache_file):
+            with open(cache_file, "r", encoding="utf-8") as f:
+                VS_QRY_REF_MEMO[cache_key] = json.load(f)["qry_ref"]
+            return VS_QRY_REF_MEMO[cache_key]
+    return None
+
+def write_vs_cache(cache_key, qry_ref, cache_dir, meta = dict()):
+    VS_QRY_REF_MEMO[cache_key] = qry_ref
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok = True)
+        cache_file = os.path.join(cache_dir, cache_key + ".json")
+        # write to a temp file first so concurrent runs never see a partial artifact
+        tmp_file = cache_file + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"key": cache_key, "meta": meta, "qry_ref": qry_ref}, f, indent = 4)
+        os.replace(tmp_file, cache_file)
+
 class JsonBlockVS:
     TOPIC_ENCODER = {
         "1": "participant characteristics",
@@ -181,12 +283,15 @@ class JsonBlockVS:
         self.idlength = idlength
     
     def get_existing_id(self):
-        with open(self.filepath,'r') as file:
-            jdata = json.load(file)
+        jdata, _ = load_vs_json(self.filepath)
         existing_id_num = [int(num) for item in jdata for num in re.findall(r'\d+', item['id'])]
         return existing_id_num
 
     def generate_new_id(self) -> str:
+        # a valueset store keeps a counter per id prefix
+        from .vs_store_utils import VsStore, is_vs_store
+        if is_vs_store(self.filepath):
+            return VsStore(self.filepath).next_id(self.idstarter, self.idlength)
         new_id = max(self.get_existing_id())+1
         return self.idstarter + str(new_id).zfill(self.idlength)
 
@@ -275,6 +380,11 @@ class JsonBlockVS:
         print(new_block)
         confirm_add = input("Do you want to add the new json block? (1=yes/0=no): ").strip().lower()
         if confirm_add == '1':
+            # a valueset store appends the block in place
+            from .vs_store_utils import VsStore, is_vs_store
+            if is_vs_store(self.filepath):
+                VsStore(self.filepath).add_block(new_block)
+                return "The new json data block is added"
             # open existing file and add json block
             with open(self.filepath,'r') as file:
                 jdata = json.load(file)
@@ -287,70 +397,246 @@ class JsonBlockVS:
             return "The new json data block is rejected"
 
 def expand_range(range_expression):
+    return list(iter_range(range_expression))
+
+def parse_range(range_expression):
+    # "A100-A999" -> ("A", 100, 999); "100-200" -> ("", 100, 200), same reading as expand_range
     range_lst = range_expression.split('-')
     prefix = range_lst[0][0:1]
     if prefix.isalpha():
-        range_expand = [prefix + str(y) for y in list(range(int(range_lst[0][1:]),int(range_lst[1][1:])+1))]
+        return (prefix, int(range_lst[0][1:]), int(range_lst[1][1:]))
     else:
-        range_expand = [str(y) for y in list(range(int(range_lst[0]),int(range_lst[1])+1))]
-    return range_expand
+        return ("", int(range_lst[0]), int(range_lst[1]))
+
+def merge_ranges(ranges):
+    # merge overlapping or touching (prefix, lo, hi) intervals of the same prefix
+    merged = []
+    for prefix, lo, hi in sorted(ranges):
+        if merged and merged[-1][0] == prefix and lo <= merged[-1][2] + 1:
+            merged[-1] = (prefix, merged[-1][1], max(merged[-1][2], hi))
+        elif lo <= hi:
+            merged.append((prefix, lo, hi))
+    return merged
+
+def range_predicate_multisql(
+    which_sql, #["snow","postgres","spark","mysql","sqlserver","oracle","duckdb"]
+    string, #code field
+    prefix, #leading letter of the range, can be empty
+    lo, #lower bound of the numeric part, inclusive
+    hi #upper bound of the numeric part, inclusive
+):
+    # matches exactly the codes expand_range would list: the prefix followed by the
+    # canonical digits (no leading zeros) of a number between lo and hi
+    pos = str(len(prefix) + 1)
+    num_part = 'substring(' + string + ',' + pos + ')'
+    canonical = prefix + '(0|[1-9][0-9]*)'
+    if which_sql == 'snow':
+        is_num = "regexp_like(" + string + ",'" + canonical + "')"
+    elif which_sql in ('postgres',):
+        is_num = string + " ~ '^" + canonical + "$'"
+    elif which_sql in ('spark',):
+        is_num = string + " rlike '^" + canonical + "$'"
+    elif which_sql in ('mysql',):
+        is_num = string + " regexp '^" + canonical + "$'"
+    elif which_sql == 'oracle':
+        is_num = "regexp_like(" + string + ",'^" + canonical + "$')"
+    elif which_sql == 'duckdb':
+        is_num = "regexp_full_match(" + string + ",'" + canonical + "')"
+    elif which_sql == 'sqlserver':
+        num_part = 'substring(' + string + ',' + pos + ',50)'
+        is_num = (
+            string + " like '" + prefix + "%' and " + num_part + " <> '' and " + num_part + " not like '%[^0-9]%'" +
+            " and (left(" + num_part + ",1) <> '0' or " + num_part + " = '0')"
+        )
+    else:
+        Warning("The SQL version is not supported!")
+        return ''
+    return (
+        '(case when ' + is_num + ' then cast(' + num_part + ' as decimal(38,0)) end between ' +
+        str(lo) + ' and ' + str(hi) + ')'
+    )
+
+def minimize_prefixes(prefixes):
+    # descendent-of prefixes compared without ".", a prefix under a shorter one is dropped:
+    # ["I21", "I21.0", "I22.1"] -> ["I21", "I221"]
+    keep = set()
+    for p in sorted({str(x).replace('.','') for x in prefixes if x}, key = len):
+        if not any(p[:i] in keep for i in range(1, len(p))):
+            keep.add(p)
+    return sorted(keep)
+
+def prefix_predicate_multisql(
+    which_sql, #["snow","postgres","spark","mysql","sqlserver","oracle","duckdb"]
+    string, #code field
+    prefixes #minimized prefixes, see minimize_prefixes
+):
+    # one "in" list per prefix length over the code without ".", so dotted and undotted codes
+    # match alike and there are only as many substrings as distinct lengths
+    cd_norm = "replace(" + string + ",'.','')"
+    by_len = {}
+    for p in prefixes:
+        by_len.setdefault(len(p), []).append("'" + p + "'")
+    return ' or '.join(
+        'substring(' + cd_norm + ',1,' + str(n) + ') in (' + ','.join(v) + ')'
+        for n, v in sorted(by_len.items())
+    )
+
+def iter_range(range_expression):
+    range_lst = range_expression.split('-')
+    prefix = range_lst[0][0:1]
+    if prefix.isalpha():
+        return (prefix + str(y) for y in range(int(range_lst[0][1:]),int(range_lst[1][1:])+1))
+    else:
+        return (str(y) for y in range(int(range_lst[0]),int(range_lst[1])+1))
 
-def json2ref(
-    json_url, #url to valueset json file (rawcontent)
-    save_csv_to #location to save the csv file
+def iter_ref_segments(
+    json_file, #parsed valueset json
+    expand_ranges = True #False: one row per merged codeRange interval (op "range") instead of one row per code
 ):
-    # load json file
-    json_url = urlreq.urlopen(json_url)
-    json_file = json.loads(json_url.read())
-    
-    # collect selected keys
-    csv_lst = []
+    # yield one ((id,name,description,codesystem), codes, op) segment per include block,
+    # codeRange values are expanded with numpy instead of python lists
     for item in json_file:
         for chunk in item["compose"]["include"]:
-            add_chunk = {
-                'id':item["id"],
-                'name':item["name"],
-                'description':item["description"],
-                'codesystem':chunk["system"]
-            }
+            meta = (item["id"], item["name"], item["description"], chunk["system"])
+            code_src = None
             if "filter" in chunk:
                 for filter_item in chunk["filter"]:
-                    if filter_item['property'] == 'codeRange':
-                        code_expand = [expand_range(x) for x in filter_item['value']]
-                        add_chunk['code'] = code_expand
-                        add_chunk['op'] = ['exists']*len(code_expand)
-                    else: 
-                        add_chunk['code'] = filter_item['value']
-                        add_chunk['op'] = [filter_item["op"]]*len(filter_item['value'])
-                    
-            if "concept" in chunk: 
-                add_chunk['code'] = [x["code"] for x in chunk["concept"]]
-                add_chunk['op'] = ['exists' if 'op' not in x else x["op"] for x in chunk["concept"]]
-    
-            csv_lst.append(add_chunk)
-
-    # create DF from json data and expand
-    df = pd.DataFrame(csv_lst)
-    def expand_row(row):
-        # Zip the lists and repeat the other columns
-        return pd.DataFrame({
-            'code': row['code'],
-            'op': row['op'],
-            **{col: [row[col]] * len(row['code']) for col in df.columns if col not in ['code', 'op']}
-        })
-    expanded_df = pd.concat(df.apply(expand_row, axis=1).tolist(), ignore_index=True)
-    expanded_df = expanded_df[['id','name','description','codesystem','code','op']]
-    expanded_df = expanded_df.explode('code')
-
-    # save to csv
-    expanded_df.to_csv(save_csv_to,index=False)
+                    # a later filter replaces an earlier one
+                    code_src = filter_item
+            if "concept" in chunk:
+                codes = np.array([x["code"] for x in chunk["concept"]], dtype = object)
+                ops = np.array(['exists' if 'op' not in x else x["op"] for x in chunk["concept"]], dtype = object)
+                yield meta, codes, ops
+            elif code_src is not None and code_src['property'] == 'codeRange' and not expand_ranges:
+                merged = merge_ranges([parse_range(x) for x in code_src['value']])
+                yield meta, np.array([p + str(lo) + '-' + p + str(hi) for p, lo, hi in merged], dtype = object), 'range'
+            elif code_src is not None and code_src['property'] == 'codeRange':
+                for x in code_src['value']:
+                    yield meta, expand_range_np(x), 'exists'
+            elif code_src is not None:
+                yield meta, np.array(code_src['value'], dtype = object), code_src["op"]
+
+def expand_range_np(range_expression):
+    # vectorized expand_range
+    range_lst = range_expression.split('-')
+    prefix = range_lst[0][0:1]
+    if prefix.isalpha():
+        nums = np.arange(int(range_lst[0][1:]), int(range_lst[1][1:])+1)
+        return np.char.add(prefix, nums.astype(str)).astype(object)
+    else:
+        nums = np.arange(int(range_lst[0]), int(range_lst[1])+1)
+        return nums.astype(str).astype(object)
+
+REF_COLUMNS = ['id','name','description','codesystem','code','op']
+
+def _segments_to_df(segments):
+    # build the chunk column-wise: repeat block metadata by segment length, concatenate codes once
+    lens = np.array([len(codes) for _, codes, _ in segments], dtype = np.int64)
+    cols = {}
+    for i, col in enumerate(REF_COLUMNS[:4]):
+        cols[col] = np.repeat(np.array([meta[i] for meta, _, _ in segments], dtype = object), lens)
+    cols['code'] = np.concatenate([codes for _, codes, _ in segments]) if segments else np.array([], dtype = object)
+    cols['op'] = np.concatenate([
+        ops if isinstance(ops, np.ndarray) else np.full(len(codes), ops, dtype = object)
+        for _, codes, ops in segments
+    ]) if segments else np.array([], dtype = object)
+    return pd.DataFrame(cols, columns = REF_COLUMNS)
+
+def iter_ref_chunks(
+    json_file, #parsed valueset json
+    chunk_size = 100000, #approximate rows per yielded DataFrame
+    expand_ranges = True #see iter_ref_segments
+):
+    segments, n_rows, n_chunk = [], 0, 0
+    for meta, codes, ops in iter_ref_segments(json_file, expand_ranges):
+        # split segments larger than a chunk
+        for start in range(0, max(len(codes), 1), chunk_size):
+            part_ops = ops[start:start+chunk_size] if isinstance(ops, np.ndarray) else ops
+            part = (meta, codes[start:start+chunk_size], part_ops)
+            if len(part[1]) == 0:
+                continue
+            segments.append(part)
+            n_rows += len(part[1])
+            if n_rows >= chunk_size:
+                yield _segments_to_df(segments)
+                segments, n_rows, n_chunk = [], 0, n_chunk + 1
+    # always yield at least one (possibly empty) chunk so the output file gets a header
+    if segments or n_chunk == 0:
+        yield _segments_to_df(segments)
+
+def json2ref_df(
+    json_file, #parsed valueset json
+    expand_ranges = True #see iter_ref_segments
+):
+    return pd.concat(list(iter_ref_chunks(json_file, expand_ranges = expand_ranges)), ignore_index = True)
+
+def json2ref(
+    json_url, #url or local path to valueset json file (rawcontent)
+    save_csv_to, #location to save the ref file; written as parquet if it ends with .parquet, otherwise csv
+    chunk_size = 100000, #rows held in memory at a time
+    expand_ranges = True #False: keep codeRange values as merged "lo-hi" intervals with op "range"
+):
+    # load json file
+    json_file, _ = load_vs_json(json_url)
+
+    # stream expanded rows to file chunk by chunk
+    if save_csv_to.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = pa.schema([(x, pa.string()) for x in REF_COLUMNS])
+        with pq.ParquetWriter(save_csv_to, schema) as writer:
+            for chunk in iter_ref_chunks(json_file, chunk_size, expand_ranges):
+                writer.write_table(pa.Table.from_pandas(chunk.astype(str), schema = schema, preserve_index = False))
+    else:
+        header = True
+        for chunk in iter_ref_chunks(json_file, chunk_size, expand_ranges):
+            chunk.to_csv(save_csv_to, index = False, header = header, mode = 'w' if header else 'a')
+            header = False
     return('new valueset saved as ref csv')
 
+def gen_code_ref(
+    json_url, #url or local path to valueset json file, or a valueset store
+    cdtype_map, #dict or path to json file of {codesystem: code type value}; systems not in it are dropped
+    sel_keys = list() #list of selected keys, can be empty
+):
+    # code reference table for join-based matching: one row per (phenotype, system, code),
+    # codes normalized without "." and PREFIX_LEN = 0 for exact match or the prefix length to compare.
+    # MATCH_CD is what the join compares, like gen_qry: the code as listed for an exact code, the
+    # normalized prefix for descendent-of
+    json_file, _ = load_vs_blocks(json_url, sel_keys)
+    cdtype_map = load_cdtype_map(cdtype_map)
+    ref = json2ref_df(json_file).dropna(subset = ['code'])
+    ref = ref[ref['codesystem'].isin(list(cdtype_map.keys()))]
+    if len(sel_keys) > 0:
+        ref = ref[ref['name'].isin(sel_keys)]
+    cd_norm = ref['code'].astype(str).str.replace('.','',regex = False)
+    code_ref = pd.DataFrame({
+        'CODESYSTEM': ref['codesystem'].values,
+        'CD_TYPE': ref['codesystem'].map(cdtype_map).values,
+        'CD': cd_norm.values,
+        'PREFIX_LEN': [len(cd) if op == 'descendent-of' else 0 for cd, op in zip(cd_norm, ref['op'])],
+        'PHE_TYPE': ref['name'].values,
+        'MATCH_CD': [cd if op == 'descendent-of' else str(raw) for cd, raw, op in zip(cd_norm, ref['code'], ref['op'])]
+    })
+    # a source row joins once per matching reference row, so like compile_qry_ref keep only the
+    # shortest of nested prefixes and drop exact codes under a prefix, per phenotype and code type
+    # (systems sharing a code type, e.g. cpt and hcpcs, are matched together)
+    keep = []
+    for _, grp in code_ref.groupby(['PHE_TYPE', 'CD_TYPE'], sort = False):
+        prefixes = minimize_prefixes(grp.loc[grp['PREFIX_LEN'] > 0, 'CD'])
+        is_prefix = grp['PREFIX_LEN'] > 0
+        keep.append(grp[
+            (is_prefix & grp['CD'].isin(prefixes)) |
+            (~is_prefix & ~grp['CD'].map(lambda cd: any(cd.startswith(x) for x in prefixes)))
+        ])
+    code_ref = pd.concat(keep) if keep else code_ref
+    return code_ref.drop_duplicates(subset = ['CD_TYPE', 'MATCH_CD', 'PREFIX_LEN', 'PHE_TYPE']).reset_index(drop = True)
+
 class QueryFromJson:
     def __init__(
         self,
-        url, #url to json file
-        sqlty, #which type of sql ["snow","postgres","spark","mysql","sqlserver","oracle"]
+        url, #url to json file, or a valueset store (see vs_store_utils)
+        sqlty, #which type of sql ["snow","postgres","spark","mysql","sqlserver","oracle","duckdb"]
         cd_field, #code field
         date_fields, #list of all date fields
         other_fields, #list of other fields needed to be retained
@@ -358,7 +644,11 @@ class QueryFromJson:
         sel_keys = list(), #list of selected keys to be queried, can be empty
         sel_domain = "", #specify concept domains for more efficient prompting ["dx","px","lab","rx"], can be empty
         cdtype_field = "", #code type field, can be empty
-        val_field = "" #value field, can be empty
+        val_field = "", #value field, can be empty
+        cdtype_map = None, #dict or path to json file of {codesystem: code type value}; prompt for it if None
+        cache_dir = ".vs_cache", #where compiled valueset artifacts are kept across runs; None to keep them in memory only
+        sample_pct = None, #keep a stable hash-based percent of patients, see sample_utils; None for all patients
+        pat_field = "PATID" #patient id field the sample is drawn on
     ):
         self.url = url
         self.sqlty = sqlty
@@ -370,35 +660,31 @@ class QueryFromJson:
         self.sel_keys = sel_keys
         self.sel_domain = sel_domain
         self.val_field = val_field
+        self.cdtype_map = cdtype_map
+        self.cache_dir = cache_dir
+        self.sample_pct = sample_pct
+        self.pat_field = pat_field
 
     @staticmethod
     def add_quote(lst):
-        lst_quote = ["'"+str(x)+"'" for x in lst]
+        # repeated codes are quoted once
+        lst_quote = ["'"+str(x)+"'" for x in dict.fromkeys(lst)]
         return (lst_quote)
     
     @staticmethod
     def parse_filter(lst):
-        cddict = {}
+        # {"p": descendent-of prefixes of any precision, "9": exact codes, "r": merged ranges}
+        cddict = {"p": [], "9": [], "r": []}
         for item in lst:
             if item["property"]=="codePrecision" and item["op"]=="descendent-of":
-                decimal = [len(x.split('.')[1]) if '.' in x else 0 for x in item["value"]]
-                try: cddict["0"] = [item["value"][index] for index, current_value in enumerate(decimal) if current_value == 0]
-                except ValueError: return None
-                try: cddict["1"] = [item["value"][index] for index, current_value in enumerate(decimal) if current_value == 1]
-                except ValueError: return None
-                try: cddict["2"] = [item["value"][index] for index, current_value in enumerate(decimal) if current_value == 2]
-                except ValueError: return None
-                try: cddict["3"] = [item["value"][index] for index, current_value in enumerate(decimal) if current_value == 3]
-                except ValueError: return None
+                cddict["p"] += item["value"]
 
             elif item["property"]=="codeRange" and item["op"]=="in":
-                cddict["9"] = []
-                for x in item["value"]:
-                    key_quote = expand_range(x)
-                    cddict["9"].extend(key_quote)
+                # keep ranges as merged intervals instead of enumerating every code
+                cddict["r"] = merge_ranges(cddict["r"] + [parse_range(x) for x in item["value"]])
 
             elif item["property"]=="codeList" and item["op"]=="exists":
-                cddict["9"] = item["value"]
+                cddict["9"] += item["value"]
 
             else:
                 print("filter property or op not defined in the valuset json file.")
@@ -409,16 +695,15 @@ class QueryFromJson:
     
     @staticmethod
     def parse_concept(lst):
-        codes = [item["code"] for item in lst]
-        return(codes)
+        # same layout as parse_filter; concepts are exact codes unless marked descendent-of
+        cddict = {
+            "p": [item["code"] for item in lst if item.get("op") == "descendent-of"],
+            "9": [item["code"] for item in lst if item.get("op") != "descendent-of"]
+        }
+        return({k: v for k, v in cddict.items() if v})
 
     def gen_cdtype_encoder(self):
-        domain_to_codes = {
-            "dx":  ["icd9cm", "icd10cm", "snomed", "drg"],
-            "px":  ["icd9proc", "icd10pcs", "cpt", "hpc"],
-            "lab": ["loinc"],
-            "rx":  ["rxnorm", "ndc"]
-        }
+        domain_to_codes = DOMAIN_TO_CODES
         allkeys = sorted({code for codes in domain_to_codes.values() for code in codes})
         if self.sel_domain == "":
             codes_to_prompt = allkeys
@@ -427,31 +712,80 @@ class QueryFromJson:
         else:
             raise ValueError(f"Unknown sel_domain '{self.sel_domain}'. ")
 
-        allprompts = {code: f"Enter Code Type Value for {code}: " for code in allkeys} 
-        cdtype_encoder = {}
-        for code in codes_to_prompt:
-            cdtype_encoder[code] = input(allprompts[code])
+        # non-interactive: only keep the code systems of the selected domain
+        if self.cdtype_map is not None:
+            cdtype_src = load_cdtype_map(self.cdtype_map)
+            return {code: cdtype_src[code] for code in codes_to_prompt if code in cdtype_src}
 
-        return(cdtype_encoder)
-        
-    def gen_qry_ref(self):     
-        # load json valueset file
-        if self.url.startswith(("http://", "https://")):
-            # Remote URL
-            with urlreq.urlopen(self.url) as response:
-                json_file = json.loads(response.read())
-        else:
-            # Local file path
-            with open(self.url, "r", encoding="utf-8") as f:
-                json_file = json.load(f)
+        # interactive: ask once per domain and process
+        if self.sel_domain not in CDTYPE_PROMPT_MEMO:
+            allprompts = {code: f"Enter Code Type Value for {code}: " for code in allkeys}
+            cdtype_encoder = {}
+            for code in codes_to_prompt:
+                cdtype_encoder[code] = input(allprompts[code])
+            CDTYPE_PROMPT_MEMO[self.sel_domain] = cdtype_encoder
+
+        return(dict(CDTYPE_PROMPT_MEMO[self.sel_domain]))
+
+    def gen_qry_ref(self):
+        # load the selected blocks of the json valueset file
+        json_file, vs_hash = load_vs_blocks(self.url, self.sel_keys)
 
         # load cdtype mapping
         cdtype_map = self.gen_cdtype_encoder()
 
+        # reuse compiled artifact if json, dialect, cdtype mapping and fields are unchanged
+        cache_key = gen_vs_cache_key(
+            vs_hash, self.sqlty, cdtype_map,
+            cd_field = self.cd_field,
+            cdtype_field = self.cdtype_field,
+            val_field = self.val_field
+        )
+        qry_out = read_vs_cache(cache_key, self.cache_dir)
+        if qry_out is None:
+            qry_out = self.compile_qry_ref(json_file, cdtype_map)
+            write_vs_cache(
+                cache_key, qry_out, self.cache_dir,
+                meta = {"url": self.url, "sqlty": self.sqlty, "cdtype_map": cdtype_map}
+            )
+        return dict(qry_out)
+
+    def gen_vs_hash(self):
+        # fingerprint of the selected valueset blocks plus everything the generated predicates depend on,
+        # used to tell whether an already loaded slice is out of date
+        sel_blocks, _ = load_vs_blocks(self.url, self.sel_keys)
+        sel_hash = hashlib.sha256(json.dumps(sel_blocks, sort_keys = True).encode("utf-8")).hexdigest()
+        return gen_vs_cache_key(
+            sel_hash, self.sqlty, self.gen_cdtype_encoder(),
+            cd_field = self.cd_field,
+            cdtype_field = self.cdtype_field,
+            val_field = self.val_field,
+            other_fields = ','.join(self.other_fields),
+            date_fields = ','.join(self.date_fields),
+            sel_keys = ','.join(self.sel_keys),
+            # only when sampling, so full-run hashes stay as they were
+            **({"sample_pct": self.sample_pct, "pat_field": self.pat_field} if self.sample_pct is not None else {})
+        )
+
+    def sample_src(
+        self,
+        srctbl_name, #source table name
+        alias = "" #alias of the source in the generated query
+    ):
+        # source table, filtered to the patient sample when sample_pct is set
+        if self.sample_pct is None:
+            return srctbl_name + (" " + alias if alias else "")
+        return (
+            "(select * from " + srctbl_name + " where " + gen_sample_predicate(self.sample_pct, self.pat_field) + ") " +
+            (alias or "smp")
+        )
+
+    def compile_qry_ref(self, json_file, cdtype_map):
         # generate reference dictionary for where clause
         qry_out = {}
         for x in json_file:  
             qryx_orlst = []
+            sys_codes = {}
             for y in x["compose"]["include"]:
                 if y["system"] in cdtype_map: 
                     # code type 
@@ -459,77 +793,198 @@ class QueryFromJson:
                     if self.cdtype_field != "":
                         qry_cdtype += self.cdtype_field + "='" + cdtype_map[y["system"]] + "' and "
                     
-                    # value range
+                    # value range, applied on top of the code predicate
                     qry_val = " "
                     if x["relatedArtifact"]["valueType"]=="continuous" and self.val_field != "":
-                        if "high" in x["relatedArtifact"]["valueRange"]:
-                            incld_dict = {0:">", 1:">="}
-                            high_val = x["relatedArtifact"]["valueRange"]["high"]["value"]
-                            incld_ind = x["relatedArtifact"]["valueRange"]["high"]["incld"]
-                            qry_val += " and " + self.val_field + incld_dict[incld_ind] + str(high_val) + ")"
-
                         if "low" in x["relatedArtifact"]["valueRange"]:
-                            incld_dict = {0:"<", 1:"<="}
+                            incld_dict = {0:">", 1:">="}
                             low_val = x["relatedArtifact"]["valueRange"]["low"]["value"]
                             incld_ind = x["relatedArtifact"]["valueRange"]["low"]["incld"]
-                            qry_val += " and " + self.val_field + incld_dict[incld_ind] + str(low_val)  + ")"
-
-                    # codes
-                    qryxy_orlst = []
-                    if "filter" in y: 
-                        cdref = self.parse_filter(y["filter"])
-                        if '0' in cdref:
-                            if y["system"] in ('icd9cm','icd10cm'):
-                                qryxy_orlst.append(
-                                    split_part_multisql(self.sqlty,self.cd_field,'.',1) + ''' in ('''+ ','.join(self.add_quote(cdref["0"])) +''')
-                                ''')
-                            else:
-                                # e.g., icd10pcs has hierarchical structure
-                                qryxy_orlst.append('''
-                                    substring('''+ self.cd_field +''',1,'''+ str(len(cdref["0"][0])) +''') in ('''+ ','.join(self.add_quote(cdref["0"])) +''')
-                                ''')
-                        elif '1' in cdref:
-                            qryxy_orlst.append('''
-                                substring('''+ self.cd_field +''',1,5) in ('''+ ','.join(self.add_quote(cdref["1"])) +''')
-                            ''')
-                        elif '2' in cdref:
-                            qryxy_orlst.append('''
-                                substring('''+ self.cd_field +''',1,6) in ('''+ ','.join(self.add_quote(cdref["2"])) +''')
-                            ''')
-                        else:
-                            cdref_leaf = (cdref.get("3") or []) + (cdref.get("9") or [])
-                            qryxy_orlst.append('''
-                                ''' + self.cd_field + ''' in ('''+ ','.join(self.add_quote(cdref_leaf)) +''')
-                            ''')
-                        qryx_orlst.append(qry_cdtype + ''' (''' + ' or '.join(qryxy_orlst) + ''')''' + qry_val)
+                            qry_val += " and " + self.val_field + incld_dict[incld_ind] + str(low_val)
 
-                    else:
-                        cdref_leaf = self.parse_concept(y["concept"])
-                        qryx_orlst.append(qry_cdtype + ''' (''' + self.cd_field + ''' in ('''+ ','.join(self.add_quote(cdref_leaf)) + ''')''' + qry_val)
+                        if "high" in x["relatedArtifact"]["valueRange"]:
+                            incld_dict = {0:"<", 1:"<="}
+                            high_val = x["relatedArtifact"]["valueRange"]["high"]["value"]
+                            incld_ind = x["relatedArtifact"]["valueRange"]["high"]["incld"]
+                            qry_val += " and " + self.val_field + incld_dict[incld_ind] + str(high_val)
+
+                    # codes, all includes of the same system compiled together
+                    cdref = self.parse_filter(y["filter"]) if "filter" in y else self.parse_concept(y.get("concept", []))
+                    sys_key = (y["system"], qry_cdtype, qry_val)
+                    if sys_key not in sys_codes:
+                        sys_codes[sys_key] = {"p": [], "9": [], "r": []}
+                    for k, v in cdref.items():
+                        sys_codes[sys_key][k] += v
 
-                else: 
+                else:
                     pass
 
-            # add non-empty query entry to dict
+            for (_, qry_cdtype, qry_val), cdref in sys_codes.items():
+                qryxy_orlst = []
+                # descendent-of prefixes of any precision, one "in" per prefix length
+                prefixes = minimize_prefixes(cdref["p"])
+                if prefixes:
+                    qryxy_orlst.append(prefix_predicate_multisql(self.sqlty, self.cd_field, prefixes))
+                # exact codes under one of the prefixes are matched already
+                cdref_leaf = [cd for cd in cdref["9"] if not any(str(cd).replace('.','').startswith(p) for p in prefixes)]
+                if cdref_leaf:
+                    qryxy_orlst.append(self.cd_field + ''' in ('''+ ','.join(self.add_quote(cdref_leaf)) +''')''')
+                for prefix, lo, hi in merge_ranges(cdref["r"]):
+                    qryxy_orlst.append(range_predicate_multisql(self.sqlty, self.cd_field, prefix, lo, hi))
+                if qryxy_orlst:
+                    qryx_orlst.append(qry_cdtype + ''' (''' + ' or '.join(qryxy_orlst) + ''')''' + qry_val)
+
+            # add non-empty query entry to dict, repeated predicates kept once
             if len(qryx_orlst) > 0: 
-                qry_out[x["name"]] = ') OR ('.join(qryx_orlst)
+                qry_out[x["name"]] = ') OR ('.join(dict.fromkeys(qryx_orlst))
 
         return qry_out 
     
-    def gen_qry(self):
+    def gen_qry(
+        self,
+        srctbl_name = None, #override source table name, so one instance can serve all sites
+        keys = None #only these of the selected keys, None for all of them
+    ):
+        srctbl_name = srctbl_name or self.srctbl_name
         selqry_lst = []
         qry_dict = self.gen_qry_ref()
         for k,v in qry_dict.items():
-            if len(self.sel_keys) == 0 or k in self.sel_keys:
+            if (len(self.sel_keys) == 0 or k in self.sel_keys) and (keys is None or k in keys):
                 nondate_fields = self.other_fields + [self.cd_field]+([self.cdtype_field] if self.cdtype_field else ["'"+self.cd_field+"'"])
                 selqry_lst.append('''
                     select ''' + ','.join(nondate_fields) + 
                         " ,coalesce(" + ','.join(self.date_fields) + ") as CD_DATE" + 
                         " ,'"+ k +"' as CD_GRP" '''
-                    from '''+ self.srctbl_name +'''
+                    from '''+ self.sample_src(srctbl_name) +'''
                     where ('''+ v +''')
                 ''')
         complt_qry = ' union all '.join(selqry_lst)
         return(complt_qry)
 
 
+    def gen_qry_scan(
+        self,
+        srctbl_name = None, #override source table name, so one instance can serve all sites
+        fanout = False #False: CASE assigns the first matching group; True: rows matching several groups are repeated per group
+    ):
+        # the source table is scanned once for all selected keys. fanout gives the same rows as gen_qry;
+        # without fanout a code in several selected valuesets is kept once, under the first of them
+        srctbl_name = srctbl_name or self.srctbl_name
+        qry_dict = {k:v for k,v in self.gen_qry_ref().items() if len(self.sel_keys) == 0 or k in self.sel_keys}
+        if len(qry_dict) == 0:
+            return ''
+        nondate_fields = self.other_fields + [self.cd_field]+([self.cdtype_field] if self.cdtype_field else ["'"+self.cd_field+"' as CD_TYPE"])
+        sel_fields = ','.join(nondate_fields) + " ,coalesce(" + ','.join(self.date_fields) + ") as CD_DATE"
+
+        if not fanout:
+            grp_case = ' '.join(["when ("+ v +") then '"+ k +"'" for k,v in qry_dict.items()])
+            complt_qry = '''
+                select * from (
+                    select ''' + sel_fields + '''
+                          ,case ''' + grp_case + ''' end as CD_GRP
+                    from '''+ self.sample_src(srctbl_name) +'''
+                ) t where CD_GRP is not null
+            '''
+            return(complt_qry)
+
+        grp_lst = ','.join(["case when ("+ v +") then '"+ k +"' end" for k,v in qry_dict.items()])
+        if self.sqlty == 'snow':
+            complt_qry = '''
+                select s.* exclude (CD_GRPS), f.value::varchar as CD_GRP
+                from (
+                    select ''' + sel_fields + '''
+                          ,array_construct_compact(''' + grp_lst + ''') as CD_GRPS
+                    from '''+ self.sample_src(srctbl_name) +'''
+                ) s, lateral flatten(input => s.CD_GRPS) f
+            '''
+        elif self.sqlty == 'postgres':
+            complt_qry = '''
+                select ''' + sel_fields + '''
+                      ,unnest(array_remove(array[''' + grp_lst + '''],null)) as CD_GRP
+                from '''+ self.sample_src(srctbl_name) +'''
+            '''
+        elif self.sqlty == 'spark':
+            complt_qry = '''
+                select ''' + sel_fields + '''
+                      ,explode(filter(array(''' + grp_lst + '''), x -> x is not null)) as CD_GRP
+                from '''+ self.sample_src(srctbl_name) +'''
+            '''
+        elif self.sqlty == 'duckdb':
+            complt_qry = '''
+                select ''' + sel_fields + '''
+                      ,unnest(list_filter([''' + grp_lst + '''], x -> x is not null)) as CD_GRP
+                from '''+ self.sample_src(srctbl_name) +'''
+            '''
+        else:
+            raise ValueError(f"fanout scan is not supported for sqlty '{self.sqlty}', use fanout = False")
+        return(complt_qry)
+
+    def gen_qry_join(
+        self,
+        reftbl_name, #name of the uploaded code reference table, see gen_code_ref
+        srctbl_name = None #override source table name, so one instance can serve all sites
+    ):
+        # same output as gen_qry, but codes are matched by an equi-join against the reference table
+        # on (code type, prefix length, code or normalized code prefix); the predicate does not grow
+        # with the valueset. keys with a valueRange on val_field are queried like gen_qry and unioned in
+        srctbl_name = srctbl_name or self.srctbl_name
+        cdtype_map = self.gen_cdtype_encoder()
+        json_file, _ = load_vs_blocks(self.url, self.sel_keys)
+        val_keys = [
+            x["name"] for x in json_file
+            if self.val_field != "" and x["relatedArtifact"]["valueType"] == "continuous"
+        ]
+        val_qry = self.gen_qry(srctbl_name, keys = val_keys) if val_keys else ''
+        code_ref = gen_code_ref(self.url, cdtype_map, self.sel_keys)
+        code_ref = code_ref[~code_ref['PHE_TYPE'].isin(val_keys)]
+        if len(code_ref) == 0:
+            return val_qry
+
+        # only a handful of distinct prefix lengths, each source row is probed once per length
+        prefix_lens = ','.join(['('+ str(x) +')' for x in sorted(code_ref['PREFIX_LEN'].unique())])
+        cd_norm = "replace(s." + self.cd_field + ",'.','')"
+        nondate_fields = self.other_fields + [self.cd_field]+([self.cdtype_field] if self.cdtype_field else ["'"+self.cd_field+"'"])
+
+        # reference rows of this instance's systems and keys. without cdtype_field all systems of a key
+        # are matched together, so a code listed under several systems, or under a prefix of another
+        # system, is kept once: a source row joins at most once per key, as in gen_qry
+        sys_cond = "CODESYSTEM in (" + ','.join(self.add_quote(sorted(cdtype_map.keys()))) + ")"
+        ref_cond = ["r." + sys_cond]
+        if len(self.sel_keys) > 0:
+            ref_cond.append("r.PHE_TYPE in (" + ','.join(self.add_quote(self.sel_keys)) + ")")
+        if val_keys:
+            ref_cond.append("r.PHE_TYPE not in (" + ','.join(self.add_quote(val_keys)) + ")")
+        grp_cols = ["PHE_TYPE"] + (["CD_TYPE"] if self.cdtype_field != "" else [])
+        shadow_cond = ["p." + x + " = r." + x for x in grp_cols] + [
+            "p." + sys_cond,
+            "p.PREFIX_LEN > 0",
+            "(r.PREFIX_LEN = 0 or p.PREFIX_LEN < r.PREFIX_LEN)",
+            "substring(r.CD,1,p.PREFIX_LEN) = p.CD"
+        ]
+        ref_qry = (
+            "select distinct " + ','.join("r." + x for x in grp_cols + ["MATCH_CD", "PREFIX_LEN"]) +
+            " from " + reftbl_name + " r where " + " and ".join(ref_cond) +
+            " and not exists (select 1 from " + reftbl_name + " p where " + " and ".join(shadow_cond) + ")"
+        )
+
+        # exact codes compare the code as it is, prefixes the code without "."
+        join_cond = [
+            "r.PREFIX_LEN = l.PREFIX_LEN",
+            "r.MATCH_CD = (case when l.PREFIX_LEN = 0 then s." + self.cd_field + " else substring(" + cd_norm + ",1,l.PREFIX_LEN) end)"
+        ]
+        if self.cdtype_field != "":
+            join_cond.append("r.CD_TYPE = s." + self.cdtype_field)
+
+        complt_qry = ('''
+            select ''' + ','.join(nondate_fields) +
+                " ,coalesce(" + ','.join(self.date_fields) + ") as CD_DATE" +
+                " ,r.PHE_TYPE as CD_GRP" + '''
+            from '''+ self.sample_src(srctbl_name, 's') +'''
+            cross join (values ''' + prefix_lens + ''') l(PREFIX_LEN)
+            join ('''+ ref_qry +''') r
+              on ''' + '''
+             and '''.join(join_cond) + '''
+        ''')
+        if val_qry:
+            complt_qry += ' union all ' + val_qry
+        return(complt_qry)
@@ -0,0 +1,114 @@
+import os
+import json
+import threading
+from datetime import datetime, timezone
+
+# checkpoint ledger for incremental loads: one entry per (site, domain) slice, holding the
+# valueset hash and source table version the slice was last built from
+
+def _now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+class LocalLedger:
+    # json file ledger, the local stand-in for SnowLedger
+    def __init__(
+        self,
+        filepath #path to ledger json file, created on first write
+    ):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(filepath):
+            with open(filepath, "r", encoding="utf-8") as f:
+                self.entries = {(x["site"], x["domain"]): x for x in json.load(f)}
+
+    def get(self, site, domain):
+        return self.entries.get((site, domain))
+
+    def is_fresh(self, site, domain, vs_hash, src_version):
+        # an unknown source version is never fresh
+        entry = self.get(site, domain)
+        return (
+            src_version is not None and entry is not None and entry["status"] == "done" and
+            entry["vs_hash"] == vs_hash and entry["src_version"] == src_version
+        )
+
+    def mark_done(self, site, domain, vs_hash, src_version, row_cnt = None):
+        with self._lock:
+            self.entries[(site, domain)] = {
+                "site": site, "domain": domain, "vs_hash": vs_hash, "src_version": src_version,
+                "status": "done", "row_cnt": row_cnt, "updated_at": _now()
+            }
+            self._save()
+
+    def reset(self):
+        with self._lock:
+            self.entries = {}
+            self._save()
+
+    def _save(self):
+        tmp_file = self.filepath + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(list(self.entries.values()), f, indent = 4)
+        os.replace(tmp_file, self.filepath)
+
+class SnowLedger(LocalLedger):
+    # ledger kept in a snowflake table next to the long tables
+    def __init__(
+        self,
+        session, #snowpark session
+        tbl_name = "KTX_LOAD_LEDGER" #ledger table name
+    ):
+        self.session = session
+        self.tbl_name = tbl_name
+        self._lock = threading.Lock()
+        session.sql(f"""
+            CREATE TABLE IF NOT EXISTS {tbl_name} (
+                SITE varchar, DOMAIN varchar, VS_HASH varchar, SRC_VERSION varchar,
+                STATUS varchar, ROW_CNT number, UPDATED_AT timestamp
+            )
+        """).collect()
+        rows = session.sql(f"SELECT SITE,DOMAIN,VS_HASH,SRC_VERSION,STATUS,ROW_CNT,UPDATED_AT FROM {tbl_name}").collect()
+        self.entries = {
+            (r[0], r[1]): {
+                "site": r[0], "domain": r[1], "vs_hash": r[2], "src_version": r[3],
+                "status": r[4], "row_cnt": r[5], "updated_at": str(r[6])
+            } for r in rows
+        }
+
+    def mark_done(self, site, domain, vs_hash, src_version, row_cnt = None):
+        with self._lock:
+            self.entries[(site, domain)] = {
+                "site": site, "domain": domain, "vs_hash": vs_hash, "src_version": src_version,
+                "status": "done", "row_cnt": row_cnt, "updated_at": _now()
+            }
+        src_version_sql = "NULL" if src_version is None else f"'{src_version}'"
+        row_cnt_sql = "NULL" if row_cnt is None else str(int(row_cnt))
+        self.session.sql(f"""
+            MERGE INTO {self.tbl_name} t
+            USING (SELECT '{site}' AS SITE, '{domain}' AS DOMAIN) s
+               ON t.SITE = s.SITE AND t.DOMAIN = s.DOMAIN
+            WHEN MATCHED THEN UPDATE SET
+                VS_HASH = '{vs_hash}', SRC_VERSION = {src_version_sql}, STATUS = 'done',
+                ROW_CNT = {row_cnt_sql}, UPDATED_AT = current_timestamp()
+            WHEN NOT MATCHED THEN INSERT (SITE,DOMAIN,VS_HASH,SRC_VERSION,STATUS,ROW_CNT,UPDATED_AT)
+                VALUES ('{site}','{domain}','{vs_hash}',{src_version_sql},'done',{row_cnt_sql},current_timestamp())
+        """).collect()
+
+    def reset(self):
+        with self._lock:
+            self.entries = {}
+        self.session.sql(f"DELETE FROM {self.tbl_name}").collect()
+
+def filter_fresh_tasks(
+    tasks, #list of dicts with keys "site", "slice", "vs_hash" and "src_version"
+    ledger #LocalLedger or SnowLedger
+):
+    # split into (tasks to run, tasks skipped because the ledger says they are up to date)
+    to_run, skipped = [], []
+    for task in tasks:
+        if ledger.is_fresh(task["site"], task["slice"], task["vs_hash"], task["src_version"]):
+            skipped.append(task)
+        else:
+            to_run.append(task)
+    return to_run, skipped
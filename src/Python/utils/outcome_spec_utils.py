@@ -0,0 +1,160 @@
+import json
+from .gen_vs_json_utils import load_vs_json
+
+# declarative outcome definitions (see ref/outcome-spec-kd.json) compiled into one query over the long
+# event tables: one scan of the dx/px table for the index and every outcome variant, one scan of each
+# table holding confirmation events, and a wide result with one date/days/indicator set per variant.
+# windows are [lo, hi] days from the index date (outcome) or from the outcome date (confirm), null for open
+
+def load_outcome_spec(
+    spec #dict, or url/local path to the spec json file
+):
+    if isinstance(spec, dict):
+        spec = dict(spec)
+    else:
+        spec, _ = load_vs_json(spec)
+    for key in ("study_window", "index", "outcomes"):
+        if key not in spec:
+            raise ValueError(f"outcome spec is missing '{key}'")
+    names = [x["name"] for x in spec["outcomes"]]
+    if len(set(names)) != len(names):
+        raise ValueError("outcome names in the spec must be unique")
+    for x in spec["outcomes"]:
+        if "confirm" in x and x["confirm"].get("src", "rx") not in ("rx", "dxpx"):
+            raise ValueError(f"unknown confirm src '{x['confirm']['src']}' for outcome '{x['name']}'")
+    return spec
+
+def _in_list(field, values):
+    return field + " in (" + ",".join("'" + str(x) + "'" for x in values) + ")"
+
+def _window_cond(from_date, to_date, window):
+    # to_date falls within [lo, hi] days after from_date
+    conds = []
+    lo, hi = (list(window) + [None, None])[:2]
+    if lo is not None:
+        conds.append(f"datediff('day',{from_date},{to_date}) >= {int(lo)}")
+    if hi is not None:
+        conds.append(f"datediff('day',{from_date},{to_date}) <= {int(hi)}")
+    return conds
+
+def _event_cond(x, study_window, prefix = ""):
+    # phenotype, encounter type and study window filters of an index/outcome/confirm definition
+    conds = []
+    if x.get("phe_type"):
+        conds.append(_in_list(prefix + "PHE_TYPE", x["phe_type"]))
+    if x.get("enc_type"):
+        conds.append(_in_list(prefix + "ENC_TYPE", x["enc_type"]))
+    sw = x.get("study_window", study_window)
+    if sw:
+        conds.append(f"{prefix}CD_DATE between date '{sw[0]}' and date '{sw[1]}'")
+    return conds
+
+def gen_outcome_sql(
+    spec, #dict or path to the outcome spec json
+    log_tbl_dxpx = "KTX_DXPX_LONG", #long dx/px event table, see event_log.py
+    log_tbl_rx = "KTX_RX_LONG" #long rx event table, see event_log.py
+):
+    spec = load_outcome_spec(spec)
+    sw = spec["study_window"]
+    idx = spec["index"]
+    outcomes = spec["outcomes"]
+    idx_cond = " and ".join(_event_cond(idx, sw))
+
+    ##--- single scan of the dx/px table: index date spread over each patient's rows, then one
+    # conditional min per outcome variant
+    all_phe = sorted({p for x in [idx] + outcomes for p in x.get("phe_type", [])})
+    all_sw = [x.get("study_window", sw) for x in [idx] + outcomes]
+    scan_filter = [f"CD_DATE between date '{min(w[0] for w in all_sw)}' and date '{max(w[1] for w in all_sw)}'"]
+    if all(x.get("phe_type") for x in [idx] + outcomes):
+        scan_filter.append(_in_list("PHE_TYPE", all_phe))
+    agg_cols = []
+    for x in outcomes:
+        name = x["name"]
+        if x.get("first_overall"):
+            # the first event in the study window must fall in the window
+            agg_cols.append(f"min(case when {' and '.join(_event_cond(x, sw))} then CD_DATE end) as {name}_ANY_DATE")
+        else:
+            conds = _event_cond(x, sw) + _window_cond("INDEX_DATE", "CD_DATE", x.get("window", [None, None]))
+            agg_cols.append(f"min(case when {' and '.join(conds)} then CD_DATE end) as {name}_DATE")
+    cte = [f"""
+    ev as (
+        select PATID, PHE_TYPE, ENC_TYPE, CD_DATE, SITE,
+               min(case when {idx_cond} then CD_DATE end) over (partition by PATID) as INDEX_DATE
+        from {log_tbl_dxpx}
+        where {' and '.join(scan_filter)}
+    ), pat_ev as (
+        select PATID,
+               min(INDEX_DATE) as INDEX_DATE,
+               min_by(SITE, case when {idx_cond} then CD_DATE end) as INDEX_SITE,
+               {(','+chr(10)+'               ').join(agg_cols)}
+        from ev
+        where INDEX_DATE is not null
+        group by PATID
+    )"""]
+
+    # outcome date per variant, first_overall variants checked against their window here
+    out_cols = []
+    for x in outcomes:
+        name = x["name"]
+        if x.get("first_overall"):
+            conds = _window_cond("INDEX_DATE", f"{name}_ANY_DATE", x.get("window", [None, None]))
+            out_cols.append(f"case when {' and '.join(conds) or 'true'} then {name}_ANY_DATE end as {name}_DATE")
+        else:
+            out_cols.append(f"{name}_DATE")
+    cte.append(f"""
+    pat_out as (
+        select PATID, INDEX_DATE, INDEX_SITE,
+               {(','+chr(10)+'               ').join(out_cols)}
+        from pat_ev
+    )""")
+
+    ##--- one scan per confirmation table, restricted to patients with a candidate outcome
+    conf = {}
+    for x in outcomes:
+        if "confirm" in x:
+            conf.setdefault(x["confirm"].get("src", "rx"), []).append(x)
+    for src, xs in conf.items():
+        tbl = log_tbl_rx if src == "rx" else log_tbl_dxpx
+        conf_cols = []
+        for x in xs:
+            conds = (
+                [f"o.{x['name']}_DATE is not null"] +
+                _event_cond(x["confirm"], x["confirm"].get("study_window"), prefix = "c.") +
+                _window_cond(f"o.{x['name']}_DATE", "c.CD_DATE", x["confirm"].get("window", [None, None]))
+            )
+            conf_cols.append(f"min(case when {' and '.join(conds)} then c.CD_DATE end) as {x['name']}_CONFIRM_DATE")
+        cte.append(f"""
+    conf_{src} as (
+        select o.PATID,
+               {(','+chr(10)+'               ').join(conf_cols)}
+        from pat_out o
+        join {tbl} c on o.PATID = c.PATID
+        where {' or '.join(f"o.{x['name']}_DATE is not null" for x in xs)}
+        group by o.PATID
+    )""")
+
+    ##--- wide result: date, days from index and indicator per variant
+    sel_cols = ["o.PATID", f"o.INDEX_DATE as {idx['name']}_DATE", f"o.INDEX_SITE as {idx['name']}_SITE"]
+    for x in outcomes:
+        name = x["name"]
+        if "confirm" in x:
+            c = "conf_" + x["confirm"].get("src", "rx")
+            out_date = f"case when {c}.{name}_CONFIRM_DATE is not null then o.{name}_DATE end"
+            sel_cols += [
+                f"{out_date} as {name}_DATE",
+                f"datediff('day',o.INDEX_DATE,{out_date}) as DAYS_TO_{name}",
+                f"{c}.{name}_CONFIRM_DATE",
+                f"datediff('day',o.{name}_DATE,{c}.{name}_CONFIRM_DATE) as DAYS_{name}_TO_CONFIRM",
+                f"case when {c}.{name}_CONFIRM_DATE is not null then 1 else 0 end as {name}_IND"
+            ]
+        else:
+            sel_cols += [
+                f"o.{name}_DATE",
+                f"datediff('day',o.INDEX_DATE,o.{name}_DATE) as DAYS_TO_{name}",
+                f"case when o.{name}_DATE is not null then 1 else 0 end as {name}_IND"
+            ]
+    joins = "".join(f"\n    left join conf_{src} on o.PATID = conf_{src}.PATID" for src in conf)
+    return (
+        "\n    with" + ",".join(cte) + "\n    select " + "\n          ,".join(sel_cols) +
+        "\n    from pat_out o" + joins + "\n    "
+    )
@@ -0,0 +1,185 @@
+import re
+import time
+import hashlib
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# stage graph runner for pipeline.py: stages run as soon as their dependencies are done, independent
+# stages side by side on one shared session, and a stage is skipped when its input fingerprint
+# (own inputs plus the fingerprints of its dependencies) matches the last successful run in the ledger
+# and none of its dependencies was rebuilt in this run
+
+LEDGER_SITE = "PIPELINE"
+
+class Stage:
+    def __init__(
+        self,
+        name, #stage name, also the ledger key
+        run, #callable(session), builds the stage output
+        deps = list(), #names of the stages that must finish first
+        inputs = None, #callable(session) returning a json-able description of the stage inputs, None to always run
+        exists = None #callable(session) returning False when the stage output is missing, so it is rebuilt even if fresh
+    ):
+        self.name = name
+        self.run = run
+        self.deps = list(deps)
+        self.inputs = inputs
+        self.exists = exists
+
+def file_hash(*paths):
+    # content hash of source files, so a code change invalidates the stage
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def _fingerprint(inputs, dep_fps):
+    return hashlib.sha256((repr(inputs) + "|" + "|".join(dep_fps)).encode("utf-8")).hexdigest()
+
+def _check_graph(stages):
+    names = {s.name for s in stages}
+    for s in stages:
+        missing = [d for d in s.deps if d not in names]
+        if missing:
+            raise ValueError(f"stage '{s.name}' depends on unknown stage(s): {', '.join(missing)}")
+    # kahn's algorithm, to fail early on cycles
+    indeg = {s.name: len(s.deps) for s in stages}
+    ready = [n for n, d in indeg.items() if d == 0]
+    seen = 0
+    while ready:
+        n = ready.pop()
+        seen += 1
+        for s in stages:
+            if n in s.deps:
+                indeg[s.name] -= 1
+                if indeg[s.name] == 0:
+                    ready.append(s.name)
+    if seen != len(stages):
+        raise ValueError("stage graph has a cycle")
+
+def run_pipeline(
+    session, #shared session, see connect_session; a TrackedSession tags the statements with the stage name
+    stages, #list of Stage
+    ledger, #LocalLedger or SnowLedger keeping the last successful fingerprint per stage
+    max_workers = 2, #stages running at the same time
+    force = list(), #stage names to run even if fresh, "all" for every stage
+    verbose = True
+):
+    _check_graph(stages)
+    by_name = {s.name: s for s in stages}
+    res = {s.name: {"stage": s.name, "deps": s.deps, "status": "pending", "start": None, "end": None, "elapsed": 0.0, "fingerprint": None, "error": None} for s in stages}
+    t0 = time.perf_counter()
+
+    def run_stage(stage):
+        out = res[stage.name]
+        out["start"] = round(time.perf_counter() - t0, 3)
+        try:
+            with session.tag(step = stage.name) if hasattr(session, "tag") else nullcontext():
+                inputs = stage.inputs(session) if stage.inputs is not None else None
+                fp = _fingerprint(inputs, [res[d]["fingerprint"] for d in stage.deps])
+                out["fingerprint"] = fp
+                if (
+                    stage.inputs is not None and "all" not in force and stage.name not in force and
+                    all(res[d]["status"] == "skipped" for d in stage.deps) and
+                    ledger.is_fresh(LEDGER_SITE, stage.name, fp, None) and
+                    (stage.exists is None or stage.exists(session))
+                ):
+                    out["status"] = "skipped"
+                else:
+                    stage.run(session)
+                    ledger.mark_done(LEDGER_SITE, stage.name, fp, None)
+                    out["status"] = "done"
+        except Exception as e:
+            out["status"], out["error"] = "failed", repr(e)
+        out["end"] = round(time.perf_counter() - t0, 3)
+        out["elapsed"] = round(out["end"] - out["start"], 3)
+        if verbose:
+            print(f"[{out['end']:>8.2f}s] {stage.name}: {out['status']} in {out['elapsed']}s" + (f" - {out['error']}" if out["error"] else ""))
+        return stage.name
+
+    # submit every stage whose dependencies are done; dependents of a failed stage are blocked
+    with ThreadPoolExecutor(max_workers = max(1, max_workers)) as pool:
+        running = set()
+        while True:
+            for s in stages:
+                if res[s.name]["status"] != "pending":
+                    continue
+                dep_status = [res[d]["status"] for d in s.deps]
+                if any(x in ("failed", "blocked") for x in dep_status):
+                    res[s.name]["status"] = "blocked"
+                    if verbose:
+                        print(f"{s.name}: blocked by a failed dependency")
+                elif all(x in ("done", "skipped") for x in dep_status):
+                    res[s.name]["status"] = "running"
+                    running.add(pool.submit(run_stage, by_name[s.name]))
+            if not running:
+                break
+            _, running = wait(running, return_when = FIRST_COMPLETED)
+    wall = round(time.perf_counter() - t0, 3)
+    return [res[s.name] for s in stages], wall
+
+def critical_path(results):
+    # chain of stages ending last: from the stage that finished last, follow the dependency that finished last
+    by_name = {r["stage"]: r for r in results if r["end"] is not None}
+    if not by_name:
+        return []
+    path = [max(by_name.values(), key = lambda r: r["end"])]
+    while True:
+        deps = [by_name[d] for d in path[-1]["deps"] if d in by_name]
+        if not deps:
+            break
+        path.append(max(deps, key = lambda r: r["end"]))
+    return [r["stage"] for r in reversed(path)]
+
+def print_pipeline_report(results, wall_time):
+    crit = critical_path(results)
+    print("stage\tstatus\tstart(s)\tend(s)\telapsed(s)\tcritical")
+    for r in sorted(results, key = lambda r: (r["start"] is None, r["start"] or 0)):
+        print(f"{r['stage']}\t{r['status']}\t{r['start']}\t{r['end']}\t{r['elapsed']}\t{'*' if r['stage'] in crit else ''}")
+    crit_time = round(sum(r["elapsed"] for r in results if r["stage"] in crit), 3)
+    serial_time = round(sum(r["elapsed"] for r in results), 3)
+    print(f"critical path: {' -> '.join(crit)} ({crit_time}s)")
+    print(f"wall time: {wall_time}s (serial sum: {serial_time}s)")
+
+def split_sql_script(script):
+    # statements of a snowflake worksheet, split on ';' outside comments, string literals and $$ bodies
+    stmts, buf, i, n = [], [], 0, len(script)
+    while i < n:
+        if script.startswith("$$", i):
+            j = script.find("$$", i + 2)
+            j = n if j < 0 else j + 2
+            buf.append(script[i:j])
+            i = j
+        elif script.startswith("--", i):
+            j = script.find("\n", i)
+            i = n if j < 0 else j
+        elif script.startswith("/*", i):
+            j = script.find("*/", i + 2)
+            i = n if j < 0 else j + 2
+        elif script[i] == "'":
+            m = re.compile(r"'(?:[^']|'')*'").match(script, i)
+            j = m.end() if m else n
+            buf.append(script[i:j])
+            i = j
+        elif script[i] == ";":
+            stmts.append("".join(buf).strip())
+            buf = []
+            i += 1
+        else:
+            buf.append(script[i])
+            i += 1
+    stmts.append("".join(buf).strip())
+    return [x for x in stmts if x]
+
+def run_sql_script(
+    session, #snowpark session
+    path, #worksheet in src/SQL
+    skip_select = True #leave out the ad hoc select statements used to eyeball the results
+):
+    with open(path, "r", encoding = "utf-8") as f:
+        stmts = split_sql_script(f.read())
+    for stmt in stmts:
+        if skip_select and re.match(r"(select|with)\b", stmt, re.IGNORECASE):
+            continue
+        session.sql(stmt).collect()
@@ -0,0 +1,168 @@
+import json
+import hashlib
+from datetime import datetime, timedelta, timezone
+
+# cache of shared intermediate results: a derivation step used several times downstream (e.g. the
+# ktx index of ktx_tbl1.py, re-inlined by snowpark into every join that reads it) is written once
+# to a transient table named after a hash of its query, parameters and input table versions. a rerun
+# with unchanged inputs reads the table instead of computing it again. a registry table records the
+# entries; entries not used for max_age_days, or beyond max_entries/max_rows/max_bytes (least
+# recently used first), are dropped after every new entry
+
+RESULT_CACHE_VERSION = "1"
+
+def _now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+def _is_duck(session):
+    # DuckSession, also behind a TrackedSession
+    return hasattr(session, "get_src_version")
+
+def table_version(
+    session, #snowpark session or DuckSession
+    tbl_name #table in the current schema
+):
+    # snowflake: last DDL/DML time and row count from the information schema; duckdb keeps no
+    # modification time, so the row count and an order-independent checksum of the rows
+    if _is_duck(session):
+        rows = session.sql(f"SELECT count(*), cast(sum(hash(t)) as varchar) FROM {tbl_name} t").collect()
+    else:
+        rows = session.sql(f"""
+            SELECT LAST_ALTERED, ROW_COUNT FROM INFORMATION_SCHEMA.TABLES
+            WHERE TABLE_SCHEMA = current_schema() AND TABLE_NAME = '{tbl_name.upper()}'
+        """).collect()
+    return [str(x) for x in rows[0]] if len(rows) > 0 else None
+
+class ResultCache:
+    def __init__(
+        self,
+        session, #snowpark session or DuckSession, current schema set
+        registry_tbl = "KTX_RESULT_CACHE", #registry table of the cached entries
+        prefix = "KTX_CACHE_", #name prefix of the cached tables
+        max_age_days = 7, #entries not used for this long are dropped, None to keep them
+        max_entries = 20, #entries kept, most recently used first, None for no limit
+        max_rows = None, #total rows kept, None for no limit
+        max_bytes = None #total bytes kept, snowflake only, None for no limit
+    ):
+        self.session = session
+        self.registry_tbl = registry_tbl
+        self.prefix = prefix
+        self.max_age_days = max_age_days
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.hits, self.misses = [], []
+        session.sql(f"""
+            CREATE TABLE IF NOT EXISTS {registry_tbl} (
+                CACHE_KEY varchar, NAME varchar, TBL_NAME varchar, INPUTS varchar,
+                ROW_CNT bigint, BYTES bigint, CREATED_AT varchar, LAST_USED_AT varchar
+            )
+        """).collect()
+
+    def cache_key(self, name, qry, inputs, params):
+        versions = {t: table_version(self.session, t) for t in inputs}
+        key_src = json.dumps(
+            {"version": RESULT_CACHE_VERSION, "name": name, "qry": qry, "inputs": versions, "params": params},
+            sort_keys = True, default = str
+        )
+        return hashlib.sha256(key_src.encode("utf-8")).hexdigest(), versions
+
+    def _table_exists(self, tbl_name):
+        if _is_duck(self.session):
+            qry = f"SELECT 1 FROM duckdb_tables() WHERE schema_name = current_schema() AND table_name = '{tbl_name}'"
+        else:
+            qry = f"SELECT 1 FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = current_schema() AND TABLE_NAME = '{tbl_name}'"
+        return len(self.session.sql(qry).collect()) > 0
+
+    def _lookup(self, key):
+        rows = self.session.sql(f"SELECT TBL_NAME FROM {self.registry_tbl} WHERE CACHE_KEY = '{key}'").collect()
+        if len(rows) > 0 and self._table_exists(rows[0][0]):
+            self.session.sql(f"UPDATE {self.registry_tbl} SET LAST_USED_AT = '{_now()}' WHERE CACHE_KEY = '{key}'").collect()
+            return rows[0][0]
+        return None
+
+    def _register(self, key, name, tbl_name, versions):
+        if _is_duck(self.session):
+            row_cnt, n_bytes = self.session.sql(f"SELECT count(*) FROM {tbl_name}").collect()[0][0], None
+        else:
+            rows = self.session.sql(f"""
+                SELECT ROW_COUNT, BYTES FROM INFORMATION_SCHEMA.TABLES
+                WHERE TABLE_SCHEMA = current_schema() AND TABLE_NAME = '{tbl_name}'
+            """).collect()
+            row_cnt, n_bytes = rows[0] if len(rows) > 0 else (None, None)
+        now = _now()
+        inputs = json.dumps(versions, sort_keys = True).replace("'", "''")
+        self.session.sql(f"DELETE FROM {self.registry_tbl} WHERE CACHE_KEY = '{key}'").collect()
+        self.session.sql(f"""
+            INSERT INTO {self.registry_tbl} (CACHE_KEY, NAME, TBL_NAME, INPUTS, ROW_CNT, BYTES, CREATED_AT, LAST_USED_AT)
+            VALUES ('{key}', '{name}', '{tbl_name}', '{inputs}', {'NULL' if row_cnt is None else int(row_cnt)},
+                    {'NULL' if n_bytes is None else int(n_bytes)}, '{now}', '{now}')
+        """).collect()
+
+    def materialize_sql(
+        self,
+        name, #entry name, part of the table name, e.g. "KTX_IDX"
+        qry, #select statement building the result
+        inputs = list(), #tables the query reads, their versions are part of the key
+        params = dict() #anything else the result depends on
+    ):
+        # name of a table holding the result of qry, built only when no entry with the same key exists
+        key, versions = self.cache_key(name, qry, inputs, params)
+        tbl_name = self._lookup(key)
+        if tbl_name is not None:
+            self.hits.append(name)
+            return tbl_name
+        self.misses.append(name)
+        tbl_name = f"{self.prefix}{name}_{key[:12]}".upper()
+        create_stmt = "CREATE OR REPLACE TABLE" if _is_duck(self.session) else "CREATE OR REPLACE TRANSIENT TABLE"
+        self.session.sql(f"{create_stmt} {tbl_name} AS {qry}").collect()
+        self._register(key, name, tbl_name, versions)
+        self.evict(keep = [key])
+        return tbl_name
+
+    def materialize(
+        self,
+        name, #entry name, see materialize_sql
+        df, #snowpark DataFrame building the result; its generated sql is part of the key
+        inputs = list(),
+        params = dict()
+    ):
+        # same as materialize_sql for a snowpark DataFrame, returns a DataFrame over the cached table
+        return self.session.table(self.materialize_sql(name, df.queries["queries"][-1], inputs, params))
+
+    def evict(
+        self,
+        keep = list() #keys never dropped, e.g. the entries used by the current run
+    ):
+        rows = self.session.sql(f"""
+            SELECT CACHE_KEY, TBL_NAME, ROW_CNT, BYTES, LAST_USED_AT FROM {self.registry_tbl}
+            ORDER BY LAST_USED_AT DESC
+        """).collect()
+        cutoff = (
+            (datetime.now(timezone.utc) - timedelta(days = self.max_age_days)).strftime("%Y-%m-%d %H:%M:%S")
+            if self.max_age_days is not None else None
+        )
+        drop, n_kept, rows_kept, bytes_kept = [], 0, 0, 0
+        for key, tbl_name, row_cnt, n_bytes, last_used in rows:
+            over = (
+                (cutoff is not None and last_used < cutoff) or
+                (self.max_entries is not None and n_kept + 1 > self.max_entries) or
+                (self.max_rows is not None and rows_kept + (row_cnt or 0) > self.max_rows) or
+                (self.max_bytes is not None and bytes_kept + (n_bytes or 0) > self.max_bytes)
+            )
+            if over and key not in keep:
+                drop.append((key, tbl_name))
+                continue
+            n_kept, rows_kept, bytes_kept = n_kept + 1, rows_kept + (row_cnt or 0), bytes_kept + (n_bytes or 0)
+        for key, tbl_name in drop:
+            self.session.sql(f"DROP TABLE IF EXISTS {tbl_name}").collect()
+            self.session.sql(f"DELETE FROM {self.registry_tbl} WHERE CACHE_KEY = '{key}'").collect()
+        return [t for _, t in drop]
+
+    def clear(self):
+        # drop every cached table
+        rows = self.session.sql(f"SELECT CACHE_KEY, TBL_NAME FROM {self.registry_tbl}").collect()
+        for key, tbl_name in rows:
+            self.session.sql(f"DROP TABLE IF EXISTS {tbl_name}").collect()
+            self.session.sql(f"DELETE FROM {self.registry_tbl} WHERE CACHE_KEY = '{key}'").collect()
+        return [r[1] for r in rows]
@@ -0,0 +1,99 @@
+import hashlib
+import numpy as np
+
+# deterministic patient sampling for development runs: a patient is in the sample when the first
+# 8 hex digits of md5(PATID) fall below pct% of the range. the same predicate is pushed into every
+# source scan (QueryFromJson, PAT_TABLE1, ALL_OBS), so a given pct always keeps the same patients
+# in every table and on both backends, and a smaller sample is a subset of a larger one.
+# sampled runs write to their own schema (sample_schema) and report the projected full-run time
+
+SAMPLE_HEX_DIGITS = 8
+
+def _threshold(pct):
+    if not 0 < pct <= 100:
+        raise ValueError(f"sample pct must be in (0, 100], got {pct}")
+    return format(min(int(round(pct / 100 * 16 ** SAMPLE_HEX_DIGITS)), 16 ** SAMPLE_HEX_DIGITS - 1), f"0{SAMPLE_HEX_DIGITS}x")
+
+def gen_sample_predicate(
+    pct, #percent of patients kept, e.g. 1; None for no sampling
+    field = "PATID", #patient id column, qualified if needed, e.g. "d.PATID"
+    salt = "" #changes which patients are drawn, same salt for the whole run
+):
+    # plain sql for snowflake and duckdb (md5 returns lowercase hex in both); "1 = 1" without sampling
+    if pct is None or pct >= 100:
+        return "1 = 1"
+    key = f"'{salt}' || {field}" if salt else field
+    return f"substring(md5({key}),1,{SAMPLE_HEX_DIGITS}) < '{_threshold(pct)}'"
+
+def in_sample(
+    patids, #iterable of patient ids
+    pct, #see gen_sample_predicate
+    salt = ""
+):
+    # local version of gen_sample_predicate, boolean array
+    if pct is None or pct >= 100:
+        return np.ones(len(patids), dtype = bool)
+    thr = _threshold(pct)
+    return np.array([
+        x is not None and hashlib.md5((salt + str(x)).encode("utf-8")).hexdigest()[:SAMPLE_HEX_DIGITS] < thr
+        for x in patids
+    ], dtype = bool)
+
+def sample_schema(
+    schema, #schema of the full run, e.g. "SX_CISTEM2"
+    pct #see gen_sample_predicate
+):
+    # "SX_CISTEM2" -> "SX_CISTEM2_S1" for a 1% sample, "SX_CISTEM2_S0_5" for 0.5%
+    if pct is None or pct >= 100:
+        return schema
+    return f"{schema}_S{format(pct, 'g').replace('.', '_')}"
+
+def use_sample_schema(
+    session, #snowpark session or DuckSession
+    schema, #schema of the full run, e.g. "SX_CISTEM2"
+    pct #see gen_sample_predicate
+):
+    # switches to sample_schema(schema, pct); the sampled schema is created on first use, snowpark's
+    # use_schema does not create it (DuckSession.use_schema does)
+    name = sample_schema(schema, pct)
+    if name != schema:
+        session.sql(f"CREATE SCHEMA IF NOT EXISTS {name}").collect()
+    session.use_schema(name)
+    return name
+
+def project_stage_times(
+    results, #stage results of run_pipeline, or any list of dicts with "stage", "deps" and "elapsed"
+    pct #sample percent the results were measured on
+):
+    # each stage scaled linearly to the full patient count, then the stage graph replayed with
+    # unlimited workers: returns ({stage: projected seconds}, projected wall seconds)
+    scale = 100 / pct
+    proj = {r["stage"]: r["elapsed"] * scale for r in results}
+    end = {}
+    def finish(name):
+        if name not in end:
+            r = next(x for x in results if x["stage"] == name)
+            end[name] = max([finish(d) for d in r["deps"] if d in proj] + [0.0]) + proj[name]
+        return end[name]
+    wall = max([finish(r["stage"]) for r in results] + [0.0])
+    return proj, wall
+
+def print_projection(
+    pct, #sample percent
+    wall_time, #measured wall time of the sampled run, seconds
+    results = None #stage results of run_pipeline, for a per-stage projection
+):
+    # linear in the number of patients: steps dominated by scanning the full source views (the
+    # sample filter is applied during the scan) come in under it
+    if pct is None or pct >= 100:
+        return
+    print(f"sampled {pct}% of patients: {round(wall_time, 3)}s")
+    if results:
+        proj, wall = project_stage_times(results, pct)
+        skipped = [r["stage"] for r in results if r["status"] == "skipped"]
+        print("stage\tsampled(s)\tprojected(s)")
+        for r in results:
+            print(f"{r['stage']}\t{r['elapsed']}\t{round(proj[r['stage']], 1)}")
+        print(f"projected full run: {round(wall, 1)}s on the stage graph" + (f" (skipped, not projected: {', '.join(skipped)})" if skipped else ""))
+    else:
+        print(f"projected full run: {round(wall_time * 100 / pct, 1)}s")
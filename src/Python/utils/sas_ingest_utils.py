@@ -0,0 +1,367 @@
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor, as_completed
+try:
+    import resource
+except ImportError:
+    # not on windows, peak memory is not reported there
+    resource = None
+
+# SRTR SAF (sas7bdat, or sas transport .xpt) to parquet: each source file is read in chunks with
+# only the projected columns, typed from the SAS metadata rather than from the data (numerics as
+# double, SAS date/datetime formats as date32/timestamp, text as string with "" as null), so every
+# chunk and every file of a table gets the same arrow schema. rows are written to hive-style
+# partitions by the year of a date column (SRTR_PART_COLS), one file per source file and partition:
+#   <out_dir>/<TABLE>/<COL>_YEAR=<year>/<source stem>.parquet
+# files are converted side by side in worker processes, the chunk size of each worker follows a
+# memory budget. <out_dir>/_manifest.json records the finished files by size, modification time and
+# settings, so a rerun converts only new or changed files and drops the output of removed ones
+
+SAS_INGEST_VERSION = "1"
+SAS_EXTS = (".sas7bdat", ".xpt")
+
+# partition column by table, the year of the date is the partition; other tables get one partition
+SRTR_PART_COLS = {
+    "TX_KI": "REC_TX_DT", "TX_KP": "REC_TX_DT", "TX_PA": "REC_TX_DT",
+    "TXF_KI": "REC_TX_DT", "TXF_KP": "REC_TX_DT", "TXF_PA": "REC_TX_DT",
+    "CAND_KIPA": "CAN_LISTING_DT"
+}
+
+# SAS formats read as dates (days since 1960-01-01) and datetimes (seconds since 1960-01-01)
+SAS_DATE_FMTS = {
+    "DATE", "DDMMYY", "DDMMYYB", "DDMMYYD", "DDMMYYN", "DDMMYYP", "DDMMYYS", "MMDDYY", "MMDDYYB", "MMDDYYD",
+    "MMDDYYN", "MMDDYYP", "MMDDYYS", "YYMMDD", "YYMMDDB", "YYMMDDD", "YYMMDDN", "YYMMDDP", "YYMMDDS", "MONYY",
+    "YYMON", "WEEKDATE", "WEEKDATX", "WORDDATE", "WORDDATX", "JULIAN", "NLDATE", "E8601DA", "B8601DA", "MINGUO", "YEAR"
+}
+SAS_DATETIME_FMTS = {"DATETIME", "DATEAMPM", "E8601DT", "B8601DT", "E8601DZ", "B8601DZ", "NLDATM", "MDYAMPM"}
+SAS_EPOCH_DAYS = 3653 #1960-01-01 to 1970-01-01
+
+# bytes a row takes while a chunk is converted: the dict chunk, the arrow table and the partition slices
+CHUNK_MEM_FACTOR = 4
+CHUNK_ROWS_RANGE = (1000, 1000000)
+
+def _now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+def _sas_fmt_name(fmt):
+    # "DATE9." -> "DATE", "E8601DA10." -> "E8601DA", "$12." -> "$"
+    return re.match(r"^(.*?)(\d+)?(\.\d*)?$", (fmt or "").upper().strip()).group(1)
+
+def _sas_reader(path):
+    import pyreadstat
+    return pyreadstat.read_xport if path.lower().endswith(".xpt") else pyreadstat.read_sas7bdat
+
+def sas_table_name(path):
+    # tx_ki.sas7bdat -> TX_KI
+    return os.path.splitext(os.path.basename(path))[0].upper()
+
+def sas_arrow_schema(
+    meta, #pyreadstat metadata of the file
+    cols = None #projected columns, None for all
+):
+    # arrow schema from the SAS variable types and formats, independent of the values of any chunk
+    import pyarrow as pa
+    fields = []
+    for c in (cols or meta.column_names):
+        if meta.readstat_variable_types[c] == "string":
+            typ = pa.string()
+        else:
+            fmt = _sas_fmt_name(meta.original_variable_types.get(c))
+            typ = pa.date32() if fmt in SAS_DATE_FMTS else pa.timestamp("s") if fmt in SAS_DATETIME_FMTS else pa.float64()
+        fields.append(pa.field(c, typ))
+    return pa.schema(fields)
+
+def sas_chunk_rows(
+    meta, #pyreadstat metadata of the file
+    cols, #projected columns
+    mem_mb #memory budget of one worker
+):
+    # rows per chunk so that a chunk in conversion stays within the budget
+    width = sum(
+        8 if meta.readstat_variable_types[c] != "string" else 56 + meta.variable_storage_width.get(c, 8)
+        for c in cols
+    )
+    rows = int(mem_mb * 1024 * 1024 / (CHUNK_MEM_FACTOR * max(width, 1)))
+    return min(max(rows, CHUNK_ROWS_RANGE[0]), CHUNK_ROWS_RANGE[1])
+
+def _to_arrow(chunk, schema):
+    # raw SAS values (dict of numpy arrays, dates not converted) into the file schema
+    import numpy as np
+    import pyarrow as pa
+    arrays = []
+    for f in schema:
+        x = chunk[f.name]
+        if pa.types.is_string(f.type):
+            arrays.append(pa.array([None if v is None or v == "" else v for v in x], type = pa.string()))
+            continue
+        x = np.asarray(x, dtype = "float64")
+        mask = np.isnan(x)
+        if pa.types.is_date32(f.type):
+            arrays.append(pa.array(np.where(mask, 0, x - SAS_EPOCH_DAYS).astype("int32"), mask = mask).cast(pa.date32()))
+        elif pa.types.is_timestamp(f.type):
+            arrays.append(pa.array(np.where(mask, 0, x - SAS_EPOCH_DAYS * 86400).astype("int64"), mask = mask).cast(f.type))
+        else:
+            arrays.append(pa.array(x, mask = mask))
+    return pa.Table.from_arrays(arrays, schema = schema)
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    # kilobytes on linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def convert_sas_file(
+    src, #sas7bdat or xpt file
+    tbl_dir, #output folder of its table, <out_dir>/<TABLE>
+    cols = None, #projected columns, None for all
+    part_col = None, #date column partitioned by year, None for one partition
+    mem_mb = 512, #memory budget, sets the chunk size
+    chunk_rows = None, #fixed chunk size instead of the budget
+    compression = "zstd"
+):
+    # one source file into its partition files; runs in a worker process, returns its manifest entry
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    start = time.perf_counter()
+    reader = _sas_reader(src)
+    _, meta = reader(src, metadataonly = True)
+    missing = [c for c in (cols or []) + ([part_col] if part_col else []) if c not in meta.column_names]
+    if missing:
+        raise ValueError(f"{src}: no column(s) {', '.join(missing)}")
+    cols = list(cols or meta.column_names)
+    read_cols = cols + ([part_col] if part_col and part_col not in cols else [])
+    schema = sas_arrow_schema(meta, read_cols)
+    out_schema = pa.schema([f for f in schema if f.name in cols])
+    if part_col and not pa.types.is_date32(schema.field(part_col).type) and not pa.types.is_timestamp(schema.field(part_col).type):
+        raise ValueError(f"{src}: partition column {part_col} has no SAS date format")
+    chunk_rows = chunk_rows or sas_chunk_rows(meta, read_cols, mem_mb)
+    stem = os.path.splitext(os.path.basename(src))[0]
+
+    # one writer per partition, files renamed into place once the whole source file is read
+    writers, n_rows, n_chunks, offset = {}, 0, 0, 0
+    try:
+        while True:
+            chunk, _ = reader(
+                src, usecols = read_cols, row_offset = offset, row_limit = chunk_rows,
+                disable_datetime_conversion = True, output_format = "dict"
+            )
+            n = len(chunk[read_cols[0]]) if read_cols else 0
+            if n == 0:
+                break
+            tbl = _to_arrow(chunk, schema)
+            del chunk
+            if part_col:
+                years = pc.year(tbl[part_col])
+                parts = [(y, tbl.filter(pc.equal(years, y)) if y is not None else tbl.filter(pc.is_null(years))) for y in pc.unique(years).to_pylist()]
+            else:
+                parts = [("all", tbl)]
+            for y, part in parts:
+                key = "all" if not part_col else f"{part_col.removesuffix('_DT')}_YEAR={'__HIVE_DEFAULT_PARTITION__' if y is None else y}"
+                if key not in writers:
+                    os.makedirs(os.path.join(tbl_dir, key), exist_ok = True)
+                    path = os.path.join(tbl_dir, key, stem + ".parquet")
+                    writers[key] = (path, pq.ParquetWriter(path + ".tmp", out_schema, compression = compression))
+                writers[key][1].write_table(part.select(out_schema.names))
+            n_rows, n_chunks, offset = n_rows + n, n_chunks + 1, offset + n
+            if n < chunk_rows:
+                break
+    except BaseException:
+        for path, w in writers.values():
+            w.close()
+            os.remove(path + ".tmp")
+        raise
+    for path, w in writers.values():
+        w.close()
+        os.replace(path + ".tmp", path)
+    return {
+        "table": os.path.basename(tbl_dir),
+        "rows": n_rows,
+        "chunks": n_chunks,
+        "chunk_rows": chunk_rows,
+        "files": sorted(os.path.relpath(p, os.path.dirname(tbl_dir)) for p, _ in writers.values()),
+        "schema": {f.name: str(f.type) for f in out_schema},
+        "elapsed": round(time.perf_counter() - start, 3),
+        "peak_rss_mb": _peak_rss_mb()
+    }
+
+def _load_manifest(path):
+    if os.path.exists(path):
+        with open(path, "r", encoding = "utf-8") as f:
+            return json.load(f)
+    return {"files": {}}
+
+def _save_manifest(path, manifest):
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "w", encoding = "utf-8") as f:
+        json.dump(manifest, f, indent = 4)
+    os.replace(tmp_file, path)
+
+def _remove_outputs(out_dir, entry):
+    for f in entry.get("files", []):
+        path = os.path.join(out_dir, f)
+        if os.path.exists(path):
+            os.remove(path)
+        # empty partition and table folders go too
+        for d in [os.path.dirname(path), os.path.dirname(os.path.dirname(path))]:
+            if os.path.isdir(d) and d != os.path.normpath(out_dir) and not os.listdir(d):
+                os.rmdir(d)
+
+def find_sas_files(src):
+    # a file, or every sas7bdat/xpt file under a folder
+    if os.path.isfile(src):
+        return [src]
+    return sorted(
+        os.path.join(root, f) for root, _, files in os.walk(src) for f in files if f.lower().endswith(SAS_EXTS)
+    )
+
+def ingest_sas(
+    src, #sas7bdat/xpt file or folder, e.g. the unpacked pubsaf2409 export
+    out_dir, #parquet root, one folder per table
+    tables = None, #tables to convert, e.g. ["TX_KI","CAND_KIPA"]; None for all
+    cols = dict(), #{table: [columns]} projections, tables not listed keep all columns
+    part_cols = SRTR_PART_COLS, #{table: date column}, see SRTR_PART_COLS
+    max_workers = 2, #files converted at the same time, one process each
+    mem_mb = 512, #memory budget of each worker, see sas_chunk_rows
+    chunk_rows = None, #fixed chunk size instead of the budget
+    overwrite = False, #convert every file again instead of only new or changed ones
+    compression = "zstd",
+    verbose = True
+):
+    files = [f for f in find_sas_files(src) if tables is None or sas_table_name(f) in tables]
+    manifest_file = os.path.join(out_dir, "_manifest.json")
+    os.makedirs(out_dir, exist_ok = True)
+    manifest = {"files": {}} if overwrite else _load_manifest(manifest_file)
+    if overwrite:
+        for tbl in {sas_table_name(f) for f in files}:
+            shutil.rmtree(os.path.join(out_dir, tbl), ignore_errors = True)
+
+    ##--- fingerprint of each file: what it is and how it would be converted
+    tasks, todo_keys = [], set()
+    for f in files:
+        tbl = sas_table_name(f)
+        settings = {
+            "version": SAS_INGEST_VERSION, "cols": cols.get(tbl), "part_col": part_cols.get(tbl),
+            "compression": compression
+        }
+        fp = hashlib.sha256(json.dumps(
+            {"size": os.path.getsize(f), "mtime": os.path.getmtime(f), **settings}, sort_keys = True
+        ).encode("utf-8")).hexdigest()[:16]
+        key = os.path.abspath(f)
+        todo_keys.add(key)
+        entry = manifest["files"].get(key)
+        if entry is not None and entry.get("status") == "done" and entry.get("fingerprint") == fp:
+            continue
+        if entry is not None:
+            _remove_outputs(out_dir, entry)
+        tasks.append((key, fp, dict(
+            src = f, tbl_dir = os.path.join(out_dir, tbl), cols = cols.get(tbl), part_col = part_cols.get(tbl),
+            mem_mb = mem_mb, chunk_rows = chunk_rows, compression = compression
+        )))
+
+    ##--- files gone from the source are dropped from the output, when all tables are converted
+    if tables is None:
+        for key in [k for k in manifest["files"] if k not in todo_keys and k.startswith(os.path.abspath(src))]:
+            _remove_outputs(out_dir, manifest["files"].pop(key))
+    _save_manifest(manifest_file, manifest)
+    if verbose:
+        print(f"{len(files) - len(tasks)} file(s) up to date, {len(tasks)} file(s) to convert")
+
+    ##--- largest files first, so the long ones do not start last
+    tasks.sort(key = lambda t: -os.path.getsize(t[2]["src"]))
+    results, failed = [], []
+    start = time.perf_counter()
+
+    def done(key, fp, out = None, err = None):
+        entry = {"status": "done", "fingerprint": fp, **out, "updated_at": _now()} if err is None else \
+                {"status": "failed", "fingerprint": fp, "error": err, "updated_at": _now()}
+        manifest["files"][key] = entry
+        _save_manifest(manifest_file, manifest)
+        results.append({"src": key, **entry})
+        if err is not None:
+            failed.append(key)
+        if verbose:
+            print(f"[{time.perf_counter() - start:>8.2f}s] {os.path.basename(key)}: " + (
+                f"{out['rows']} row(s) in {out['chunks']} chunk(s) of {out['chunk_rows']}, {out['elapsed']}s, peak {out['peak_rss_mb']} MB"
+                if err is None else f"failed - {err}"
+            ))
+
+    if max_workers <= 1 or len(tasks) <= 1:
+        for key, fp, kw in tasks:
+            try:
+                done(key, fp, convert_sas_file(**kw))
+            except Exception as e:
+                done(key, fp, err = repr(e))
+    else:
+        # a fresh process per file, so each file starts from an empty heap and reports its own peak
+        with ProcessPoolExecutor(max_workers = max_workers, max_tasks_per_child = 1) as pool:
+            futures = {pool.submit(convert_sas_file, **kw): (key, fp) for key, fp, kw in tasks}
+            for fut in as_completed(futures):
+                key, fp = futures[fut]
+                try:
+                    done(key, fp, fut.result())
+                except Exception as e:
+                    done(key, fp, err = repr(e))
+
+    manifest["finished_at"] = _now()
+    _save_manifest(manifest_file, manifest)
+    if failed:
+        raise RuntimeError(f"sas ingestion failed for: {', '.join(os.path.basename(k) for k in failed)}; rerun to resume")
+    return results
+
+def gen_synthetic_sas(
+    out_dir, #folder the files are written to
+    n_pat = 10000, #transplant recipients
+    seed = 0
+):
+    # small SRTR-like SAS transport files for testing ingest_sas: tx_ki.xpt and cand_kipa.xpt with
+    # SAS dates (some missing), numerics with missing values and text columns. pyreadstat writes
+    # transport files only, the sas7bdat path of ingest_sas reads through the same code
+    import numpy as np
+    import pandas as pd
+    import pyreadstat
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok = True)
+
+    def dates(n, lo, hi, p_null = 0.0):
+        d = pd.to_datetime(rng.integers(pd.Timestamp(lo).value // 10**9, pd.Timestamp(hi).value // 10**9, n), unit = "s").normalize()
+        return pd.Series(d).mask(rng.random(n) < p_null)
+
+    px_id = np.arange(1, n_pat + 1, dtype = "float64")
+    listing = dates(n_pat, "2000-01-01", "2019-12-31")
+    tx = listing + pd.to_timedelta(rng.integers(0, 1500, n_pat), unit = "D")
+    tx_ki = pd.DataFrame({
+        "PX_ID": px_id,
+        "TRR_ID": px_id + 5e6,
+        "PERS_ID": px_id + 1e7,
+        "REC_TX_DT": tx.dt.date,
+        "REC_FAIL_DT": (tx + pd.to_timedelta(rng.integers(30, 4000, n_pat), unit = "D")).mask(rng.random(n_pat) < 0.8).dt.date,
+        "REC_AGE_AT_TX": rng.integers(18, 80, n_pat).astype("float64"),
+        "CAN_GENDER": rng.choice(["M", "F"], n_pat),
+        "DON_TY": rng.choice(["C", "L"], n_pat, p = [0.7, 0.3]),
+        "REC_CREAT": np.where(rng.random(n_pat) < 0.1, np.nan, rng.lognormal(0.5, 0.5, n_pat).round(2)),
+        "REC_CTR_CD": rng.choice(["KSUM", "MOUM", "IAIV", "NEUN", ""], n_pat)
+    })
+    cand_kipa = pd.DataFrame({
+        "PX_ID": px_id,
+        "PERS_ID": px_id + 1e7,
+        "CAN_LISTING_DT": listing.dt.date,
+        "CAN_REM_DT": tx.mask(rng.random(n_pat) < 0.1).dt.date,
+        "CAN_ABO": rng.choice(["A", "B", "AB", "O"], n_pat),
+        "CAN_BMI": np.where(rng.random(n_pat) < 0.05, np.nan, rng.normal(28, 5, n_pat).round(1)),
+        "CAN_LISTING_CTR_CD": rng.choice(["KSUM", "MOUM", "IAIV", "NEUN"], n_pat)
+    })
+    written = []
+    for name, df, date_cols in [
+        ("tx_ki", tx_ki, ["REC_TX_DT", "REC_FAIL_DT"]),
+        ("cand_kipa", cand_kipa, ["CAN_LISTING_DT", "CAN_REM_DT"])
+    ]:
+        path = os.path.join(out_dir, name + ".xpt")
+        pyreadstat.write_xport(df, path, table_name = name.upper()[:8], variable_format = {c: "DATE9." for c in date_cols})
+        written.append(path)
+    return written
@@ -0,0 +1,36 @@
+import os
+import json
+from .duckdb_utils import DuckSession
+
+def connect_snow(
+    path_to_config = None #json file with a "snowflake-deid-api" entry, defaults to .config.json at the repo root
+):
+    # snowpark session on the GROUSE deid database
+    from snowflake.snowpark import Session
+    if path_to_config is None:
+        path_to_config = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))), '.config.json')
+    with open(path_to_config,"r") as f:
+        config = json.load(f)
+        connect_params = {
+            "account": config["snowflake-deid-api"]["acct"],
+            "user": config["snowflake-deid-api"]["user"],
+            "password":config["snowflake-deid-api"]["pwd"],
+            "role": config["snowflake-deid-api"]["role"],
+            "warehouse": config["snowflake-deid-api"]["wh"]
+        }
+    session = Session.builder.configs(connect_params).create()
+    # test connection
+    # print(session.sql("SELECT CURRENT_USER(), CURRENT_ROLE(), CURRENT_DATABASE()").collect())
+    session.use_database(config["snowflake-deid-api"]["db"])
+    return session
+
+def connect_session(
+    backend = "snow", #"snow" or "duckdb"
+    duckdb_file = ":memory:", #duckdb backend: database file the derived tables are written to
+    cdm_root = None, #duckdb backend: root folder of the parquet extracts
+    threads = None #duckdb backend: threads per query
+):
+    # both session types work as context managers and expose sql(...).collect(), use_schema and write_pandas
+    if backend == "duckdb":
+        return DuckSession(duckdb_file, cdm_root = cdm_root, threads = threads)
+    return connect_snow()
@@ -0,0 +1,122 @@
+import time
+import random
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+class LocalSession:
+    # stand-in for a snowpark session: records every statement and sleeps to simulate
+    # warehouse latency, so the fan-out logic can be exercised without snowflake
+    def __init__(
+        self,
+        latency = 0.1, #seconds per statement, or (min,max) tuple for a random latency
+        fail_on = dict(), #{substring: number of times a statement containing it should fail}
+        seed = None #random seed for latency draws
+    ):
+        self.latency = latency
+        self.fail_on = dict(fail_on)
+        self.queries = []
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sql(self, query, params = None):
+        return LocalSqlResult(self, query)
+
+    def _execute(self, query):
+        with self._lock:
+            if isinstance(self.latency, (tuple, list)):
+                wait = self._rng.uniform(*self.latency)
+            else:
+                wait = self.latency
+            fail = None
+            for k, n in self.fail_on.items():
+                if k in query and n > 0:
+                    self.fail_on[k] = n - 1
+                    fail = k
+                    break
+        time.sleep(wait)
+        with self._lock:
+            self.queries.append({"sql": query, "thread": threading.current_thread().name, "failed": fail is not None})
+        if fail is not None:
+            raise RuntimeError(f"simulated failure on '{fail}'")
+        return []
+
+class LocalSqlResult:
+    def __init__(self, session, query):
+        self.session = session
+        self.query = query
+
+    def collect(self):
+        return self.session._execute(self.query)
+
+def run_site_tasks(
+    session, #snowpark session (thread-safe) or a stand-in exposing sql(...).collect()
+    tasks, #list of dicts with keys "site", "slice" and "sql"; sql is a statement or a list of statements that is safe to rerun as a whole, a statement is a string or a (string, params) tuple
+    max_workers = 4, #concurrency limit; 1 runs the tasks one after another
+    retries = 2, #extra attempts per task before it is marked as failed
+    retry_wait = 5, #seconds to wait before the first retry, doubled every attempt
+    verbose = True, #print a line as each task finishes
+    on_done = None #callback(task) run in the worker after a task succeeds, e.g. to checkpoint it
+):
+    # tags set by the caller (e.g. the pipeline stage) carry over to the worker threads
+    parent_tags = session.current_tags() if hasattr(session, "current_tags") else {}
+
+    def run_task(task):
+        start = time.perf_counter()
+        attempt, err = 0, None
+        stmts = [task["sql"]] if isinstance(task["sql"], str) else task["sql"]
+        while attempt <= retries:
+            attempt += 1
+            try:
+                # a TrackedSession records the statements under the task's site and slice, which
+                # replace a site or slice the caller tagged
+                tags = {**parent_tags, "site": task["site"], "slice": task["slice"], "attempt": attempt}
+                with session.tag(**tags) if hasattr(session, "tag") else nullcontext():
+                    for stmt in stmts:
+                        if isinstance(stmt, tuple):
+                            session.sql(stmt[0], params = stmt[1]).collect()
+                        else:
+                            session.sql(stmt).collect()
+                if on_done is not None:
+                    on_done(task)
+                err = None
+                break
+            except Exception as e:
+                err = e
+                if attempt <= retries:
+                    time.sleep(retry_wait * 2**(attempt-1))
+        out = {
+            "site": task["site"],
+            "slice": task["slice"],
+            "status": "failed" if err is not None else "done",
+            "attempts": attempt,
+            "elapsed": round(time.perf_counter() - start, 3),
+            "error": repr(err) if err is not None else None
+        }
+        if verbose:
+            print(f"{out['site']}-{out['slice']}: {out['status']} in {out['elapsed']}s ({attempt} attempt(s))")
+        return out
+
+    # failures are isolated per task - the remaining sites keep running
+    with ThreadPoolExecutor(max_workers = max(1, max_workers)) as pool:
+        results = list(pool.map(run_task, tasks))
+    return results
+
+def summarize_site_runs(results):
+    # per-site wall time (sum of its slices) and status, slowest first
+    site_summ = {}
+    for r in results:
+        summ = site_summ.setdefault(r["site"], {"site": r["site"], "elapsed": 0.0, "slices": 0, "failed": []})
+        summ["elapsed"] = round(summ["elapsed"] + r["elapsed"], 3)
+        summ["slices"] += 1
+        if r["status"] != "done":
+            summ["failed"].append(r["slice"])
+    return sorted(site_summ.values(), key = lambda x: x["elapsed"], reverse = True)
+
+def print_site_report(results, wall_time = None):
+    print("site\telapsed(s)\tslices\tfailed")
+    for summ in summarize_site_runs(results):
+        print(f"{summ['site']}\t{summ['elapsed']}\t{summ['slices']}\t{','.join(summ['failed'])}")
+    if wall_time is not None:
+        serial_time = sum(r["elapsed"] for r in results)
+        print(f"wall time: {round(wall_time,3)}s (serial sum: {round(serial_time,3)}s)")
@@ -0,0 +1,75 @@
+import re
+import json
+
+# compact, parameterized form of the generated valueset queries: whitespace collapsed, code lists
+# bound as array parameters and the source table bound by name, so the statement text is the same
+# for every site and only the parameters change. snowflake: array_contains(x::variant, parse_json(?))
+# and identifier(?); duckdb: list_contains(?, x) and query_table(?)
+
+SQL_LITERAL = r"'(?:[^']|'')*'"
+IN_LIST = re.compile(
+    r"(?:(?P<fn>(?:split_part|substring)\([^()]*\)) ?|(?P<col>[A-Za-z_][\w.]*) )(?P<neg>not )?in ?\((?P<vals>" + SQL_LITERAL + r"(?:," + SQL_LITERAL + r")*)\)",
+    re.IGNORECASE
+)
+
+def compact_sql(sql):
+    # collapse whitespace outside string literals and drop it around brackets and commas
+    parts = re.split("(" + SQL_LITERAL + ")", sql)
+    out = []
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            part = re.sub(r"\s+", " ", part)
+            part = re.sub(r"\s*([(),=])\s*", r"\1", part)
+        out.append(part)
+    return "".join(out).strip()
+
+def _unquote(vals):
+    # 'a','b' -> ["a","b"], repeated codes dropped
+    return list(dict.fromkeys(x[1:-1].replace("''", "'") for x in re.findall(SQL_LITERAL, vals)))
+
+def bind_sql(
+    sql, #generated query, ideally after compact_sql
+    sqlty, #"snow" or "duckdb"
+    srctbl_name = None, #table name to bind, e.g. the site table
+    binds = list() #other string literals to bind wherever they appear, e.g. the site acronym
+):
+    # returns (sql, params), placeholders are positional (?) in order of appearance
+    if sqlty not in ("snow", "duckdb"):
+        raise ValueError(f"parameter binding is not supported for sqlty '{sqlty}'")
+    alts = [IN_LIST.pattern]
+    if srctbl_name:
+        alts.append(r"(?P<tbl>(?<![\w.])" + re.escape(srctbl_name) + r"(?![\w.]))")
+    if binds:
+        alts.append(r"(?P<lit>" + "|".join(re.escape("'" + str(x).replace("'", "''") + "'") for x in binds) + ")")
+    pattern = re.compile("|".join(alts), re.IGNORECASE)
+    params = []
+
+    def sub(m):
+        if m.groupdict().get("tbl"):
+            params.append(srctbl_name)
+            return "identifier(?)" if sqlty == "snow" else "query_table(?)"
+        if m.groupdict().get("lit"):
+            params.append(m.group("lit")[1:-1].replace("''", "'"))
+            return "?"
+        vals = _unquote(m.group("vals"))
+        lhs = m.group("fn") or m.group("col")
+        neg = "not " if m.group("neg") else ""
+        if sqlty == "snow":
+            params.append(json.dumps(vals))
+            return neg + "array_contains(" + lhs + "::variant,parse_json(?))"
+        params.append(vals)
+        return neg + "list_contains(?," + lhs + ")"
+
+    return pattern.sub(sub, sql), params
+
+def sql_size_report(stmts):
+    # stmts: list of sql strings or (sql, params) tuples
+    texts = [x[0] if isinstance(x, tuple) else x for x in stmts]
+    params = [x[1] for x in stmts if isinstance(x, tuple)]
+    return {
+        "statements": len(texts),
+        "distinct_texts": len(set(texts)),
+        "sql_bytes": sum(len(x.encode()) for x in texts),
+        "distinct_sql_bytes": sum(len(x.encode()) for x in set(texts)),
+        "param_bytes": sum(len(json.dumps(p).encode()) for p in params)
+    }
@@ -0,0 +1,225 @@
+import os
+import numpy as np
+import pandas as pd
+from .gen_vs_json_utils import gen_code_ref, load_cdtype_map, DOMAIN_TO_CODES
+
+# seeded synthetic PCORnet CDM extracts in the DuckSession layout: <out_root>/<SITE>/<TABLE>/part-<k>.parquet.
+# phenotype codes are drawn from the valueset json, every other code is background noise that no
+# valueset matches. patients are generated in chunks, so memory stays flat from thousands to tens of millions
+
+CDM_TABLES = ["DEMOGRAPHIC", "ENCOUNTER", "DEATH", "DIAGNOSIS", "PROCEDURES", "PRESCRIBING", "LAB_RESULT_CM", "VITAL", "OBS_CLIN"]
+
+# share of patients carrying each phenotype, 1-3 coded events each
+DEFAULT_PREVALENCE = {"KTx": 0.05, "T2DM": 0.15, "MI": 0.05, "RenalBiopsy": 0.04, "AR": 0.02, "AntiRejectionRx": 0.05}
+
+# lab loinc: (unit, typical value); creatinine comes in both mass and molar units, glucose and
+# hemoglobin are background labs outside the study valuesets
+SYNTH_LABS = {
+    "2160-0": ("mg/dL", 1.3),
+    "38483-4": ("mg/dL", 1.3),
+    "14682-9": ("umol/L", 115.0),
+    "59826-8": ("umol/L", 115.0),
+    "11253-2": ("ng/mL", 8.0),
+    "2345-7": ("mg/dL", 110.0),
+    "718-7": ("g/dL", 13.0)
+}
+
+DAY0 = np.datetime64("2012-01-01")
+
+def _fmt_codes(system, codes):
+    # put the dot back into dotless icd codes
+    codes = np.asarray(codes, dtype = object)
+    if system in ("icd9cm", "icd10cm"):
+        return np.array([c[:3] + "." + c[3:] if len(c) > 3 else c for c in codes], dtype = object)
+    if system == "icd9proc":
+        return np.array([c[:2] + "." + c[2:] if len(c) > 2 else c for c in codes], dtype = object)
+    return codes
+
+def _code_pools(vs_url, cdtype_map, rng):
+    # {phenotype: {"domain", "cd", "cd_type"}} arrays to sample from
+    # coded events only, the lab/vital tables are generated from SYNTH_LABS
+    ref = gen_code_ref(vs_url, cdtype_map)
+    sys_domain = {x: d for d, systems in DOMAIN_TO_CODES.items() for x in systems}
+    ref = ref[ref["CODESYSTEM"].map(sys_domain).isin(["dx", "px", "rx"])]
+    pools = {}
+    for phe, grp in ref.groupby("PHE_TYPE", sort = True):
+        cds, types, domains = [], [], []
+        for system, sgrp in grp.groupby("CODESYSTEM", sort = True):
+            cd = sgrp["CD"].to_numpy(dtype = object)
+            # descendent-of: the parent code and one random child
+            child = np.array([
+                c + str(d) if p > 0 and len(c) < 5 else c
+                for c, p, d in zip(cd, sgrp["PREFIX_LEN"], rng.integers(0, 10, len(cd)))
+            ], dtype = object)
+            cd = np.concatenate([cd, child])
+            cds.append(_fmt_codes(system, cd))
+            types.append(np.repeat(sgrp["CD_TYPE"].iloc[0], len(cd)))
+            domains.append(np.repeat(sys_domain[system], len(cd)))
+        pools[phe] = {
+            "cd": np.concatenate(cds),
+            "cd_type": np.concatenate(types).astype(object),
+            "domain": np.concatenate(domains).astype(object)
+        }
+    return pools
+
+def _noise_codes(domain, n, rng):
+    # codes outside every valueset in vs-cde-kd.json
+    if domain == "dx":
+        letters = np.array(list("JKLMNR"), dtype = object)
+        cd = letters[rng.integers(0, len(letters), n)] + rng.integers(10, 100, n).astype(str).astype(object) + "." + rng.integers(0, 10, n).astype(str).astype(object)
+        return cd, np.full(n, "10", dtype = object)
+    if domain == "px":
+        return rng.integers(70000, 99500, n).astype(str).astype(object), np.full(n, "CH", dtype = object)
+    return rng.integers(1000000, 9999999, n).astype(str).astype(object), np.full(n, "RX", dtype = object)
+
+def _gen_chunk(site, chunk_id, pat_lo, pat_hi, pools, prevalence, mean_enc, rng):
+    n = pat_hi - pat_lo
+    patid = np.char.add(site + "-", np.arange(pat_lo, pat_hi).astype(str)).astype(object)
+    out = {}
+
+    ##--- demographic, death
+    out["DEMOGRAPHIC"] = pd.DataFrame({
+        "PATID": patid,
+        "BIRTH_DATE": np.datetime64("1930-01-01") + rng.integers(0, 75*365, n).astype("timedelta64[D]"),
+        "SEX": np.array(["F","M","UN"], dtype = object)[rng.choice(3, n, p = [0.49, 0.49, 0.02])],
+        "RACE": np.array(["05","03","02","01","NI"], dtype = object)[rng.choice(5, n, p = [0.7, 0.15, 0.05, 0.05, 0.05])],
+        "HISPANIC": np.array(["Y","N","NI"], dtype = object)[rng.choice(3, n, p = [0.1, 0.85, 0.05])]
+    })
+    dead = rng.random(n) < 0.03
+    out["DEATH"] = pd.DataFrame({
+        "PATID": patid[dead],
+        "DEATH_DATE": DAY0 + rng.integers(3*365, 13*365, dead.sum()).astype("timedelta64[D]")
+    })
+
+    ##--- encounters: 1 + poisson(mean_enc - 1) per patient
+    n_enc = 1 + rng.poisson(max(mean_enc - 1, 0), n)
+    enc_start = np.concatenate([[0], np.cumsum(n_enc)[:-1]])
+    enc_pat = np.repeat(np.arange(n), n_enc)
+    m = len(enc_pat)
+    enc_type = np.array(["AV","IP","EI","ED","OA","TH"], dtype = object)[rng.choice(6, m, p = [0.6, 0.1, 0.03, 0.1, 0.12, 0.05])]
+    admit = DAY0 + rng.integers(0, 13*365, m).astype("timedelta64[D]")
+    los = np.where(np.isin(enc_type, ["IP","EI"]), rng.integers(1, 11, m), 0).astype("timedelta64[D]")
+    encid = np.char.add(f"{site}-E{chunk_id}-", np.arange(m).astype(str)).astype(object)
+    out["ENCOUNTER"] = pd.DataFrame({
+        "PATID": patid[enc_pat],
+        "ENCOUNTERID": encid,
+        "ADMIT_DATE": admit,
+        "DISCHARGE_DATE": admit + los,
+        "ENC_TYPE": enc_type
+    })
+
+    ##--- coded events: background noise per encounter/patient plus phenotype events per patient
+    events = {"dx": [], "px": [], "rx": []}
+    for domain, lam in [("dx", 2.0), ("px", 1.0)]:
+        k = rng.poisson(lam, m)
+        enc_idx = np.repeat(np.arange(m), k)
+        cd, cd_type = _noise_codes(domain, len(enc_idx), rng)
+        events[domain].append((enc_idx, cd, cd_type))
+    k = rng.poisson(3.0, n)
+    enc_idx = enc_start[np.repeat(np.arange(n), k)] + (rng.random(k.sum()) * n_enc[np.repeat(np.arange(n), k)]).astype(int)
+    cd, cd_type = _noise_codes("rx", len(enc_idx), rng)
+    events["rx"].append((enc_idx, cd, cd_type))
+
+    for phe, rate in prevalence.items():
+        if phe not in pools:
+            continue
+        pool = pools[phe]
+        carriers = np.flatnonzero(rng.random(n) < rate)
+        k = rng.integers(1, 4, len(carriers))
+        pat_idx = np.repeat(carriers, k)
+        enc_idx = enc_start[pat_idx] + (rng.random(len(pat_idx)) * n_enc[pat_idx]).astype(int)
+        pick = rng.integers(0, len(pool["cd"]), len(pat_idx))
+        for domain in events:
+            sel = pool["domain"][pick] == domain
+            if sel.any():
+                events[domain].append((enc_idx[sel], pool["cd"][pick[sel]], pool["cd_type"][pick[sel]]))
+
+    def stack(domain):
+        enc_idx = np.concatenate([e[0] for e in events[domain]])
+        cd = np.concatenate([e[1] for e in events[domain]])
+        cd_type = np.concatenate([e[2] for e in events[domain]])
+        return enc_idx, cd, cd_type
+
+    enc_idx, cd, cd_type = stack("dx")
+    # some rows miss the event date, coalesce falls back to the admit date
+    dx_date = admit[enc_idx].astype("datetime64[ns]")
+    dx_date[rng.random(len(enc_idx)) < 0.05] = np.datetime64("NaT")
+    out["DIAGNOSIS"] = pd.DataFrame({
+        "PATID": patid[enc_pat[enc_idx]], "ENCOUNTERID": encid[enc_idx], "ENC_TYPE": enc_type[enc_idx],
+        "DX": cd, "DX_TYPE": cd_type, "DX_DATE": dx_date, "ADMIT_DATE": admit[enc_idx]
+    })
+    enc_idx, cd, cd_type = stack("px")
+    out["PROCEDURES"] = pd.DataFrame({
+        "PATID": patid[enc_pat[enc_idx]], "ENCOUNTERID": encid[enc_idx], "ENC_TYPE": enc_type[enc_idx],
+        "PX": cd, "PX_TYPE": cd_type, "PX_DATE": admit[enc_idx], "ADMIT_DATE": admit[enc_idx]
+    })
+    enc_idx, cd, _ = stack("rx")
+    out["PRESCRIBING"] = pd.DataFrame({
+        "PATID": patid[enc_pat[enc_idx]], "ENCOUNTERID": encid[enc_idx], "RXNORM_CUI": cd,
+        "RX_START_DATE": admit[enc_idx] + rng.integers(0, 3, len(enc_idx)).astype("timedelta64[D]"),
+        "RX_ORDER_DATE": admit[enc_idx]
+    })
+
+    ##--- labs: poisson(1.5) per encounter, lognormal around the typical value, a few missing results
+    k = rng.poisson(1.5, m)
+    enc_idx = np.repeat(np.arange(m), k)
+    loinc = np.array(list(SYNTH_LABS), dtype = object)[rng.integers(0, len(SYNTH_LABS), len(enc_idx))]
+    unit = np.array([SYNTH_LABS[x][0] for x in loinc], dtype = object)
+    result = np.round(np.array([SYNTH_LABS[x][1] for x in loinc]) * rng.lognormal(0, 0.35, len(enc_idx)), 2)
+    result[rng.random(len(enc_idx)) < 0.03] = np.nan
+    out["LAB_RESULT_CM"] = pd.DataFrame({
+        "PATID": patid[enc_pat[enc_idx]], "ENCOUNTERID": encid[enc_idx], "LAB_LOINC": loinc, "RAW_LAB_NAME": loinc,
+        "SPECIMEN_DATE": admit[enc_idx], "LAB_ORDER_DATE": admit[enc_idx], "RESULT_DATE": admit[enc_idx] + rng.integers(0, 2, len(enc_idx)).astype("timedelta64[D]"),
+        "RESULT_NUM": result, "RESULT_UNIT": unit, "NORM_RANGE_LOW": None, "NORM_RANGE_HIGH": None, "RESULT_QUAL": "NI"
+    })
+
+    ##--- vitals: 60% of encounters, height in inches and weight in lb, 1% implausible values
+    enc_idx = np.flatnonzero(rng.random(m) < 0.6)
+    ht = np.round(rng.normal(66, 4, len(enc_idx)), 1)
+    wt = np.round(rng.normal(180, 40, len(enc_idx)), 1)
+    wt[rng.random(len(enc_idx)) < 0.01] = 9999
+    bmi = np.where(rng.random(len(enc_idx)) < 0.5, np.round(703 * wt / ht**2, 1), np.nan)
+    out["VITAL"] = pd.DataFrame({
+        "PATID": patid[enc_pat[enc_idx]], "ENCOUNTERID": encid[enc_idx], "MEASURE_DATE": admit[enc_idx],
+        "HT": ht, "WT": wt, "ORIGINAL_BMI": bmi,
+        "SMOKING": np.array(["01","02","03","04","NI"], dtype = object)[rng.integers(0, 5, len(enc_idx))]
+    })
+
+    ##--- obs_clin: loinc-coded weight in kg for 20% of encounters
+    enc_idx = np.flatnonzero(rng.random(m) < 0.2)
+    out["OBS_CLIN"] = pd.DataFrame({
+        "PATID": patid[enc_pat[enc_idx]], "ENCOUNTERID": encid[enc_idx],
+        "OBSCLIN_START_DATE": admit[enc_idx], "OBSCLIN_STOP_DATE": admit[enc_idx],
+        "OBSCLIN_TYPE": "LC", "OBSCLIN_CODE": "29463-7", "RAW_OBSCLIN_NAME": "Body weight",
+        "OBSCLIN_RESULT_NUM": np.round(rng.normal(82, 18, len(enc_idx)), 1), "OBSCLIN_RESULT_UNIT": "kg",
+        "OBSCLIN_RESULT_QUAL": None, "OBSCLIN_RESULT_TEXT": None
+    })
+    return out
+
+def gen_synthetic_cdm(
+    out_root, #folder to write the site extracts to
+    n_pats, #total number of patients, split evenly across sites
+    sites = ["SITE1","SITE2"], #site acronyms, one subfolder each
+    seed = 42, #same seed, sites and chunk_pats give the same extracts
+    chunk_pats = 250000, #patients generated and written at a time
+    vs_url = './ref/vs-cde-kd.json', #valueset json the phenotype codes are drawn from
+    cdtype_map = './ref/cdtype-map.json', #codesystem to code type values
+    prevalence = None, #{phenotype: share of patients}, defaults to DEFAULT_PREVALENCE
+    mean_enc = 8 #mean encounters per patient
+):
+    prevalence = DEFAULT_PREVALENCE if prevalence is None else prevalence
+    cdtype_map = load_cdtype_map(cdtype_map)
+    pools = _code_pools(vs_url, cdtype_map, np.random.default_rng(seed))
+    row_cnt = {tbl: 0 for tbl in CDM_TABLES}
+    per_site = -(-n_pats // len(sites))
+    for i, site in enumerate(sites):
+        n_site = max(0, min(per_site, n_pats - i * per_site))
+        for tbl in CDM_TABLES:
+            os.makedirs(os.path.join(out_root, site, tbl), exist_ok = True)
+        for k, pat_lo in enumerate(range(0, n_site, chunk_pats)):
+            rng = np.random.default_rng([seed, i, k])
+            chunk = _gen_chunk(site, k, pat_lo, min(pat_lo + chunk_pats, n_site), pools, prevalence, mean_enc, rng)
+            for tbl, df in chunk.items():
+                df.to_parquet(os.path.join(out_root, site, tbl, f"part-{k:05d}.parquet"), index = False)
+                row_cnt[tbl] += len(df)
+    return row_cnt
@@ -0,0 +1,230 @@
+import json
+import time
+import uuid
+import hashlib
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from .duckdb_utils import DuckSession
+
+# per-statement run log: every statement sent through a TrackedSession is recorded with its
+# query id, wall time, rows inserted/deleted and, on snowflake, the warehouse metrics of the query.
+# records are appended to a local json lines file as they finish and written to a run-log table
+# at the end of the run; summarize_run_log ranks the (site, slice) pairs by time spent
+
+DML_TYPES = ("INSERT", "DELETE", "UPDATE", "MERGE")
+RUN_LOG_COLS = [
+    "run_id", "step", "site", "slice", "attempt", "stmt_type", "sql_hash", "sql_text", "started_at",
+    "query_id", "elapsed_s", "rows_affected", "bytes_scanned", "rows_produced", "warehouse", "status", "error"
+]
+
+def _now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+def _stmt_type(query):
+    words = query.split(None, 5)
+    if not words:
+        return ""
+    stmt = words[0].upper()
+    if stmt == "CREATE" and " AS " in query.upper():
+        return "CTAS"
+    return stmt
+
+def _rows_affected(stmt_type, rows):
+    # INSERT/DELETE/UPDATE return the affected row count(s) as the only row, MERGE one count per action
+    if stmt_type not in DML_TYPES or not rows:
+        return None
+    vals = [v for v in tuple(rows[0]) if isinstance(v, int)]
+    return sum(vals) if vals else None
+
+class TrackedSession:
+    # wraps a snowpark session or DuckSession; anything other than sql/save_as_table is passed through
+    def __init__(
+        self,
+        session, #snowpark session or DuckSession
+        run_id = None, #id shared by all records of the run, generated if None
+        jsonl_file = None, #local json lines file the records are appended to, None to keep them in memory only
+        log_tbl = "KTX_RUN_LOG", #run-log table written by flush, None to skip it
+        step = "" #default step name for the records, e.g. the script name
+    ):
+        self.session = session
+        self.run_id = run_id or datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S") + "-" + uuid.uuid4().hex[:6]
+        self.jsonl_file = jsonl_file
+        self.log_tbl = log_tbl
+        self.records = []
+        self._flushed = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._default_tags = {"step": step}
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    @contextmanager
+    def tag(self, **tags):
+        # tags (site, slice, step, attempt, ...) for the statements run by this thread inside the block
+        prev = getattr(self._local, "tags", {})
+        self._local.tags = {**prev, **tags}
+        try:
+            yield self
+        finally:
+            self._local.tags = prev
+
+    def current_tags(self):
+        # tags of the calling thread, to carry them over to worker threads
+        return dict(getattr(self._local, "tags", {}))
+
+    def sql(self, query, params = None):
+        return TrackedSqlResult(self, query, params)
+
+    def save_as_table(self, df, tbl_name, mode = "overwrite"):
+        # snowpark DataFrame write, tracked like a CTAS
+        def run():
+            job = df.write.mode(mode).save_as_table(tbl_name, block = False)
+            job.result()
+            return [], job.query_id
+        return self._track(f"-- save_as_table {tbl_name}\n" + df.queries["queries"][-1], run, stmt_type = "CTAS")
+
+    def _track(self, query, run, stmt_type = None):
+        stmt_type = stmt_type or _stmt_type(query)
+        rec = {
+            "run_id": self.run_id,
+            **self._default_tags,
+            "site": None, "slice": None, "attempt": None,
+            **getattr(self._local, "tags", {}),
+            "stmt_type": stmt_type,
+            "sql_hash": hashlib.md5(query.encode()).hexdigest(),
+            "sql_text": query.strip()[:2000],
+            "started_at": _now(),
+            "query_id": None, "elapsed_s": None, "rows_affected": None,
+            "bytes_scanned": None, "rows_produced": None, "warehouse": None,
+            "status": "done", "error": None
+        }
+        start = time.perf_counter()
+        try:
+            rows, rec["query_id"] = run()
+            rec["rows_affected"] = _rows_affected(stmt_type, rows)
+            return rows
+        except Exception as e:
+            rec["status"], rec["error"] = "failed", repr(e)[:1000]
+            raise
+        finally:
+            rec["elapsed_s"] = round(time.perf_counter() - start, 4)
+            self._append(rec)
+
+    def _append(self, rec):
+        with self._lock:
+            self.records.append(rec)
+            if self.jsonl_file:
+                with open(self.jsonl_file, "a", encoding = "utf-8") as f:
+                    f.write(json.dumps(rec, default = str) + "\n")
+
+    def _fetch_warehouse_metrics(self, recs):
+        # snowflake only: bytes scanned, rows produced/inserted and warehouse from the session's query history
+        qids = [r["query_id"] for r in recs if r["query_id"]]
+        if not qids or isinstance(self.session, DuckSession):
+            return
+        try:
+            rows = self.session.sql(f"""
+                SELECT QUERY_ID, BYTES_SCANNED, ROWS_PRODUCED, ROWS_INSERTED, WAREHOUSE_NAME
+                FROM TABLE(INFORMATION_SCHEMA.QUERY_HISTORY_BY_SESSION(RESULT_LIMIT => 10000))
+                WHERE QUERY_ID IN ({','.join("'" + q + "'" for q in qids)})
+            """).collect()
+        except Exception as e:
+            print(f"warehouse metrics not available: {e!r}")
+            return
+        metrics = {r[0]: r for r in rows}
+        for rec in recs:
+            m = metrics.get(rec["query_id"])
+            if m is not None:
+                rec["bytes_scanned"], rec["rows_produced"], rec["warehouse"] = m[1], m[2], m[4]
+                if rec["rows_affected"] is None and m[3]:
+                    rec["rows_affected"] = m[3]
+
+    def flush(self):
+        # warehouse metrics for the records since the last flush, then append them to the run-log table
+        with self._lock:
+            recs = self.records[self._flushed:]
+            self._flushed = len(self.records)
+        if not recs:
+            return
+        self._fetch_warehouse_metrics(recs)
+        if self.log_tbl:
+            import pandas as pd
+            # fixed column set, tags beyond these are kept in the json lines file only
+            df = pd.DataFrame([{c: r.get(c) for c in RUN_LOG_COLS} for r in recs]).rename(columns = str.upper)
+            for c in ("ATTEMPT", "ROWS_AFFECTED", "BYTES_SCANNED", "ROWS_PRODUCED"):
+                df[c] = df[c].astype("Int64")
+            df = df.astype({c: "string" for c in df.columns if df[c].dtype == object})
+            self.session.write_pandas(df, self.log_tbl, auto_create_table = True, overwrite = False)
+
+class TrackedSqlResult:
+    def __init__(self, tracked, query, params = None):
+        self.tracked = tracked
+        self.query = query
+        self.params = params
+
+    def collect(self):
+        def run():
+            res = self.tracked.session.sql(self.query, params = self.params)
+            if hasattr(res, "collect_nowait"):
+                # snowpark: the async job carries the snowflake query id
+                job = res.collect_nowait()
+                return job.result(), job.query_id
+            return res.collect(), uuid.uuid4().hex
+        return self.tracked._track(self.query, run)
+
+    def to_pandas(self):
+        return self.tracked.session.sql(self.query, params = self.params).to_pandas()
+
+    def to_pandas_batches(self):
+        return self.tracked.session.sql(self.query, params = self.params).to_pandas_batches()
+
+def load_run_log(
+    jsonl_file, #json lines file written by TrackedSession
+    run_id = None #records of this run only, None for the last run in the file
+):
+    with open(jsonl_file, "r", encoding = "utf-8") as f:
+        recs = [json.loads(line) for line in f if line.strip()]
+    if run_id is None and recs:
+        run_id = recs[-1]["run_id"]
+    return [r for r in recs if r["run_id"] == run_id]
+
+def summarize_run_log(records):
+    # per (step, site, slice): statements, failures, wall time, rows and bytes, slowest first
+    summ = {}
+    for r in records:
+        key = (r.get("step") or "", r.get("site") or "", r.get("slice") or "")
+        s = summ.setdefault(key, {
+            "step": key[0], "site": key[1], "slice": key[2],
+            "stmts": 0, "failed": 0, "elapsed_s": 0.0, "rows_written": 0, "bytes_scanned": None
+        })
+        s["stmts"] += 1
+        s["failed"] += r["status"] != "done"
+        s["elapsed_s"] = round(s["elapsed_s"] + (r["elapsed_s"] or 0), 4)
+        if r["stmt_type"] != "DELETE":
+            s["rows_written"] += r["rows_affected"] or 0
+        if r.get("bytes_scanned") is not None:
+            s["bytes_scanned"] = (s["bytes_scanned"] or 0) + r["bytes_scanned"]
+    return sorted(summ.values(), key = lambda x: x["elapsed_s"], reverse = True)
+
+def print_run_report(records, top = 10):
+    if not records:
+        print("run log: no statements")
+        return
+    summ = summarize_run_log(records)
+    total = sum(s["elapsed_s"] for s in summ)
+    print(f"run {records[0]['run_id']}: {len(records)} statement(s), {round(total,3)}s")
+    print("step\tsite\tslice\telapsed(s)\tshare\tstmts\tfailed\trows_written\tbytes_scanned")
+    for s in summ[:top]:
+        share = f"{s['elapsed_s'] / total:.0%}" if total else ""
+        print(
+            f"{s['step']}\t{s['site']}\t{s['slice']}\t{s['elapsed_s']}\t{share}\t{s['stmts']}\t{s['failed']}\t"
+            f"{s['rows_written']}\t{'' if s['bytes_scanned'] is None else s['bytes_scanned']}"
+        )
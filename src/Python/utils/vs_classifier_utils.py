@@ -0,0 +1,179 @@
+import numpy as np
+import pandas as pd
+from .gen_vs_json_utils import load_vs_json, load_cdtype_map, parse_range, merge_ranges, DOMAIN_TO_CODES
+
+# offline phenotype labelling of (code, code_type) columns from the valueset json, without a
+# warehouse. codes are compared without "." like gen_code_ref: descendent-of values are prefixes,
+# codeList/concept values are exact codes and codeRange values are numeric intervals
+
+def _to_object_array(x):
+    # pandas Series, numpy array, list or pyarrow Array/ChunkedArray -> numpy object array
+    if type(x).__module__.startswith("pyarrow"):
+        x = x.to_pandas()
+    return pd.Series(x, dtype = object).to_numpy()
+
+def _norm_codes(codes):
+    # dotless, null-safe unicode array
+    s = pd.Series(_to_object_array(codes), dtype = object).fillna("").astype(str)
+    return s.str.replace(".", "", regex = False).to_numpy(dtype = str)
+
+def _safe_take(uniques, idx):
+    # uniques[idx] with None where idx is -1 (null)
+    out = np.empty(len(idx), dtype = object)
+    ok = idx >= 0
+    out[ok] = np.asarray(uniques, dtype = object)[idx[ok]]
+    return out
+
+def _lookup_bits(keys, bits, x):
+    # sorted-array lookup: rows of x found in keys get the label bits of the matching key
+    out = np.zeros((len(x), bits.shape[1]), dtype = np.uint64)
+    if len(keys) == 0 or len(x) == 0:
+        return out
+    idx = np.searchsorted(keys, x)
+    idx[idx == len(keys)] = 0
+    hit = keys[idx] == x
+    out[hit] = bits[idx[hit]]
+    return out
+
+class VsClassifier:
+    def __init__(
+        self,
+        url, #url or local path to valueset json file
+        cdtype_map = None, #dict or path to json file of {codesystem: code type value}; None ignores code types
+        sel_keys = list(), #list of selected keys, can be empty
+        sel_domain = "" #restrict to the code systems of one domain ("dx","px","lab","rx"), can be empty
+    ):
+        json_file, self.vs_hash = load_vs_json(url)
+        systems = DOMAIN_TO_CODES[sel_domain] if sel_domain else None
+        cdtype_map = load_cdtype_map(cdtype_map) if cdtype_map is not None else None
+
+        blocks = [x for x in json_file if len(sel_keys) == 0 or x["name"] in sel_keys]
+        self.labels = list(dict.fromkeys(x["name"] for x in blocks))
+        self.n_words = max(1, (len(self.labels) + 63) // 64)
+
+        # collect rules by code type: {cd_type: {"exact": {code: {label}}, "prefix": {len: {prefix: {label}}}, "range": [...]}}
+        rules = {}
+        for block in blocks:
+            label = self.labels.index(block["name"])
+            for chunk in block["compose"]["include"]:
+                system = chunk["system"]
+                if systems is not None and system not in systems:
+                    continue
+                if cdtype_map is not None and system not in cdtype_map:
+                    continue
+                rule = rules.setdefault(
+                    cdtype_map[system] if cdtype_map is not None else None,
+                    {"exact": {}, "prefix": {}, "range": []}
+                )
+                for item in chunk.get("filter", []):
+                    if item["property"] == "codePrecision" and item["op"] == "descendent-of":
+                        for cd in item["value"]:
+                            cd = cd.replace(".", "")
+                            rule["prefix"].setdefault(len(cd), {}).setdefault(cd, set()).add(label)
+                    elif item["property"] == "codeRange" and item["op"] == "in":
+                        rule["range"] += [(p, lo, hi, label) for p, lo, hi in merge_ranges([parse_range(x) for x in item["value"]])]
+                    elif item["property"] == "codeList" and item["op"] == "exists":
+                        for cd in item["value"]:
+                            rule["exact"].setdefault(cd.replace(".", ""), set()).add(label)
+                for x in chunk.get("concept", []):
+                    rule["exact"].setdefault(x["code"].replace(".", ""), set()).add(label)
+
+        # compile to sorted key arrays with aligned label bitmasks
+        self.tables = {}
+        for cd_type, rule in rules.items():
+            self.tables[cd_type] = {
+                "exact": self._compile(rule["exact"]),
+                "prefix": {n: self._compile(v) for n, v in sorted(rule["prefix"].items())},
+                "range": rule["range"]
+            }
+
+    def _compile(self, code_labels):
+        keys = np.array(sorted(code_labels), dtype = str)
+        bits = np.zeros((len(keys), self.n_words), dtype = np.uint64)
+        for i, k in enumerate(keys):
+            for label in code_labels[k]:
+                bits[i, label // 64] |= np.uint64(1) << np.uint64(label % 64)
+        return keys, bits
+
+    def match_bits(
+        self,
+        codes, #column of codes
+        code_types = None #column of code types, ignored when the classifier was built without cdtype_map
+    ):
+        # label bitmask per row, shape (n, ceil(n_labels/64)). code columns repeat heavily, so
+        # each distinct (code, code type) pair is matched once and the result broadcast back
+        cd_idx, cd_uniq = pd.factorize(_to_object_array(codes))
+        if None in self.tables or code_types is None:
+            # nulls are factorized to -1 and pick the trailing all-zero row
+            bits = self._match_distinct(cd_uniq, None)
+            return np.vstack([bits, np.zeros((1, self.n_words), dtype = np.uint64)])[cd_idx]
+        ty_idx, ty_uniq = pd.factorize(_to_object_array(code_types))
+        n_ty = len(ty_uniq) + 1
+        pair_idx, pairs = pd.factorize((cd_idx.astype(np.int64) + 1) * n_ty + (ty_idx + 1))
+        bits = self._match_distinct(_safe_take(cd_uniq, pairs // n_ty - 1), _safe_take(ty_uniq, pairs % n_ty - 1))
+        return bits[pair_idx]
+
+    def _match_distinct(self, codes, code_types):
+        cd = _norm_codes(codes)
+        out = np.zeros((len(cd), self.n_words), dtype = np.uint64)
+        if code_types is None:
+            groups = [(tbl, np.arange(len(cd))) for tbl in self.tables.values()]
+        else:
+            ty = pd.Series(code_types, dtype = object).fillna("").astype(str).to_numpy()
+            groups = [(tbl, np.flatnonzero(ty == cd_type)) for cd_type, tbl in self.tables.items()]
+
+        for tbl, rows in groups:
+            if len(rows) == 0:
+                continue
+            sub = cd[rows]
+            bits = _lookup_bits(*tbl["exact"], sub)
+            for n, (keys, kbits) in tbl["prefix"].items():
+                bits |= _lookup_bits(keys, kbits, sub.astype(f"U{n}"))
+            if tbl["range"]:
+                s = pd.Series(sub, dtype = object)
+                for p in sorted({r[0] for r in tbl["range"]}):
+                    # canonical digits only, same reading as expand_range
+                    num = s.str.extract("^" + p + "(0|[1-9][0-9]{0,17})$", expand = False)
+                    ok = num.notna().to_numpy()
+                    val = np.full(len(sub), -1, dtype = np.int64)
+                    val[ok] = num[ok].astype(np.int64).to_numpy()
+                    for rp, lo, hi, label in tbl["range"]:
+                        if rp == p:
+                            hit = ok & (val >= lo) & (val <= hi)
+                            bits[hit, label // 64] |= np.uint64(1) << np.uint64(label % 64)
+            out[rows] |= bits
+        return out
+
+    def match_matrix(self, codes, code_types = None):
+        # boolean (n, n_labels) matrix, columns in the order of self.labels
+        bits = self.match_bits(codes, code_types)
+        return np.stack([
+            (bits[:, j // 64] >> np.uint64(j % 64)) & np.uint64(1) for j in range(len(self.labels))
+        ], axis = 1).astype(bool) if self.labels else np.zeros((len(bits), 0), dtype = bool)
+
+    def classify(
+        self,
+        codes, #column of codes
+        code_types = None, #column of code types
+        offset = 0 #added to ROW_IDX, for batches
+    ):
+        # long output like the union-all sql: one (ROW_IDX, PHE_TYPE) row per matching label
+        rows, cols = np.nonzero(self.match_matrix(codes, code_types))
+        return pd.DataFrame({
+            "ROW_IDX": rows + offset,
+            "PHE_TYPE": np.array(self.labels, dtype = object)[cols]
+        })
+
+    def classify_batches(
+        self,
+        batches, #iterable of pandas DataFrames or pyarrow RecordBatches/Tables, e.g. pq.ParquetFile(...).iter_batches()
+        cd_field = "CD", #code column
+        cdtype_field = "CD_TYPE" #code type column, can be None
+    ):
+        # yield one long label frame per batch, ROW_IDX counted across batches
+        offset = 0
+        for batch in batches:
+            codes = batch[cd_field]
+            code_types = batch[cdtype_field] if cdtype_field is not None else None
+            yield self.classify(codes, code_types, offset = offset)
+            offset += len(codes)
@@ -0,0 +1,220 @@
+import os
+import re
+import json
+import sqlite3
+import hashlib
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from .gen_vs_json_utils import load_vs_json, iter_ref_segments, parse_range
+
+# indexed valueset store: the blocks of a valueset json (e.g. ./ref/vs-cde-kd.json) kept in one
+# sqlite file, one row per block plus a code index, so that
+#  - blocks are found by id or name, and codes mapped back to their blocks, through indexes
+#    (exact codes and codeList values by equality, descendent-of prefixes by the prefixes of the
+#    code, codeRange intervals by a range probe) instead of a pass over every block
+#  - new ids come from a per-prefix counter, not a scan of the existing ids
+#  - a block is appended as a few rows, the rest of the library is not rewritten
+# export_json writes the blocks back in the json layout, in the order they were added.
+# QueryFromJson, JsonBlockVS, gen_code_ref and load_vs_json take a store path wherever they take
+# a json path (see is_vs_store)
+
+VS_STORE_EXTS = (".db", ".sqlite", ".sqlite3")
+
+VS_STORE_DDL = [
+    """CREATE TABLE IF NOT EXISTS vs_block (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT NOT NULL UNIQUE, name TEXT NOT NULL UNIQUE,
+        body TEXT NOT NULL, block_hash TEXT NOT NULL, added_at TEXT
+    )""",
+    # one row per code, codeList value or descendent-of prefix, codes without "." like gen_code_ref
+    """CREATE TABLE IF NOT EXISTS vs_code (
+        code TEXT NOT NULL, system TEXT, op TEXT, block_seq INTEGER NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS vs_code_idx ON vs_code (code, op)",
+    # codeRange intervals, merged as in QueryFromJson.parse_filter
+    """CREATE TABLE IF NOT EXISTS vs_range (
+        prefix TEXT NOT NULL, lo INTEGER NOT NULL, hi INTEGER NOT NULL, system TEXT, block_seq INTEGER NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS vs_range_idx ON vs_range (prefix, lo)",
+    # last number handed out per id prefix
+    "CREATE TABLE IF NOT EXISTS vs_id_seq (prefix TEXT PRIMARY KEY, last_num INTEGER NOT NULL)",
+    # running digest of the appended blocks
+    "CREATE TABLE IF NOT EXISTS vs_meta (key TEXT PRIMARY KEY, value TEXT)"
+]
+
+def is_vs_store(path):
+    return isinstance(path, str) and path.lower().endswith(VS_STORE_EXTS)
+
+def _split_id(block_id):
+    # "KD00011" -> ("KD", 11); ids without trailing digits get no number
+    m = re.match(r"^(.*?)(\d+)$", block_id)
+    return (m.group(1), int(m.group(2))) if m else (block_id, None)
+
+def _norm_code(code):
+    return str(code).replace('.', '')
+
+class VsStore:
+    def __init__(
+        self,
+        path, #sqlite file, created if missing
+        timeout = 30 #seconds to wait for another writer
+    ):
+        self.path = path
+        self.timeout = timeout
+        with self._connect() as con:
+            for stmt in VS_STORE_DDL:
+                con.execute(stmt)
+
+    @contextmanager
+    def _connect(self):
+        # one short-lived connection per call, so a store can be shared across threads and processes
+        con = sqlite3.connect(self.path, timeout = self.timeout)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    @classmethod
+    def from_json(
+        cls,
+        json_url, #url or local path to a valueset json file
+        path, #sqlite file to write
+        overwrite = False #replace an existing store instead of appending to it
+    ):
+        if overwrite and os.path.exists(path):
+            os.remove(path)
+        store = cls(path)
+        json_file, _ = load_vs_json(json_url)
+        with store._connect() as con:
+            for block in json_file:
+                store._insert(con, block)
+        return store
+
+    def _insert(self, con, block):
+        # rows of one block, in the caller's transaction
+        prefix, num = _split_id(block["id"])
+        body = json.dumps(block)
+        block_hash = hashlib.sha256(json.dumps(block, sort_keys = True).encode("utf-8")).hexdigest()
+        try:
+            seq = con.execute(
+                "INSERT INTO vs_block (id, name, body, block_hash, added_at) VALUES (?, ?, ?, ?, ?)",
+                (block["id"], block["name"], body, block_hash, datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"))
+            ).lastrowid
+        except sqlite3.IntegrityError:
+            raise ValueError(f"valueset id '{block['id']}' or name '{block['name']}' is already in {self.path}")
+
+        codes, ranges = [], []
+        for (_, _, _, system), vals, ops in iter_ref_segments([block], expand_ranges = False):
+            if isinstance(ops, str) and ops == "range":
+                ranges += [(*parse_range(v), system, seq) for v in vals]
+            else:
+                ops = [ops] * len(vals) if isinstance(ops, str) else ops
+                codes += [(_norm_code(v), system, op, seq) for v, op in zip(vals, ops)]
+        con.executemany("INSERT INTO vs_code (code, system, op, block_seq) VALUES (?, ?, ?, ?)", codes)
+        con.executemany("INSERT INTO vs_range (prefix, lo, hi, system, block_seq) VALUES (?, ?, ?, ?, ?)", ranges)
+
+        if num is not None:
+            con.execute(
+                "INSERT INTO vs_id_seq (prefix, last_num) VALUES (?, ?) "
+                "ON CONFLICT (prefix) DO UPDATE SET last_num = max(last_num, excluded.last_num)",
+                (prefix, num)
+            )
+        digest = con.execute("SELECT value FROM vs_meta WHERE key = 'digest'").fetchone()
+        digest = hashlib.sha256(((digest[0] if digest else "") + block_hash).encode("utf-8")).hexdigest()
+        con.execute("INSERT OR REPLACE INTO vs_meta (key, value) VALUES ('digest', ?)", (digest,))
+
+    def next_id(
+        self,
+        idstarter, #id prefix, e.g. "KD"
+        idlength #digits of the number, zero-padded
+    ):
+        # the id the next block of this prefix gets, from the counter
+        with self._connect() as con:
+            row = con.execute("SELECT last_num FROM vs_id_seq WHERE prefix = ?", (idstarter,)).fetchone()
+        return idstarter + str((row[0] if row else 0) + 1).zfill(idlength)
+
+    def add_block(
+        self,
+        block, #valueset block as in the json file; an "id" of None is allocated from idstarter/idlength
+        idstarter = "",
+        idlength = 5
+    ):
+        # appends the block and returns its id; raises ValueError if its id or name is taken
+        with self._connect() as con:
+            con.execute("BEGIN IMMEDIATE")
+            if block.get("id") is None:
+                row = con.execute("SELECT last_num FROM vs_id_seq WHERE prefix = ?", (idstarter,)).fetchone()
+                block = {**block, "id": idstarter + str((row[0] if row else 0) + 1).zfill(idlength)}
+            self._insert(con, block)
+        return block["id"]
+
+    def get_block(self, block_id):
+        with self._connect() as con:
+            row = con.execute("SELECT body FROM vs_block WHERE id = ?", (block_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_by_name(self, name):
+        with self._connect() as con:
+            row = con.execute("SELECT body FROM vs_block WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_blocks(
+        self,
+        names = list() #block names, empty for all blocks
+    ):
+        # blocks in the order they were added
+        with self._connect() as con:
+            if len(names) == 0:
+                rows = con.execute("SELECT body FROM vs_block ORDER BY seq").fetchall()
+            else:
+                names = list(dict.fromkeys(names))
+                rows = con.execute(
+                    f"SELECT body FROM vs_block WHERE name IN ({','.join('?' * len(names))}) ORDER BY seq", names
+                ).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def digest(self):
+        # changes with every appended block
+        with self._connect() as con:
+            row = con.execute("SELECT value FROM vs_meta WHERE key = 'digest'").fetchone()
+        return row[0] if row else hashlib.sha256(b"").hexdigest()
+
+    def find_code(
+        self,
+        code, #code as in the source data, with or without "."
+        system = None #code system, None for any
+    ):
+        # reverse lookup: the blocks whose codes, prefixes or ranges cover the code, as
+        # [{"id", "name", "system", "op"}] in block order
+        cd = _norm_code(code)
+        prefixes = [cd[:i] for i in range(1, len(cd) + 1)]
+        qry = f"""
+            SELECT b.seq, b.id, b.name, c.system, c.op FROM vs_code c JOIN vs_block b ON b.seq = c.block_seq
+            WHERE (c.code = ? AND c.op <> 'descendent-of')
+               OR (c.code IN ({','.join('?' * len(prefixes))}) AND c.op = 'descendent-of')
+        """
+        params = [cd] + prefixes
+        m = re.match(r"^([A-Za-z]?)(0|[1-9][0-9]*)$", cd)
+        if m:
+            qry += """
+            UNION ALL
+            SELECT b.seq, b.id, b.name, r.system, 'range' FROM vs_range r JOIN vs_block b ON b.seq = r.block_seq
+            WHERE r.prefix = ? AND r.lo <= ? AND r.hi >= ?
+            """
+            params += [m.group(1), int(m.group(2)), int(m.group(2))]
+        with self._connect() as con:
+            rows = con.execute(f"SELECT DISTINCT * FROM ({qry}) ORDER BY 1", params).fetchall()
+        return [
+            {"id": r[1], "name": r[2], "system": r[3], "op": r[4]}
+            for r in rows if system is None or r[3] == system
+        ]
+
+    def export_json(
+        self,
+        save_to #json file to write, same layout as ./ref/vs-cde-kd.json
+    ):
+        tmp_file = save_to + ".tmp"
+        with open(tmp_file, "w", encoding = "utf-8") as f:
+            json.dump(self.get_blocks(), f, indent = 4)
+        os.replace(tmp_file, save_to)
+        return save_to
@@ -0,0 +1,43 @@
+import json
+import argparse
+from utils import VsStore
+
+# indexed valueset store kept next to the curated json, see utils/vs_store_utils.py:
+#   python src/Python/vs_store.py import ./ref/vs-cde-kd.json ./ref/vs-cde-kd.db
+#   python src/Python/vs_store.py find ./ref/vs-cde-kd.db 250.00 E11.9
+#   python src/Python/vs_store.py export ./ref/vs-cde-kd.db ./ref/vs-cde-kd.json
+# the store path can be given to QueryFromJson(url = ...) and JsonBlockVS in place of the json
+# run from the repo root, like the other scripts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "build, query and export an indexed valueset store")
+    sub = parser.add_subparsers(dest = "cmd", required = True)
+    p = sub.add_parser("import", help = "load a valueset json into a store")
+    p.add_argument("json_url", help = "url or local path to the valueset json")
+    p.add_argument("store", help = "sqlite file, e.g. ./ref/vs-cde-kd.db")
+    p.add_argument("--overwrite", action = "store_true", help = "replace the store instead of appending to it")
+    p = sub.add_parser("export", help = "write a store back to the valueset json layout")
+    p.add_argument("store")
+    p.add_argument("json_file")
+    p = sub.add_parser("find", help = "valuesets covering each code")
+    p.add_argument("store")
+    p.add_argument("codes", nargs = "+")
+    p.add_argument("--system", default = None, help = "code system, e.g. icd10cm")
+    p = sub.add_parser("next-id", help = "id the next block of a prefix gets")
+    p.add_argument("store")
+    p.add_argument("--idstarter", default = "KD")
+    p.add_argument("--idlength", type = int, default = 5)
+    args = parser.parse_args()
+
+    if args.cmd == "import":
+        store = VsStore.from_json(args.json_url, args.store, overwrite = args.overwrite)
+        print(f"{len(store.get_blocks())} valueset(s) in {args.store}")
+    elif args.cmd == "export":
+        VsStore(args.store).export_json(args.json_file)
+        print(f"written {args.json_file}")
+    elif args.cmd == "find":
+        store = VsStore(args.store)
+        for cd in args.codes:
+            print(cd + "\t" + json.dumps(store.find_code(cd, args.system)))
+    else:
+        print(VsStore(args.store).next_id(args.idstarter, args.idlength))
@@ -176,21 +176,23 @@ for(i=0; i<SITES.length; i++){
 $$
 ;
 
-create or replace table ALL_OBS (
-        PATID varchar(50) NOT NULL
-       ,OBS_DATE date
-       ,DAYS_SINCE_INDEX number
-       ,OBS_CODE_TYPE varchar(10)
-       ,OBS_CODE varchar(100)
-       ,OBS_NAME varchar(500)
-       ,OBS_NUM number 
-       ,OBS_UNIT varchar(50)
-       ,OBS_REF_LOW varchar(100)
-       ,OBS_REF_HIGH varchar(100) 
-       ,OBS_QUAL varchar(100)
-       ,OBS_TYPE varchar(105)
-       ,OBS_SRC varchar(10)
-);
+/* ALL_OBS is now built by src/Python/obs_extract.py: the loinc valuesets are pushed into each
+   site scan and the sites run in parallel. get_obs_long is kept for reference */
+-- create or replace table ALL_OBS (
+--         PATID varchar(50) NOT NULL
+--        ,OBS_DATE date
+--        ,DAYS_SINCE_INDEX number
+--        ,OBS_CODE_TYPE varchar(10)
+--        ,OBS_CODE varchar(100)
+--        ,OBS_NAME varchar(500)
+--        ,OBS_NUM number 
+--        ,OBS_UNIT varchar(50)
+--        ,OBS_REF_LOW varchar(100)
+--        ,OBS_REF_HIGH varchar(100) 
+--        ,OBS_QUAL varchar(100)
+--        ,OBS_TYPE varchar(105)
+--        ,OBS_SRC varchar(10)
+-- );
 
 
 /* test */
@@ -206,24 +208,24 @@ create or replace table ALL_OBS (
 -- select * from TMP_SP_OUTPUT;
 
 
-call get_obs_long(
-       'KTX_TBL1',
-       'ALL_OBS',
-       array_construct(
-         'ALLINA'
-        ,'IHC'
-        ,'KUMC'
-        ,'MCW'
-        ,'MU'
-        ,'UIOWA'
-        ,'UNMC'
-        ,'UTHOUSTON'
-        ,'UTSW'
-        ,'UU'
-        ,'WASHU'
-    ), 
-    FALSE, NULL
-);
+-- call get_obs_long(
+--        'KTX_TBL1',
+--        'ALL_OBS',
+--        array_construct(
+--          'ALLINA'
+--         ,'IHC'
+--         ,'KUMC'
+--         ,'MCW'
+--         ,'MU'
+--         ,'UIOWA'
+--         ,'UNMC'
+--         ,'UTHOUSTON'
+--         ,'UTSW'
+--         ,'UU'
+--         ,'WASHU'
+--     ), 
+--     FALSE, NULL
+-- );
 
 select * from ALL_OBS limit 5;
 select count(distinct patid), count(*) 
@@ -233,15 +235,15 @@ from ALL_OBS
 create or replace table SEL_OBS_BMI as
 with cte_wt as (
        select * from ALL_OBS
-       where obs_name in ('WT') 
+       where obs_name in ('WT') and obs_type = 'vital'
          and obs_num > 60 and obs_num < 1400
 ),   cte_ht as (
        select * from ALL_OBS
-       where obs_name in ('HT')
+       where obs_name in ('HT') and obs_type = 'vital'
          and obs_num > 40 and obs_num < 100
 ),   cte_bmi as (
        select * from ALL_OBS
-       where obs_name in ('ORIGINAL_BMI') 
+       where obs_name in ('BMI') and obs_type = 'vital'
          and obs_num between 10 and 200
 ),  cte_all_dt as (
        select distinct patid, obs_date, days_since_index,obs_src from cte_wt